@@ -6,58 +6,189 @@
         1. Combine fic IDs that were separately scraped
         2. Exclude fic IDs that were already scraped (to update a fandom's IDs, e.g.)
 
+    Rows are streamed from the ID CSVs to the output, so nothing but fic IDs is held in
+    memory: the IDs seen so far and the IDs to exclude, in sets. For more IDs than fit in
+    memory, --external-sort sorts the rows in runs of --run-size on disk instead and
+    merges them, so memory stays constant (the output is then in order of fic ID).
+    Only the fic_id column of the metadata to exclude is kept.
+
     @author Michael Miller Yoder
     @date 2020
 """
 
 import os
 import argparse
-import pandas as pd
+import csv
+import heapq
+import shutil
+import tempfile
+from ao3_output import read_columns
+
+
+def row_id(row):
+    return int(row[0])
+
+def id_rows(fpath):
+    """ Yields the rows of a CSV of fic IDs, skipping any without a numeric ID (like headers) """
+    with open(fpath, 'r', newline='') as f_in:
+        for row in csv.reader(f_in):
+            if row and row[0].strip().isdigit():
+                yield row
+
+def metadata_ids(path):
+    """ Yields the fic IDs in a stories.csv (or stories.parquet directory), reading only that column """
+    if os.path.isdir(path):
+        for fic_id, in read_columns(path, ['fic_id']):
+            yield int(fic_id)
+        return
+    csv.field_size_limit(1000000000)
+    with open(path, 'r', newline='') as f_in:
+        reader = csv.reader(f_in)
+        header = next(reader, None)
+        if header is None:
+            return
+        col = header.index('fic_id')
+        for row in reader:
+            if len(row) > col and row[col].strip().isdigit():
+                yield int(row[col])
+
+
+class ExternalSort():
+    """ Sorts rows by fic ID in runs of run_size rows, written to tmpdir, and merges them """
+
+    def __init__(self, tmpdir, run_size=200000):
+        self.tmpdir = tmpdir
+        self.run_size = run_size
+
+    def sorted(self, rows):
+        runs = []
+        run = []
+        for row in rows:
+            run.append(row)
+            if len(run) >= self.run_size:
+                runs.append(self.write_run(run))
+                run = []
+        if run:
+            runs.append(self.write_run(run))
+        return self.merge(runs)
+
+    def write_run(self, run):
+        # stable, and merge takes equal IDs from earlier runs first, so rows keep their input order
+        run.sort(key=row_id)
+        fd, fpath = tempfile.mkstemp(suffix='.csv', dir=self.tmpdir)
+        with open(fd, 'w', newline='') as f_out:
+            csv.writer(f_out).writerows(run)
+        return fpath
+
+    def merge(self, runs):
+        files = [open(fpath, 'r', newline='') for fpath in runs]
+        try:
+            yield from heapq.merge(*(csv.reader(f) for f in files), key=row_id)
+        finally:
+            for f, fpath in zip(files, runs):
+                f.close()
+                os.remove(fpath)
 
 
 class FicIdManipulator():
 
-    def __init__(self, outpath, sections_dirpath, scraped_path, exclude_path):
+    def __init__(self, outpath, sections_dirpath, scraped_path, exclude_path, external_sort=False, run_size=200000, tmpdir=None):
         self.outpath = outpath
         self.sections_dirpath = sections_dirpath
         self.scraped_path = scraped_path
         self.exclude_path = exclude_path
-        self.scraped_fic_ids = None
-        self.output_fic_ids = None
+        self.external_sort = external_sort
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self.n_scraped = 0
+        self.n_duplicates = 0
+        self.n_excluded = 0
+        self.n_output = 0
 
     def manipulate(self):
-        if self.sections_dirpath: self.combine_fic_ids()
-        if self.exclude_path: self.exclude_fic_ids()
+        tmpdir = tempfile.mkdtemp(dir=self.tmpdir) if self.external_sort else None
+        try:
+            self.sorter = ExternalSort(tmpdir, self.run_size) if self.external_sort else None
+            # the rows are only read once save_fic_ids writes them out
+            if self.sections_dirpath:
+                print("Combining scraped fic IDs...")
+                rows = self.combine_fic_ids()
+            else:
+                rows = self.load_scraped_fic_ids()
+            rows = self.unique(rows)
+            if self.exclude_path:
+                print("Removing fic IDs that were already scraped...")
+                rows = self.exclude_fic_ids(rows)
+            self.save_fic_ids(rows)
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        print(f"\tNumber of scraped fic IDs: {self.n_scraped} ({self.n_duplicates} duplicates)")
+        if self.exclude_path:
+            print(f"\tNumber of fic IDs already scraped: {self.n_excluded}")
+            print(f"\tNumber of new fic IDs: {self.n_output}")
 
     def combine_fic_ids(self):
-        # Load scraped fic IDs
-        print("Combining scraped fic IDs...")
-        self.scraped_fic_ids = pd.DataFrame()
-        for fname in os.listdir(self.sections_dirpath):
+        """ Rows of every fic ID CSV in the sections directory, one file after another """
+        for fname in sorted(os.listdir(self.sections_dirpath)):
             fic_ids_path = os.path.join(self.sections_dirpath, fname)
-            fic_ids_data = pd.read_csv(fic_ids_path, index_col=0, header=None)
-            pdb.set_trace() # TODO: verify no 'url:' in fic_id column, or any strings (is it a header?)
-            self.scraped_fic_ids = pd.concat([self.scraped_fic_ids, fic_ids_data])
-
-    def exclude_fic_ids(self):
-        """ Exclude fic_ids that were already scraped """
-        print("Removing fic IDs that were already scraped...")
-
-        # Load fic IDs of data already scraped
-        if self.scraped_fic_ids is None:
-            self.load_scraped_fic_ids()
-        print(f"\tNumber of scraped fic IDs: {len(self.scraped_fic_ids)}")
-        existing_metadata = pd.read_csv(self.exclude_path)
-        new_fic_ids = list(set(self.scraped_fic_ids.index) - set(existing_metadata['fic_id']))
-        self.output_fic_ids = self.scraped_fic_ids.loc[new_fic_ids,:]
-        print(f"\tNumber of new fic IDs: {len(self.output_fic_ids)}")
+            if os.path.isfile(fic_ids_path):
+                yield from id_rows(fic_ids_path)
 
     def load_scraped_fic_ids(self):
-        self.scraped_fic_ids = pd.read_csv(self.scraped_path, index_col=0, header=None)
-
-    def save_fic_ids(self):
-        """ Save out new fic ids """
-        self.output_fic_ids.to_csv(self.outpath, header=False)
+        return id_rows(self.scraped_path)
+
+    def unique(self, rows):
+        """ Drops rows for fic IDs that were already seen, keeping the first """
+        if self.sorter is not None:
+            last = None
+            for row in self.sorter.sorted(rows):
+                self.n_scraped += 1
+                if row_id(row) == last:
+                    self.n_duplicates += 1
+                    continue
+                last = row_id(row)
+                yield row
+            return
+        seen = set()
+        for row in rows:
+            self.n_scraped += 1
+            fic_id = row_id(row)
+            if fic_id in seen:
+                self.n_duplicates += 1
+                continue
+            seen.add(fic_id)
+            yield row
+
+    def exclude_fic_ids(self, rows):
+        """ Exclude fic_ids that were already scraped """
+        if self.sorter is None:
+            existing = set(metadata_ids(self.exclude_path))
+            for row in rows:
+                if row_id(row) in existing:
+                    self.n_excluded += 1
+                else:
+                    yield row
+            return
+        # both sorted by ID, so they can be gone through together
+        existing = (row_id(row) for row in self.sorter.sorted([fic_id] for fic_id in metadata_ids(self.exclude_path)))
+        excluded = next(existing, None)
+        for row in rows:
+            fic_id = row_id(row)
+            while excluded is not None and excluded < fic_id:
+                excluded = next(existing, None)
+            if excluded == fic_id:
+                self.n_excluded += 1
+            else:
+                yield row
+
+    def save_fic_ids(self, rows):
+        """ Save out new fic ids, as they come """
+        with open(self.outpath, 'w', newline='') as f_out:
+            writer = csv.writer(f_out)
+            for row in rows:
+                writer.writerow(row)
+                self.n_output += 1
         print(f"Output fic IDs saved to {self.outpath}")
 
 
@@ -72,19 +203,29 @@ def get_args():
     parser.add_argument('--scraped-path', dest='scraped_path', nargs='?',
             default=None,
             help='If not combining fic IDs, path to the 1 scraped fic CSV')
-    parser.add_argument('--exclude-path', dest='exclude_path', nargs='?', 
+    parser.add_argument('--exclude-path', dest='exclude_path', nargs='?',
             default=None,
-            help='Path to the metadata CSV of stories that are already scraped')
+            help='Path to the metadata CSV (or stories.parquet directory) of stories that are already scraped')
+    parser.add_argument('--external-sort', dest='external_sort', action='store_true',
+            help='For more fic IDs than fit in memory: sort them on disk instead of keeping sets. The output is in order of fic ID')
+    parser.add_argument('--run-size', dest='run_size', type=int,
+            default=200000,
+            help='With --external-sort, how many rows to sort in memory at a time (default 200000)')
+    parser.add_argument('--tmpdir', default=None,
+            help='With --external-sort, where to write the sorted runs (default the system temp directory)')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.outpath or not (args.sections_dirpath or args.scraped_path):
+        parser.error('give an output path and --sections-dirpath or --scraped-path')
+    return args
 
 
 def main():
     args = get_args()
 
-    manipulator = FicIdManipulator(args.outpath, args.sections_dirpath, args.scraped_path, args.exclude_path)
+    manipulator = FicIdManipulator(args.outpath, args.sections_dirpath, args.scraped_path, args.exclude_path,
+            args.external_sort, args.run_size, args.tmpdir)
     manipulator.manipulate()
-    manipulator.save_fic_ids()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,160 @@
+'''
+An asyncio/aiohttp alternative to the blocking requests in ao3_http.fetch,
+used by ao3_get_fanfics.py --async.
+
+A blocking scraper sends one request, waits for the whole page to arrive, parses it
+and only then waits out the rest of the delay before the next request. Here each
+request is started as soon as its host's turn comes round, whether or not earlier
+pages have finished downloading, so slow responses overlap with each other and
+with parsing (which the caller hands to a process pool).
+
+Requests to each host are spaced out by their own RateLimiter (AO3's is the same one
+the blocking scrapers share), and throttling is handled by the same RetryPolicy.
+
+aiohttp is optional: pip install aiohttp to use this.
+'''
+
+import asyncio
+import collections
+import time
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from tqdm import tqdm
+from ao3_errors import ScrapeError, NETWORK_ERROR
+from ao3_metrics import metrics
+from ao3_http import (RateLimiter, RetryPolicy, is_throttled, retry_after_seconds, record_request,
+                      ACCEPT_ENCODING, CONNECT_TIMEOUT, DEFAULT_DELAY, DEFAULT_RATE_FPATH, DEFAULT_TIMEOUT)
+
+AO3_HOST = "archiveofourown.org"
+
+
+class HostScheduler():
+    '''
+    gives out turns to send requests, delay seconds apart for each host.
+    AO3's turns come from the rate file shared with every other scraper,
+    other hosts' from their own file next to it.
+
+    A turn is only taken once a request can be sent straight away, one request
+    per host at a time in the order they asked, so a pause (Retry-After, or the
+    circuit breaker) that comes while requests are waiting holds them all back
+    '''
+
+    def __init__(self, delay=DEFAULT_DELAY, state_fpath=DEFAULT_RATE_FPATH, max_tries=10):
+        self.delay = delay
+        self.state_fpath = state_fpath
+        self.max_tries = max_tries
+        self.hosts = {}
+        self.queues = {} # limiter: lock the requests waiting for a turn queue on
+        self.loop = None # the event loop the locks belong to
+
+    def host(self, url):
+        ''' returns (limiter, retry policy) for the host of url '''
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            state_fpath = self.state_fpath
+            if state_fpath and host != AO3_HOST:
+                state_fpath = "{}.{}".format(state_fpath, host.replace(":", "_"))
+            limiter = RateLimiter(self.delay, state_fpath=state_fpath)
+            self.hosts[host] = (limiter, RetryPolicy(limiter, max_tries=self.max_tries))
+        return self.hosts[host]
+
+    async def wait(self, limiter):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # a lock can only be waited on in one event loop, and each retry round has its own
+            self.loop = loop
+            self.queues = {}
+        queue = self.queues.setdefault(limiter, asyncio.Lock())
+        async with queue:
+            while True:
+                wait = limiter.try_reserve()
+                if wait <= 0:
+                    return
+                metrics.count("sleep_seconds_total", wait)
+                await asyncio.sleep(wait)
+
+
+class AsyncFetcher():
+    '''
+    async with AsyncFetcher(scheduler) as fetcher:
+        status, text = await fetcher.get(url)
+    '''
+
+    def __init__(self, scheduler, headers=None, timeout=DEFAULT_TIMEOUT, max_connections=8):
+        if aiohttp is None:
+            raise ImportError("the async fetcher needs aiohttp: pip install aiohttp")
+        self.scheduler = scheduler
+        self.headers = dict(headers or {})
+        self.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=CONNECT_TIMEOUT)
+        self.max_connections = max_connections
+        self.session = None
+
+    async def __aenter__(self):
+        # connections and DNS lookups are kept between requests
+        connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def get(self, url, headers=None):
+        '''
+        returns (status, text) for url, retrying like ao3_http.fetch while the host
+        is throttling (up to policy.max_throttled times) or the connection fails.
+        Raises ScrapeError once the connection is given up
+        '''
+        limiter, policy = self.scheduler.host(url)
+        attempt = 0
+        n_throttled = 0
+        while True:
+            await self.scheduler.wait(limiter)
+            start = time.time()
+            try:
+                async with self.session.get(url, headers=headers) as resp:
+                    body = await resp.read()
+                    text = body.decode(resp.get_encoding(), errors="replace")
+                    status = resp.status
+                    wait = retry_after_seconds(resp.headers.get("Retry-After"))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                record_request(start, "error")
+                tqdm.write("ERROR, on {} {} {}".format(url, type(e), e))
+                if attempt + 1 >= policy.max_tries:
+                    raise ScrapeError(NETWORK_ERROR, '{}: {}'.format(type(e).__name__, e))
+                policy.failed(attempt)
+            else:
+                record_request(start, status, len(body))
+                if not is_throttled(status, text):
+                    policy.succeeded()
+                    return status, text
+                n_throttled += 1
+                if n_throttled >= policy.max_throttled:
+                    tqdm.write("Giving up on {} after {} tries ({})".format(url, n_throttled, status))
+                    return status, text
+                tqdm.write("Page reads 'retry later' ({}) on {}".format(status, url))
+                policy.failed(attempt, wait)
+            attempt += 1
+
+
+async def map_ordered(fn, items, window):
+    '''
+    yields await fn(item) for each item, in order, with up to window of them running at once
+    '''
+    running = collections.deque()
+    items = iter(items)
+    try:
+        for item in items:
+            running.append(asyncio.ensure_future(fn(item)))
+            if len(running) >= window:
+                yield await running.popleft()
+        while running:
+            yield await running.popleft()
+    finally:
+        for task in running:
+            task.cancel()
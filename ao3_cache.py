@@ -0,0 +1,169 @@
+'''
+On-disk cache of raw AO3 pages, so that a re-run (or a re-parse after a parser fix)
+does not have to re-request every work from the archive.
+
+Pages are stored gzipped under the cache directory, keyed by a hash of the URL
+and sharded two levels deep (raw/ab/cd/abcd....gz) so that a large fandom doesn't
+put millions of files in one folder. The first line of every entry is the URL it
+was fetched from, which lets the cache be walked without any network access.
+
+Pages that came back with an error (a 404 or a 500, say) are kept apart under
+raw/failed/, so that they can be looked at later but are never read back as the work.
+
+Entries are written to a temporary file and renamed into place, so a crash never
+leaves a half-written page behind. If a size cap is given, the least recently used
+entries are evicted once the cap is exceeded.
+'''
+
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+
+HEADER_PREFIX = "AO3CACHE "
+FAILED_DIRNAME = "failed"
+
+
+class CacheMiss(KeyError):
+    ''' Raised when running offline and a page isn't in the cache '''
+    pass
+
+
+def url_key(url):
+    # http:// and https:// point at the same page, so they share an entry
+    return hashlib.sha1(re.sub(r'^https?://', '', url).encode("utf-8")).hexdigest()
+
+def legacy_path(url, cache_dir):
+    ''' path used by earlier versions of ao3_get_fanfics.py (flat, one file per url) '''
+    return os.path.join(cache_dir, re.sub(r'[^a-zA-Z0-9]', '_', url) + ".gz")
+
+def legacy_paths(url, cache_dir):
+    # earlier versions requested work pages over http
+    yield legacy_path(url, cache_dir)
+    if url.startswith("https://"):
+        yield legacy_path("http://" + url[len("https://"):], cache_dir)
+
+def read_entry(path):
+    '''
+    returns (url, text) for a cache file.
+    url is None for entries written in the old flat format, which have no header line.
+    '''
+    with gzip.open(path, "rb") as f:
+        text = f.read().decode("utf-8", "replace")
+    if text.startswith(HEADER_PREFIX):
+        header, _, text = text.partition("\n")
+        return header[len(HEADER_PREFIX):], text
+    return None, text
+
+def entry_url(path):
+    ''' returns the url a cache file was fetched from, without reading the whole page (None for old entries) '''
+    with gzip.open(path, "rb") as f:
+        header = f.readline().decode("utf-8", "replace").rstrip("\n")
+    if header.startswith(HEADER_PREFIX):
+        return header[len(HEADER_PREFIX):]
+    return None
+
+
+class RawCache():
+
+    def __init__(self, cache_dir='raw', max_bytes=0, offline=False):
+        '''
+        cache_dir: directory the cache lives in. An empty string disables the cache.
+        max_bytes: evict least recently used entries above this size (0 for no cap)
+        offline: never go to the network; pages that aren't cached raise CacheMiss
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.total_bytes = None # computed lazily, only needed with a size cap
+
+    def enabled(self):
+        return bool(self.cache_dir)
+
+    def path(self, url):
+        key = url_key(url)
+        return os.path.join(self.cache_dir, key[:2], key[2:4], key + ".gz")
+
+    def get(self, url):
+        ''' returns the cached text for url, or None '''
+        if not self.enabled():
+            return None
+        for path in (self.path(url), *legacy_paths(url, self.cache_dir)):
+            if os.path.isfile(path):
+                try:
+                    _, text = read_entry(path)
+                except (OSError, EOFError):
+                    continue # corrupt entry, treat as a miss
+                if self.max_bytes:
+                    # mtime doubles as the last-used time for LRU eviction
+                    try: os.utime(path)
+                    except OSError: pass
+                return text
+        return None
+
+    def put(self, url, text):
+        if not self.enabled():
+            return
+        path = self.path(url)
+        dirpath = os.path.dirname(path)
+        os.makedirs(dirpath, exist_ok=True)
+        old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+        fd, tmppath = tempfile.mkstemp(dir=dirpath, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw_f:
+                with gzip.GzipFile(fileobj=raw_f, mode="wb") as f:
+                    f.write((HEADER_PREFIX + url + "\n").encode("utf-8"))
+                    f.write(text.encode("utf-8"))
+            os.replace(tmppath, path)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        if self.max_bytes:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.scan())
+            else:
+                self.total_bytes += os.path.getsize(path) - old_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def put_failed(self, url, text):
+        ''' keeps an error page for url, out of the way of the pages get returns '''
+        if not self.enabled():
+            return
+        RawCache(os.path.join(self.cache_dir, FAILED_DIRNAME)).put(url, text)
+
+    def scan(self):
+        ''' yields (mtime, size, path) for every entry '''
+        for path in self.entries():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield (st.st_mtime, st.st_size, path)
+
+    def evict(self):
+        # Go down to 90% of the cap so that we don't rescan on every put
+        entries = sorted(self.scan())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.total_bytes = total
+
+    def entries(self):
+        ''' yields the path of every cached page '''
+        for dirpath, dirnames, fnames in os.walk(self.cache_dir):
+            if dirpath == self.cache_dir and FAILED_DIRNAME in dirnames:
+                dirnames.remove(FAILED_DIRNAME)
+            dirnames.sort()
+            for fname in sorted(fnames):
+                if fname.endswith(".gz"):
+                    yield os.path.join(dirpath, fname)
@@ -0,0 +1,239 @@
+'''
+A catalog of works in SQLite, kept by both scrapers (--catalog), so that what has been
+found, fetched and written can be asked of one indexed table rather than worked out
+from id csvs, stories.csv, errors.csv and completed.csv.
+
+The works table has a row per work:
+    fic_id          AO3 work id
+    fandom          --fandom it was collected or scraped under
+    discovered_url  the listing page ao3_work_ids.py found it on
+    listing_date, listing_chapters, listing_words   the stats shown in its blurb there
+    status          listed (found but not fetched yet), scraped, changed (listed again with
+                    different stats since it was scraped), or a kind of failure (ao3_errors.py)
+    last_fetched    unix time its page was last fetched or parsed
+    content_hash    sha1 of that page
+    location        where its text was written: its csv, or the text store holding it
+
+The database is in WAL mode, so scrapers for several fandoms (and readers) can use it
+at the same time. ao3_get_fanfics.py buffers its updates and commits them each time
+its tables are flushed, so the catalog never runs ahead of what is on disk.
+
+Usage:
+    python ao3_catalog.py catalog.db summary
+    python ao3_catalog.py catalog.db todo --fandom F > ids.csv    # works that need fetching
+    python ao3_catalog.py catalog.db import ids.csv --fandom F    # id csvs from before the catalog
+    python ao3_catalog.py catalog.db import ao3_F_text/completed.csv --fandom F --completed
+'''
+
+import argparse
+import csv
+import sqlite3
+import sys
+
+from ao3_errors import TRANSIENT, NOT_IN_CACHE
+
+LISTED = 'listed'
+SCRAPED = 'scraped'
+CHANGED = 'changed'
+
+# works in these states are fetched by ao3_get_fanfics.py --catalog
+TO_FETCH = (LISTED, CHANGED, NOT_IN_CACHE) + TRANSIENT
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS works (
+    fic_id INTEGER PRIMARY KEY,
+    fandom TEXT,
+    discovered_url TEXT,
+    listing_date TEXT,
+    listing_chapters TEXT,
+    listing_words TEXT,
+    status TEXT NOT NULL,
+    last_fetched REAL,
+    content_hash TEXT,
+    location TEXT
+);
+CREATE INDEX IF NOT EXISTS works_status ON works (status, fandom);
+'''
+
+# a work that was scraped and is listed with different stats has changed since
+LISTED_SQL = '''
+INSERT INTO works (fic_id, fandom, discovered_url, listing_date, listing_chapters, listing_words, status)
+VALUES (?, ?, ?, ?, ?, ?, '{listed}')
+ON CONFLICT (fic_id) DO UPDATE SET
+    fandom = coalesce(works.fandom, excluded.fandom),
+    discovered_url = excluded.discovered_url,
+    status = CASE WHEN works.status = '{scraped}' AND works.listing_date IS NOT NULL
+                   AND (works.listing_date, works.listing_chapters, works.listing_words)
+                    IS NOT (excluded.listing_date, excluded.listing_chapters, excluded.listing_words)
+             THEN '{changed}' ELSE works.status END,
+    listing_date = excluded.listing_date,
+    listing_chapters = excluded.listing_chapters,
+    listing_words = excluded.listing_words
+'''.format(listed=LISTED, scraped=SCRAPED, changed=CHANGED)
+
+RECORD_SQL = '''
+INSERT INTO works (fic_id, fandom, status, last_fetched, content_hash, location)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (fic_id) DO UPDATE SET
+    fandom = coalesce(works.fandom, excluded.fandom),
+    status = excluded.status,
+    last_fetched = coalesce(excluded.last_fetched, works.last_fetched),
+    content_hash = coalesce(excluded.content_hash, works.content_hash),
+    location = coalesce(excluded.location, works.location)
+'''
+
+
+def listing_row(fandom, row):
+    # older id csvs have no url or blurb stats
+    row = list(row) + [None] * (5 - len(row))
+    return [int(row[0]), fandom] + row[1:5]
+
+
+class Catalog():
+
+    def __init__(self, db_fpath):
+        self.db_fpath = db_fpath
+        self.db = sqlite3.connect(db_fpath, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.pending = []
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #
+    # Writing
+    #
+    def listed(self, fandom, rows):
+        '''
+        adds works found on a listing page, given as rows of an ao3_work_ids.py csv:
+        id, url, updated date, chapters, words
+        '''
+        with self.db:
+            self.db.executemany(LISTED_SQL, (listing_row(fandom, row) for row in rows))
+
+    def record(self, fic_id, fandom, status, content_hash=None, location=None, fetched=None):
+        '''
+        notes how scraping a work went, to be written on the next commit.
+        fetched is the time its page was got, if it was
+        '''
+        if not fic_id:
+            return
+        self.pending.append((int(fic_id), fandom, status, fetched, content_hash, location))
+
+    def commit(self):
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany(RECORD_SQL, self.pending)
+        self.pending = []
+
+    #
+    # Reading
+    #
+    def status(self, fic_id):
+        row = self.db.execute("SELECT status FROM works WHERE fic_id = ?", (int(fic_id),)).fetchone()
+        return None if row is None else row[0]
+
+    def __contains__(self, fic_id):
+        return self.status(fic_id) is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM works").fetchone()[0]
+
+    def to_fetch(self, fandom=None, batch_size=1000):
+        '''
+        yields the rows (id, url, updated date, chapters, words, as in ao3_work_ids.py's csvs)
+        of works that still need fetching, in order of id. They are read a batch at a time,
+        so the catalog can be updated while this is being gone through
+        '''
+        where = "status IN ({})".format(",".join("?" * len(TO_FETCH)))
+        params = list(TO_FETCH)
+        if fandom:
+            where += " AND fandom = ?"
+            params.append(fandom)
+        last = -1
+        while True:
+            rows = self.db.execute(
+                "SELECT fic_id, discovered_url, listing_date, listing_chapters, listing_words FROM works "
+                "WHERE fic_id > ? AND " + where + " ORDER BY fic_id LIMIT ?", [last] + params + [batch_size]).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield [str(row[0])] + ['' if value is None else value for value in row[1:]]
+            last = rows[-1][0]
+
+    def summary(self):
+        ''' [(fandom, status, number of works)] '''
+        return self.db.execute("SELECT fandom, status, COUNT(*) FROM works GROUP BY fandom, status ORDER BY fandom, status").fetchall()
+
+
+def import_csv(catalog, fpath, fandom, completed=False):
+    '''
+    adds the works in an id csv written by ao3_work_ids.py, or with completed,
+    marks those in a completed.csv written by ao3_get_fanfics.py as scraped
+    '''
+    n = 0
+    batch = []
+    with open(fpath, 'r') as f_in:
+        for row in csv.reader(f_in):
+            if not row or not row[0].isdigit():
+                continue
+            batch.append(row)
+            n += 1
+            if len(batch) >= 10000:
+                import_rows(catalog, batch, fandom, completed)
+                batch = []
+    import_rows(catalog, batch, fandom, completed)
+    return n
+
+def import_rows(catalog, rows, fandom, completed):
+    if completed:
+        for row in rows:
+            catalog.record(row[0], fandom, SCRAPED)
+        catalog.commit()
+    else:
+        catalog.listed(fandom, rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query or fill in the catalog of works kept by the scrapers')
+    parser.add_argument(
+        'db', metavar='DB',
+        help='the catalog database, as given to --catalog')
+    parser.add_argument(
+        'command', choices=['summary', 'todo', 'import'],
+        help='summary: works by fandom and status, todo: write the works that need fetching as an id csv, import: add works from csvs')
+    parser.add_argument(
+        'csvs', metavar='CSV', nargs='*',
+        help='for import, id csvs from ao3_work_ids.py (or completed.csvs, with --completed)')
+    parser.add_argument(
+        '--fandom', default='',
+        help='fandom to import works under, or to list works to fetch for (default all)')
+    parser.add_argument(
+        '--completed', action='store_true',
+        help='the csvs to import are completed.csvs of works that were scraped')
+    args = parser.parse_args()
+    with Catalog(args.db) as catalog:
+        if args.command == 'summary':
+            for fandom, status, count in catalog.summary():
+                print('{}\t{}\t{}'.format(fandom, status, count))
+        elif args.command == 'todo':
+            writer = csv.writer(sys.stdout)
+            for row in catalog.to_fetch(args.fandom or None):
+                writer.writerow(row)
+        else:
+            for fpath in args.csvs:
+                n = import_csv(catalog, fpath, args.fandom or None, args.completed)
+                print('Imported {} works from {}'.format(n, fpath), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+'''
+Exports the text that ao3_get_fanfics.py scraped to a paragraph corpus that can be
+memory-mapped, for reading single works out of tens of GB without parsing any csvs.
+
+Usage - python ao3_corpus.py ao3_<fandom>_text/ corpus_dir/
+
+reads the text of each work from ao3_<fandom>_text/text/ (--text-format jsonl.zst)
+or, if that isn't there, the csvs in ao3_<fandom>_text/stories/, and writes:
+    text.bin                the utf-8 text of every paragraph, back to back
+    paragraph_offsets.npy   byte offset in text.bin of each paragraph, and of the end
+    chapter_offsets.npy     index of each chapter's first paragraph, and of the end
+    work_offsets.npy        index of each work's first chapter, and of the end
+    work_ids.npy            fic id of each work
+    id_order.npy            work indices sorted by fic id, and
+    sorted_ids.npy          the fic ids in that order, for looking works up
+
+Work i's chapters are work_offsets[i] to work_offsets[i+1], chapter j's paragraphs
+are chapter_offsets[j] to chapter_offsets[j+1], and paragraph k is
+text.bin[paragraph_offsets[k]:paragraph_offsets[k+1]]. ParagraphCorpus reads these:
+
+    corpus = ParagraphCorpus("corpus_dir")
+    chapters = corpus.work(123456)      # [[paragraph, ...], ...]
+    raw = corpus.raw_paragraph(0)       # a memoryview into text.bin, not a copy
+
+numpy is needed for this.
+'''
+
+import argparse
+import array
+import csv
+import mmap
+import os
+import re
+from itertools import groupby
+
+import numpy as np
+from tqdm import tqdm
+
+from ao3_textstore import TextStore
+
+
+#
+# Reading the scraped text
+#
+def store_works(text_dirpath):
+    ''' yields (fic_id, [(chapter_id, para_id, text), ...]) from a packed text store '''
+    for fic_id, rows in TextStore(text_dirpath).works():
+        yield fic_id, [(row["chapter_id"], row["para_id"], row["text"]) for row in rows]
+
+def csv_works(content_dirpath):
+    ''' yields (fic_id, [(chapter_id, para_id, text), ...]) from the csvs of a stories/ directory '''
+    csv.field_size_limit(1000000000)
+    fnames = []
+    for fname in os.listdir(content_dirpath):
+        match = re.fullmatch(r'(\d+)(?:_(\d+))?\.csv', fname)
+        if match:
+            fnames.append((int(match.group(1)), int(match.group(2) or 0), fname))
+    fnames.sort()
+    for fic_id, work_fnames in groupby(fnames, key=lambda f: f[0]):
+        rows = []
+        for _, _, fname in work_fnames:
+            with open(os.path.join(content_dirpath, fname), 'r') as f_in:
+                reader = csv.reader(f_in)
+                next(reader, None) # header
+                for row in reader:
+                    if len(row) == 4:
+                        rows.append((int(row[1]), int(row[2]), row[3]))
+        yield str(fic_id), rows
+
+def scraped_works(text_dirpath):
+    ''' the works in an ao3_<fandom>_text/ directory, wherever their text was written '''
+    if os.path.isfile(os.path.join(text_dirpath, "text", "index.csv")):
+        return store_works(os.path.join(text_dirpath, "text"))
+    return csv_works(os.path.join(text_dirpath, "stories"))
+
+
+#
+# Writing the corpus
+#
+def build(works, out_dirpath):
+    '''
+    writes a corpus of works, given as (fic_id, [(chapter_id, para_id, text), ...])
+    with paragraphs in order, to out_dirpath. returns the number of works
+    '''
+    os.makedirs(out_dirpath, exist_ok=True)
+    # array rather than list, so that millions of offsets take 8 bytes each
+    paragraph_offsets = array.array('q', [0])
+    chapter_offsets = array.array('q', [0])
+    work_offsets = array.array('q', [0])
+    work_ids = array.array('q')
+    with open(os.path.join(out_dirpath, "text.bin"), "wb") as text_f:
+        offset = 0
+        for fic_id, rows in tqdm(works, desc='Building corpus', ncols=70):
+            for _, chapter_rows in groupby(rows, key=lambda row: row[0]):
+                for _, _, text in chapter_rows:
+                    data = text.encode("utf-8")
+                    text_f.write(data)
+                    offset += len(data)
+                    paragraph_offsets.append(offset)
+                chapter_offsets.append(len(paragraph_offsets) - 1)
+            work_offsets.append(len(chapter_offsets) - 1)
+            work_ids.append(int(fic_id))
+    work_ids = np.frombuffer(work_ids, dtype=np.int64)
+    np.save(os.path.join(out_dirpath, "paragraph_offsets.npy"), np.frombuffer(paragraph_offsets, dtype=np.int64))
+    np.save(os.path.join(out_dirpath, "chapter_offsets.npy"), np.frombuffer(chapter_offsets, dtype=np.int64))
+    np.save(os.path.join(out_dirpath, "work_offsets.npy"), np.frombuffer(work_offsets, dtype=np.int64))
+    np.save(os.path.join(out_dirpath, "work_ids.npy"), work_ids)
+    # stable, so that a work exported twice is looked up at its last copy
+    id_order = np.argsort(work_ids, kind='stable')
+    np.save(os.path.join(out_dirpath, "id_order.npy"), id_order)
+    np.save(os.path.join(out_dirpath, "sorted_ids.npy"), work_ids[id_order])
+    return len(work_ids)
+
+
+#
+# Reading the corpus
+#
+class ParagraphCorpus():
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        load = lambda name: np.load(os.path.join(dirpath, name + ".npy"), mmap_mode='r')
+        self.paragraph_offsets = load("paragraph_offsets")
+        self.chapter_offsets = load("chapter_offsets")
+        self.work_offsets = load("work_offsets")
+        self.work_ids = load("work_ids")
+        self.id_order = load("id_order")
+        self.sorted_ids = load("sorted_ids")
+        with open(os.path.join(dirpath, "text.bin"), "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self.text = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            else: # mmap can't map an empty file
+                self.text = memoryview(b"")
+
+    def __len__(self):
+        return len(self.work_ids)
+
+    def __contains__(self, fic_id):
+        return self.work_index(fic_id) is not None
+
+    def work_index(self, fic_id):
+        ''' position of a work in the corpus, or None '''
+        fic_id = int(fic_id)
+        i = np.searchsorted(self.sorted_ids, fic_id, side='right') - 1
+        if i < 0 or self.sorted_ids[i] != fic_id:
+            return None
+        return int(self.id_order[i])
+
+    def raw_paragraph(self, k):
+        ''' paragraph k as a memoryview of utf-8 bytes, without copying it '''
+        return self.text[self.paragraph_offsets[k]:self.paragraph_offsets[k+1]]
+
+    def paragraph(self, k):
+        return str(self.raw_paragraph(k), "utf-8")
+
+    def chapter_paragraphs(self, j):
+        ''' range of the paragraph indices of chapter j '''
+        return range(self.chapter_offsets[j], self.chapter_offsets[j+1])
+
+    def work_chapters(self, i):
+        ''' range of the chapter indices of the work at position i '''
+        return range(self.work_offsets[i], self.work_offsets[i+1])
+
+    def work(self, fic_id):
+        ''' the paragraphs of a work, as a list of chapters of paragraphs, or None '''
+        i = self.work_index(fic_id)
+        if i is None:
+            return None
+        return [[self.paragraph(k) for k in self.chapter_paragraphs(j)] for j in self.work_chapters(i)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export scraped text to a memory-mapped paragraph corpus')
+    parser.add_argument(
+        'textdir', metavar='TEXTDIR',
+        help='the ao3_<fandom>_text directory written by ao3_get_fanfics.py')
+    parser.add_argument(
+        'outdir', metavar='OUTDIR',
+        help='directory to write the corpus to')
+    args = parser.parse_args()
+    n_works = build(scraped_works(args.textdir), args.outdir)
+    print("Wrote {} works to {}".format(n_works, args.outdir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+'''
+The ways scraping a work can fail, as recorded in errors.csv (fic_id, error, detail).
+
+Locked and deleted works, and pages that couldn't be parsed, won't be any different
+if they're requested again, so they count as done. Network and server errors are
+transient: ao3_get_fanfics.py puts those works in a retry queue that it goes through
+again at the end of the run, and leaves them out of completed.csv if they still fail,
+so that --resume tries them again next time.
+'''
+
+LOCKED = 'locked'               # only for logged in users
+DELETED = 'deleted'             # 404, or hidden by its author
+RATE_LIMITED = 'rate limited'
+SERVER_ERROR = 'server error'   # 5xx
+NETWORK_ERROR = 'network error' # the connection failed every time it was tried
+PARSE_ERROR = 'parse error'
+NOT_IN_CACHE = 'not in cache'   # --offline, and the page was never downloaded
+
+TRANSIENT = (RATE_LIMITED, SERVER_ERROR, NETWORK_ERROR)
+
+
+class ScrapeError(Exception):
+    ''' Raised when a work's page can't be got '''
+
+    def __init__(self, kind, detail=''):
+        super().__init__(kind, detail)
+        self.kind = kind
+        self.detail = detail
+
+
+def status_error(status):
+    ''' the kind of failure an HTTP status is, or None for 200 '''
+    if status == 200:
+        return None
+    if status in (404, 410):
+        return DELETED
+    if status in (401, 403):
+        return LOCKED
+    if status == 429:
+        return RATE_LIMITED
+    return SERVER_ERROR
+
+def failure(fic_id, kind, detail=''):
+    ''' what the fetchers and parsers return instead of a parsed work when it failed '''
+    return {"fic_id": fic_id, "failed": kind, "detail": detail}
+
+def error_row(fic_id, kind, detail=''):
+    return [fic_id, kind, detail]
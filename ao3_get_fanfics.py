@@ -20,9 +20,58 @@
 # csv output file. If left blank, it will be called "fanfics.csv"
 # Note that by default, the script appends to existing csvs instead of overwriting them.
 # 
+# --resume skips every work that an earlier run with the same --fandom and --outputdir
+# completed (see completed.csv), wherever it is in the input.
+#
 # --restart is an optional string which when used in combination with a csv input will start
 # the scraping from the given work_id, skipping all previous rows in the csv
 #
+# --cache-dir is the directory where raw pages are cached (default raw/, '' to disable).
+# --cache-max-gb caps the size of the cache, evicting the least recently used pages.
+# --offline only reads pages from the cache and never requests anything from AO3.
+#
+# --pipeline N fetches pages in one thread and parses them in N processes, so that
+# parsing and writing happen while waiting out the delay before the next request.
+#
+# --parser lxml uses the faster lxml/XPath parser in ao3_lxml_parse.py instead of BeautifulSoup.
+# Both produce the same output.
+#
+# --delay is the number of seconds between requests (default 5, as AO3's terms of service ask).
+# It is shared by every scraper running on the machine, through the file given by --rate-file.
+# --base_url requests works from somewhere other than https://archiveofourown.org,
+# such as the local stand-in in benchmarks/ao3_standin.py.
+# --timeout is how long to wait for a page before trying again (default 60 seconds).
+#
+# --async requests pages with asyncio and aiohttp (see ao3_async.py), starting each request
+# as soon as the delay allows rather than after the previous page has arrived, and parses
+# them in --pipeline N processes.
+#
+# --output-format parquet writes stories and chapters as Parquet tables (stories.parquet/ and
+# chapters.parquet/ directories, see ao3_output.py) instead of csvs, with tags as lists and
+# stats as numbers. needs pyarrow
+# --text-format jsonl.zst writes the text of works to a packed store (text/ in the output
+# directory, see ao3_textstore.py) instead of a csv file per work. needs zstandard
+#
+# --metrics-file writes counts of requests, latencies, retries, works/hour and the time spent
+# waiting, fetching, parsing and writing to this file every --metrics-every seconds (default 60),
+# as json, or in the Prometheus text format if it ends in .prom (see ao3_metrics.py).
+#
+# Rows are written out every --flush-every works (default 100) or --flush-secs seconds (default 30),
+# after which the works are recorded in completed.csv (see ao3_output.WorkWriter). --fsync makes
+# sure each flush is on disk before the works are recorded.
+#
+# --profile DIR times each stage of scraping (parsing the page, its stats and tags, splitting
+# paragraphs, writing) and writes them, with cProfile stats, to DIR (default profile/) every
+# --profile-every works (see ao3_profile.py). --profile-memory adds the lines that allocated
+# the most memory, from tracemalloc. Pages are parsed in the main process while profiling.
+#
+# --catalog FILE keeps the status of every work, when it was fetched, a hash of its page
+# and where its text went in an SQLite catalog shared with ao3_work_ids.py (see ao3_catalog.py).
+# Given no ids, the works in the catalog that still need fetching for --fandom are scraped.
+#
+# --reparse DIR re-extracts every work page cached in DIR (e.g. raw/) without any
+# network access, parsing in as many processes as there are cores (or --pipeline N).
+#
 # Author: Jingyi Li soundtracknoon [at] gmail
 # I wrote this in Python 2.7. 9/23/16
 # Updated 2/13/18 (also Python3 compatible)
@@ -36,61 +85,70 @@
 
 import requests
 from bs4 import BeautifulSoup
-import bs4
-import json
-import gzip
 import argparse
 import time
 import os
-import pdb
 import re
 import csv
 import sys
+import queue
+import threading
+import multiprocessing
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from tqdm import tqdm
-#from unidecode import unidecode
+import ao3_lxml_parse
+from ao3_cache import RawCache, CacheMiss, read_entry, entry_url
+from ao3_async import HostScheduler, AsyncFetcher, map_ordered
+from ao3_text import unidecode, text_of, into_chunks, into_text, chapter_paras
+from ao3_output import storycolumns, chaptercolumns, textcolumns, storytypes, chaptertypes, open_table, parquet_path, read_columns, CsvTable, CompletionJournal, WorkWriter, FORMATS
+from ao3_textstore import TextStore
+from ao3_catalog import Catalog, SCRAPED
+from ao3_metrics import metrics
+from ao3_profile import profiler, timed
+from ao3_errors import ScrapeError, status_error, failure, error_row, LOCKED, PARSE_ERROR, RATE_LIMITED, NETWORK_ERROR, NOT_IN_CACHE, TRANSIENT
+from ao3_http import RateLimiter, RetryPolicy, fetch, make_session, throttled, is_throttled, DEFAULT_DELAY, DEFAULT_RATE_FPATH, DEFAULT_TIMEOUT
+
+# raw pages that have already been downloaded, see ao3_cache.py
+raw_cache = RawCache('raw')
+
+# spaces out requests to AO3 across every running scraper, see ao3_http.py
+rate_limiter = RateLimiter()
+retry_policy = RetryPolicy(rate_limiter)
+session = make_session()
+request_timeout = DEFAULT_TIMEOUT
+# where works are requested from, see benchmarks/ao3_standin.py for another
+base_url = 'https://archiveofourown.org'
+
+# for --async, see ao3_async.py
+host_scheduler = HostScheduler()
+
+# for --text-format jsonl.zst, where the text of works goes instead of a csv per work
+text_store = None
+
+# works that failed with a transient error, to try again at the end of the run (see ao3_errors.py)
+retry_queue = []
+retry_rounds = 2
+# whether works failing with a transient error now are given up on rather than tried again
+last_round = True
 
-# We don't want to convert unicode to ascii particularly
-def unidecode(st): return st
+# the WorkWriter that completed works are recorded with, and how often it flushes
+output = None
+flush_every = 100
+flush_secs = 30
+fsync_flushes = False
+
+# the catalog of works that the status of each one is recorded in, see ao3_catalog.py
+catalog = None
 
 def safe(st):
     try: return st.encode("utf-8", "default")
     except: return st
 
-def maybe_json(s):
-    if type(s) is list: return json.dumps(s)
-    if type(s) is dict: return json.dumps(s)
-    else: return s
-
 def consolidate(tags):
-    return " ".join([unidecode(t.text if type(t) is bs4.element.Tag else t).strip() for t in tags])
-
-def into_chunks(tag):
-    previouschild  = []
-    for i, child in enumerate(tag.children):
-        if child.name == "p":
-            if len(previouschild): 
-                yield consolidate(previouschild)
-                previouschild = []
-            for chunk in into_chunks(child):
-                yield chunk
-        elif child.name == "div":
-            if len(previouschild): 
-                yield consolidate(previouschild)
-                previouschild = []
-            for chunk in into_chunks(child): 
-                yield chunk
-        elif child.name == "br":
-            if len(previouschild): 
-                yield consolidate(previouschild)
-                previouschild = []
-        elif type(child) is bs4.element.Tag:
-            previouschild.append(child)
-        else:
-            previouschild.append(child)
-    yield consolidate(previouschild)
-
-def into_text(tag):
-    return "\n".join([ch.strip() for ch in into_chunks(tag) if len(ch.strip()) > 0])
+    return " ".join(text_of(t) for t in tags)
 
 def get_tag_info(category, meta):
     '''
@@ -115,6 +173,7 @@ def get_series(meta):
         seriesid = ""
     return (series, seriespart, seriesid)
     
+@timed("get_stats")
 def get_stats(meta):
     '''
     returns a dictionary of  
@@ -144,6 +203,7 @@ def get_stats(meta):
     #print stats
     return stats      
 
+@timed("get_tags")
 def get_tags(meta):
     '''
     returns a list of lists, of
@@ -160,34 +220,23 @@ def access_denied(soup):
         return True
     return False
 
-def url2cache(url):
-    cache = "raw/" + re.sub(r'[^a-zA-Z0-9]', '_', url) + ".gz"
-    return cache
-
-
 def robust_get(url, headers):
-    delay = 5
-    cache = url2cache(url)
-    if os.path.isfile(cache):
-        return gzip.open(cache).read().decode("utf-8","default")
-    req = None
-    req_count = 10
-    req_err = None
-    while req_count > 0 and req is None:
-        try:
-            time.sleep(delay)
-            req = requests.get(url, headers=headers)
-            #with gzip.open(cache,"wb") as f:
-            #    f.write(req.text.encode("utf-8"))
-        except Exception as e:
-            req = None
-            req_err = e
-            req_count -= 1
-            print("ERROR, on ", url, " sleeping 30")
-            print(type(e), e)
-            time.sleep(30)
-    if req_count == 0 and req is None:
-        raise req_err
+    text = raw_cache.get(url)
+    if text is not None:
+        return text
+    if raw_cache.offline:
+        raise CacheMiss(url)
+    # the delay is counted from the start of the previous request, so
+    # time spent downloading and parsing counts towards it
+    try:
+        req = fetch(url, headers, rate_limiter, retry_policy, session, request_timeout)
+    except requests.exceptions.RequestException as e:
+        raise ScrapeError(NETWORK_ERROR, '{}: {}'.format(type(e).__name__, e))
+    if req.status_code != 200 or throttled(req):
+        raw_cache.put_failed(url, req.text)
+        # a 200 that says 'Retry later' is throttling too
+        raise ScrapeError(status_error(req.status_code) or RATE_LIMITED, 'HTTP {}'.format(req.status_code))
+    raw_cache.put(url, req.text)
     return req.text
 
 def workdir(output_dirpath, fandom): 
@@ -199,12 +248,26 @@ def storiescsv(output_dirpath, fandom):
 def errorscsv(output_dirpath, fandom): 
     return os.path.join(output_dirpath, "ao3_" + fandom + "_text/errors.csv")
 
+def completedcsv(output_dirpath, fandom): 
+    return os.path.join(output_dirpath, "ao3_" + fandom + "_text/completed.csv")
+
 def chapterscsv(output_dirpath, fandom): 
     return os.path.join(output_dirpath, "ao3_" + fandom + "_text/chapters.csv")
 
 def contentdir(output_dirpath, fandom): 
     return os.path.join(output_dirpath, "ao3_" + fandom + "_text/stories/")
 
+def textstoredir(output_dirpath, fandom): 
+    return os.path.join(output_dirpath, "ao3_" + fandom + "_text/text/")
+
+def text_location(output_dirpath, fandom, workid, write_whole_fics=False):
+    ''' where the text of a work is written, for the catalog '''
+    if text_store is not None:
+        return text_store.dirpath
+    if write_whole_fics:
+        return contentfile(output_dirpath, fandom, workid, None)
+    return contentdir(output_dirpath, fandom)
+
 def contentfile(output_dirpath, fandom, workid, chapterid): 
     if chapterid is None:
         contentpath = contentdir(output_dirpath, fandom) + workid + ".csv"
@@ -212,161 +275,400 @@ def contentfile(output_dirpath, fandom, workid, chapterid):
         contentpath = contentdir(output_dirpath, fandom) + workid + "_" + str(chapterid).zfill(4) + ".csv"
     return contentpath
 
-def write_fic_to_csv(fandom, fic_id, only_first_chap, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, header_info='', output_dirpath='', write_whole_fics=False):
-    '''
-    fandom is the grouping that determines filenames etc.
-    fic_id is the AO3 ID of a fic, found every URL /works/[id].
-    writer is a csv writer object
-    the output of this program is a row in the CSV file containing all metadata 
-    and the fic content itself.
-    header_info should be the header info to encourage ethical scraping.
-    write_whole_fics: Whether to write whole fic output (True) or by default (False),
-        will write separate files for chapters
-    '''
-    tqdm.write('Scraping {}'.format(fic_id))
+def work_url(fic_id, only_first_chap):
     get_comments = True
-    url = 'http://archiveofourown.org/works/'+str(fic_id)+'?view_adult=true'
+    url = base_url+'/works/'+str(fic_id)+'?view_adult=true'
     if not only_first_chap:
         url = url + '&view_full_work=true'
     if get_comments:
         url = url + '&show_comments=true'
-    headers = {'user-agent' : header_info}
-    src = robust_get(url, headers)
-    soup = BeautifulSoup(src, 'lxml')
+    return url
+
+def parse_fic(fic_id, src, stream=False):
+    '''
+    parses the source of a work page.
+    returns a dictionary of
+        fic_id
+        denied: True if the work couldn't be accessed (and src, the page itself)
+        errors: error rows for errors.csv
+        story: the row for stories.csv, as a dictionary
+        chapters: a list of (chapter row for chapters.csv, list of paragraphs)
+    This doesn't touch any files, so it can run in a separate process.
+    With stream=True the paragraphs are generators instead of lists, and
+    paragraph_count is left as None for write_parsed_fic to fill in.
+    '''
+    parsed = {"fic_id": fic_id, "denied": False, "errors": [], "story": None, "chapters": []}
+    with profiler.stage("soup"):
+        soup = BeautifulSoup(src, 'lxml')
     if (access_denied(soup)):
-        print('Access Denied')
-        open("err_" + str(fic_id) + ".err.txt", "w").write(src)
-        error_row = [fic_id] + ['Access Denied']
-        errorwriter.writerow(error_row)
-    else:
-        meta = soup.find("dl", class_="work meta group")
-        (series, seriespart, seriesid) = get_series(meta)
-        tags = get_tags(meta)
-        stats = get_stats(meta)
-        title = unidecode(soup.find("h2", class_="title heading").string).strip()
-        author = unidecode(soup.find(class_="byline").text).strip()
-        try:
-            href = soup.find(class_="byline").find("a")["href"]
-            author_key = href.split("/")[2]
-            author_pseudo = href.split("/")[4]
-        except Exception as e:
-            print('Unexpected error getting authorship: ', sys.exc_info()[0])
-            error_row = [fic_id] +  [sys.exc_info()[0]]
-            errorwriter.writerow(error_row)
-            author_key = author
-            author_pseudo= author
-            
-        #get the fic itself
-        content = soup.find("div", id= "chapters")
-        #chapters = content.findAll("div", id=re.compile('^chapter-'))
-        chapnodes = content.findAll("div", id=re.compile('^chapter-'))
-        if len(chapnodes) == 0: chapnodes = soup.findAll("div", id="chapters")
-        chapter_titles = [t.h3.text.strip()  for t in chapnodes]
-        chapters = [ch.find("div", class_="userstuff") for ch in chapnodes]
-        #content.findAll("div", class_="userstuff") #id=re.compile('^chapter-'))
-        #chapters = content.findAll("div", class_="userstuff") #id=re.compile('^chapter-'))
-        #chapter_titles = [unidecode(t.find("h3").text).strip() for t in content.findAll("div", class_="preface")]
-        #if len(chapter_titles) == 0:
-        #    chapter_titles = [title]
-
-
-        st_summary = ""
-        st_preface_notes = ""
-        st_afterword_notes = ""
-        for preface in soup.find_all("div", class_="preface"):
-            if "afterword" in preface.attrs['class']:
-                try:
-                    st_afterword_notes = into_text(preface.find("blockquote"))
-                except: pass
-            elif "chapter" not in preface.attrs['class']:
-                try:
-                    st_preface_notes = into_text(preface.find("div",class_="notes").find("blockquote"))
-                except: pass
-                try:
-                    st_summary = into_text(preface.find("div",class_="summary").find("blockquote"))
-                except: pass
-
-        strow = { "fic_id": fic_id,
-                  "title": title.encode("utf-8"),
-                  "summary": st_summary.encode("utf-8"),
-                  "preface_notes": st_preface_notes.encode("utf-8"),
-                  "afterword_notes": st_afterword_notes.encode("utf-8"),
-                  "series": series,
-                  "seriespart": seriespart,
-                  "seriesid": seriesid,
-                  "author": author_pseudo.encode("utf-8"),
-                  "author_key": author_key.encode("utf-8"),
-                  "additional tags": tags["freeform"],
-                  "chapter_count": len(chapters) }
-        strow = dict(strow, **tags)
-        strow = dict(strow, **stats)
-        #storywriter.writerow([safe(maybe_json(strow.get(k,"null"))) for k in storycolumns])
-        storywriter.writerow([maybe_json(strow.get(k,"null")) for k in storycolumns])
-            
-
-        # get div class=notes under div class=preface, and under div class=afterword; class-level notes
-        # get div class=summary under div class=preface
-        outlines = []
-        for ch, chall in enumerate(chapters):
-            chapter_title = chapter_titles[ch]
-            paras = [t.text if type(t) is bs4.element.Tag else t for t in into_chunks(chall)]
-            #paras = [unidecode(t).strip() for t in paras if len(t.strip()) > 0 and t.strip() != "Chapter Text"]
-            paras = [t.strip() for t in paras if len(t.strip()) > 0 and t.strip() != "Chapter Text"]
-             
-            ch_preface_notes = ""
-            ch_summary = ""
-            ch_afterword_notes = ""
-            chapnode = chapnodes[ch]
+        parsed["denied"] = True
+        parsed["src"] = src
+        return parsed
+
+    meta = soup.find("dl", class_="work meta group")
+    (series, seriespart, seriesid) = get_series(meta)
+    tags = get_tags(meta)
+    stats = get_stats(meta)
+    title = unidecode(soup.find("h2", class_="title heading").string).strip()
+    author = unidecode(soup.find(class_="byline").text).strip()
+    try:
+        href = soup.find(class_="byline").find("a")["href"]
+        author_key = href.split("/")[2]
+        author_pseudo = href.split("/")[4]
+    except Exception as e:
+        print('Unexpected error getting authorship: ', sys.exc_info()[0])
+        parsed["errors"].append(error_row(fic_id, PARSE_ERROR, 'byline: {}'.format(type(e).__name__)))
+        author_key = author
+        author_pseudo= author
+        
+    #get the fic itself
+    content = soup.find("div", id= "chapters")
+    #chapters = content.findAll("div", id=re.compile('^chapter-'))
+    chapnodes = content.findAll("div", id=re.compile('^chapter-'))
+    if len(chapnodes) == 0: chapnodes = soup.findAll("div", id="chapters")
+    chapter_titles = [t.h3.text.strip()  for t in chapnodes]
+    chapters = [ch.find("div", class_="userstuff") for ch in chapnodes]
+    #content.findAll("div", class_="userstuff") #id=re.compile('^chapter-'))
+    #chapters = content.findAll("div", class_="userstuff") #id=re.compile('^chapter-'))
+    #chapter_titles = [unidecode(t.find("h3").text).strip() for t in content.findAll("div", class_="preface")]
+    #if len(chapter_titles) == 0:
+    #    chapter_titles = [title]
+
+
+    st_summary = ""
+    st_preface_notes = ""
+    st_afterword_notes = ""
+    for preface in soup.find_all("div", class_="preface"):
+        if "afterword" in preface.attrs['class']:
             try:
-                ch_summary = into_text(chapnode.find("div", class_="preface").find("div", id="summary").find("blockquote"))
+                st_afterword_notes = into_text(preface.find("blockquote"))
             except: pass
+        elif "chapter" not in preface.attrs['class']:
             try:
-                ch_preface_notes = into_text(chapnode.find("div", class_="preface").find("div", id="notes").find("blockquote"))
+                st_preface_notes = into_text(preface.find("div",class_="notes").find("blockquote"))
             except: pass
             try:
-                ch_afterword_notes = into_text(chapnode.find("div", class_="end").find("blockquote"))
+                st_summary = into_text(preface.find("div",class_="summary").find("blockquote"))
             except: pass
-            # div class=end notes --> id=notes
-            chrow =  {
-                 "fic_id": fic_id,
-                 "title": title,
-                 "summary": ch_summary,
-                 "preface_notes": ch_preface_notes,
-                 "afterword_notes": ch_afterword_notes,
-                 "chapter_num": str(ch+1),
-                 "chapter_title": chapter_title,
-                 "paragraph_count": len(paras)}
-            chapterwriter.writerow([chrow.get(k,"null") for k in chaptercolumns])
-            if not write_whole_fics:
-                content_out = csv.writer(open(contentfile(output_dirpath, fandom, fic_id, ch+1), "w"))
-                content_out.writerow(['fic_id', 'chapter_id','para_id','text'])
-                for pn, para in enumerate(paras):
-                    try:
-                        #content_out.writerow([fic_id, ch+1, pn+1, para.encode("utf-8")])
-                        content_out.writerow([fic_id, ch+1, pn+1, para])
-                    except:
-                        print('Unexpected error: ', sys.exc_info()[0])
-                        pdb.set_trace()
-                        error_row = [fic_id] +  [sys.exc_info()[0]]
-                        errorwriter.writerow(error_row)
-                content_out = None
-            else: # will write out whole fic at once
-                for pn, para in enumerate(paras):
-                    outlines.append([fic_id, ch+1, pn+1, para])
 
+    strow = { "fic_id": fic_id,
+              "title": title,
+              "summary": st_summary,
+              "preface_notes": st_preface_notes,
+              "afterword_notes": st_afterword_notes,
+              "series": series,
+              "seriespart": seriespart,
+              "seriesid": seriesid,
+              "author": author_pseudo,
+              "author_key": author_key,
+              "additional tags": tags["freeform"],
+              "chapter_count": len(chapters) }
+    strow = dict(strow, **tags)
+    strow = dict(strow, **stats)
+    parsed["story"] = strow
+
+    # get div class=notes under div class=preface, and under div class=afterword; class-level notes
+    # get div class=summary under div class=preface
+    for ch, chall in enumerate(chapters):
+        chapter_title = chapter_titles[ch]
+        paras = chapter_paras(chall)
+        if not stream:
+            paras = list(paras)
+         
+        ch_preface_notes = ""
+        ch_summary = ""
+        ch_afterword_notes = ""
+        chapnode = chapnodes[ch]
+        try:
+            ch_summary = into_text(chapnode.find("div", class_="preface").find("div", id="summary").find("blockquote"))
+        except: pass
+        try:
+            ch_preface_notes = into_text(chapnode.find("div", class_="preface").find("div", id="notes").find("blockquote"))
+        except: pass
+        try:
+            ch_afterword_notes = into_text(chapnode.find("div", class_="end").find("blockquote"))
+        except: pass
+        # div class=end notes --> id=notes
+        chrow =  {
+             "fic_id": fic_id,
+             "title": title,
+             "summary": ch_summary,
+             "preface_notes": ch_preface_notes,
+             "afterword_notes": ch_afterword_notes,
+             "chapter_num": str(ch+1),
+             "chapter_title": chapter_title,
+             "paragraph_count": None if stream else len(paras)}
+        parsed["chapters"].append((chrow, paras))
+    return parsed
+
+def parse_page(fic_id, src, parser='bs4', stream=False):
+    '''
+    parses a work page with the chosen parser, 'bs4' or 'lxml'.
+    A page that can't be parsed gives a failure (see ao3_errors.py).
+    The time it took is returned as parse_seconds, since it may be spent in another process,
+    and a hash of the page as content_hash
+    '''
+    start = time.time()
+    content_hash = hashlib.sha1(src.encode('utf-8') if isinstance(src, str) else src).hexdigest()
+    try:
+        if parser == 'lxml':
+            parsed = ao3_lxml_parse.parse_fic(fic_id, src, stream)
+        else:
+            parsed = parse_fic(fic_id, src, stream)
+    except Exception as e:
+        parsed = failure(fic_id, PARSE_ERROR, '{}: {}'.format(type(e).__name__, e))
+    parsed["parse_seconds"] = time.time() - start
+    parsed["content_hash"] = content_hash
+    return parsed
+
+def write_failure(parsed, errorwriter, fandom=None):
+    '''
+    records a work that failed in errors.csv (and the catalog). Transient failures are put
+    in the retry queue, other works are done with (apart from pages missing from the cache)
+    '''
+    fic_id, kind, detail = parsed["fic_id"], parsed["failed"], parsed["detail"]
+    if kind in TRANSIENT and not last_round:
+        # counted as a work once it is done with, in a later round
+        metrics.count("work_retries_total", outcome=kind)
+    else:
+        metrics.count("works_total", outcome=kind)
+    if catalog is not None:
+        catalog.record(fic_id, fandom, kind, parsed.get("content_hash"), fetched=time.time())
+    tqdm.write('Failed: {} ({}{})'.format(fic_id, kind, ', ' + detail if detail else ''))
+    errorwriter.writerow(error_row(fic_id, kind, detail))
+    if kind in TRANSIENT:
+        retry_queue.append(fic_id)
+    if output is None:
+        return
+    if kind in TRANSIENT or kind == NOT_IN_CACHE:
+        # not done with, but a later work's discard mustn't drop the error row
+        output.keep()
+    else:
+        output.done(fic_id)
+
+def write_parsed_fic(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath='', write_whole_fics=False):
+    '''
+    writes the output of parse_fic to the stories, chapters and errors tables
+    and to the content file(s) of the fic.
+    '''
+    metrics.count("parse_seconds_total", parsed.get("parse_seconds", 0))
+    with metrics.timer("write"):
+        write_work(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath, write_whole_fics)
+    metrics.maybe_write()
+    profiler.done()
+
+def write_work(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath='', write_whole_fics=False):
+    fic_id = parsed["fic_id"]
+    if parsed.get("denied"):
+        # the page itself is in the cache
+        parsed = dict(failure(fic_id, LOCKED, 'access denied'), content_hash=parsed.get("content_hash"))
+    if parsed.get("failed"):
+        write_failure(parsed, errorwriter, fandom)
+        return
+    try:
+        write_fic_rows(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath, write_whole_fics)
+    except Exception as e:
+        # with stream=True, parsing carries on while the paragraphs are written
+        if output is not None:
+            output.discard()
+        write_failure(dict(failure(fic_id, PARSE_ERROR, '{}: {}'.format(type(e).__name__, e)), content_hash=parsed.get("content_hash")), errorwriter, fandom)
+        return
+    metrics.count("works_total", outcome="scraped")
+    if catalog is not None:
+        catalog.record(fic_id, fandom, SCRAPED, parsed.get("content_hash"), text_location(output_dirpath, fandom, fic_id, write_whole_fics), time.time())
+    if output is not None:
+        output.done(fic_id)
+
+def write_fic_rows(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath='', write_whole_fics=False):
+    fic_id = parsed["fic_id"]
+    for row in parsed["errors"]:
+        errorwriter.writerow(row)
+    strow = parsed["story"]
+    storywriter.writerow([strow.get(k,"null") for k in storycolumns])
+
+    # paragraphs are written out as they come, so a long fic is never held in memory twice
+    if text_store is not None:
+        write_to_text_store(fic_id, parsed["chapters"], chapterwriter, chaptercolumns)
+        return
+    # with stream=True, parsing can still fail partway through, and then the
+    # content files written so far are removed along with the work's rows
+    content_fpaths = []
+    content_f = None
+    try:
         if write_whole_fics:
-            content_out = csv.writer(open(contentfile(output_dirpath, fandom, fic_id, None), "w"))
-            content_out.writerow(['fic_id', 'chapter_id','para_id','text'])
-            for line in outlines:
-                content_out.writerow(line)
-                
+            content_fpaths.append(contentfile(output_dirpath, fandom, fic_id, None))
+            content_f = open(content_fpaths[-1], "w")
+            content_out = csv.writer(content_f)
+            content_out.writerow(textcolumns)
+        for ch, (chrow, paras) in enumerate(parsed["chapters"]):
+            if not write_whole_fics:
+                content_fpaths.append(contentfile(output_dirpath, fandom, fic_id, ch+1))
+                content_f = open(content_fpaths[-1], "w")
+                content_out = csv.writer(content_f)
+                content_out.writerow(textcolumns)
+            pn = 0
+            for para in paras:
+                content_out.writerow([fic_id, ch+1, pn+1, para])
+                pn += 1
+            if not write_whole_fics:
+                content_f.close()
+            if chrow["paragraph_count"] is None:
+                chrow = dict(chrow, paragraph_count=pn)
+            chapterwriter.writerow([chrow.get(k,"null") for k in chaptercolumns])
+    except BaseException:
+        if content_f is not None:
+            content_f.close()
+        for fpath in content_fpaths:
+            if os.path.exists(fpath):
+                os.remove(fpath)
+        raise
+    if content_f is not None:
+        content_f.close()
+
+def write_to_text_store(fic_id, chapters, chapterwriter, chaptercolumns):
+    paragraph_counts = []
+    def paras():
+        for ch, (chrow, chapter_paras) in enumerate(chapters):
+            pn = 0
+            for para in chapter_paras:
+                pn += 1
+                yield ch+1, pn, para
+            paragraph_counts.append(pn)
+    text_store.add_work(fic_id, paras())
+    for (chrow, _), pn in zip(chapters, paragraph_counts):
+        if chrow["paragraph_count"] is None:
+            chrow = dict(chrow, paragraph_count=pn)
+        chapterwriter.writerow([chrow.get(k,"null") for k in chaptercolumns])
+
+def write_fic_to_csv(fandom, fic_id, only_first_chap, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, header_info='', output_dirpath='', write_whole_fics=False, parser='bs4'):
+    '''
+    fandom is the grouping that determines filenames etc.
+    fic_id is the AO3 ID of a fic, found every URL /works/[id].
+    writer is a csv writer object
+    the output of this program is a row in the CSV file containing all metadata 
+    and the fic content itself.
+    header_info should be the header info to encourage ethical scraping.
+    write_whole_fics: Whether to write whole fic output (True) or by default (False),
+        will write separate files for chapters
+    parser: 'bs4' or 'lxml', see parse_page
+    '''
+    tqdm.write('Scraping {}'.format(fic_id))
+    url = work_url(fic_id, only_first_chap)
+    headers = {'user-agent' : header_info}
+    try:
+        src = robust_get(url, headers)
+    except CacheMiss:
+        parsed = failure(fic_id, NOT_IN_CACHE)
+    except ScrapeError as e:
+        parsed = failure(fic_id, e.kind, e.detail)
+    else:
+        parsed = parse_page(fic_id, src, parser, stream=True)
+    write_parsed_fic(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath, write_whole_fics)
+    if not parsed.get("failed") and not parsed.get("denied"):
         tqdm.write('Done.')
         tqdm.write(' ')
 
+# 
+# Pipeline mode: one thread fetches pages (and is the only thing that waits on
+# the 5 second delay), a pool of processes parses them, and the main process
+# writes every csv row, so parsing and writing overlap with the delay.
+# 
+def fetch_fics(fic_ids, only_first_chap, header_info, fetched):
+    '''
+    fetcher thread: puts (fic_id, page source) on the fetched queue,
+    followed by None when done. src is a failure instead for pages that couldn't be got.
+    '''
+    headers = {'user-agent' : header_info}
+    try:
+        for fic_id in fic_ids:
+            tqdm.write('Scraping {}'.format(fic_id))
+            try:
+                src = robust_get(work_url(fic_id, only_first_chap), headers)
+            except CacheMiss:
+                src = failure(fic_id, NOT_IN_CACHE)
+            except ScrapeError as e:
+                src = failure(fic_id, e.kind, e.detail)
+            fetched.put((fic_id, src))
+    except BaseException as e:
+        fetched.put(e)
+    finally:
+        fetched.put(None)
+
+def parse_fetched(item, parser='bs4'):
+    ''' parser worker '''
+    fic_id, src = item
+    if isinstance(src, dict): # a failure
+        return src
+    return parse_page(fic_id, src, parser)
+
+def fetched_items(fetched):
+    ''' items from the fetcher thread, re-raising its error in this thread '''
+    for item in iter(fetched.get, None):
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+def scrape_pipelined(fandom, fic_ids, n_workers, only_first_chap, storywriter, chapterwriter, errorwriter, header_info='', output_dirpath='', write_whole_fics=False, parser='bs4'):
+    # bounded, so the fetcher doesn't run too far ahead of the parsers
+    fetched = queue.Queue(maxsize=2 * n_workers)
+    fetcher = threading.Thread(target=fetch_fics, args=(fic_ids, only_first_chap, header_info, fetched), daemon=True)
+    # start the workers before the fetcher thread, so they aren't forked while it holds a lock
+    with multiprocessing.Pool(n_workers) as pool:
+        fetcher.start()
+        parse = partial(parse_fetched, parser=parser)
+        # while profiling, pages are parsed here, where the profiler can see them
+        mapped = map(parse, fetched_items(fetched)) if profiler.enabled else pool.imap(parse, fetched_items(fetched))
+        for parsed in mapped:
+            write_parsed_fic(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath, write_whole_fics)
+    fetcher.join()
+
+# 
+# Async mode: pages are requested with asyncio (see ao3_async.py) as soon as the
+# delay allows, even while earlier pages are still downloading, and parsed in a
+# pool of processes; the main process writes the csvs in the order of the ids.
+# 
+async def scrape_async_loop(fandom, fic_ids, n_workers, only_first_chap, storywriter, chapterwriter, errorwriter, header_info='', output_dirpath='', write_whole_fics=False, parser='bs4'):
+    loop = asyncio.get_running_loop()
+    headers = {'user-agent' : header_info}
+    n_workers = n_workers or os.cpu_count()
+    # the workers are started from a clean process, not forked from this one with its threads
+    context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    # pages are compressed and written to the cache one at a time (RawCache keeps a running size) off the loop
+    with ProcessPoolExecutor(n_workers, mp_context=context) as pool, ThreadPoolExecutor(1) as cache_writer:
+        async with AsyncFetcher(host_scheduler, timeout=request_timeout) as fetcher:
+
+            async def fetch_and_parse(fic_id):
+                url = work_url(fic_id, only_first_chap)
+                # reading (and decompressing) the page would hold up the requests on the loop
+                src = await loop.run_in_executor(None, raw_cache.get, url)
+                if src is None and raw_cache.offline:
+                    src = failure(fic_id, NOT_IN_CACHE)
+                elif src is None:
+                    tqdm.write('Scraping {}'.format(fic_id))
+                    try:
+                        status, src = await fetcher.get(url, headers)
+                    except ScrapeError as e:
+                        status, src = None, failure(fic_id, e.kind, e.detail)
+                    if status == 200 and not is_throttled(status, src):
+                        await loop.run_in_executor(cache_writer, raw_cache.put, url, src)
+                    elif status is not None:
+                        await loop.run_in_executor(cache_writer, raw_cache.put_failed, url, src)
+                        src = failure(fic_id, status_error(status) or RATE_LIMITED, 'HTTP {}'.format(status))
+                if profiler.enabled:
+                    return parse_fetched((fic_id, src), parser)
+                return await loop.run_in_executor(pool, partial(parse_fetched, parser=parser), (fic_id, src))
+
+            async for parsed in map_ordered(fetch_and_parse, fic_ids, window=2 * n_workers + 2):
+                write_parsed_fic(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath, write_whole_fics)
+
+def scrape_async(*args, **kwargs):
+    asyncio.run(scrape_async_loop(*args, **kwargs))
+
 def get_args(): 
+    global base_url, flush_every, flush_secs, fsync_flushes, retry_rounds
     parser = argparse.ArgumentParser(description='Scrape and save some fanfic, given their AO3 IDs.')
     parser.add_argument(
-        'ids', metavar='IDS', nargs='+',
+        'ids', metavar='IDS', nargs='*',
         help='a single id, a space seperated list of ids, or a csv input filename')
     parser.add_argument(
         '--fandom', default='some_fandom',
@@ -377,15 +679,94 @@ def get_args():
     parser.add_argument(
         '--restart', default='', 
         help='work_id to start at from within a csv')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='skip works that were already scraped into this --outputdir')
     parser.add_argument(
         '--firstchap', default='', 
         help='only retrieve first chapter of multichapter fics')
     parser.add_argument(
         '--outputdir', default='',
         help='Path to the output directory. Will create output/ao3_<fandom>_text directory within that directory.')
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', default='raw',
+        help='directory to cache raw pages in, an empty string disables the cache')
+    parser.add_argument(
+        '--cache-max-gb', dest='cache_max_gb', type=float, default=0,
+        help='maximum size of the page cache in GB, least recently used pages are evicted (default no limit)')
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='only use cached pages, never request anything from AO3')
+    parser.add_argument(
+        '--base_url', default=base_url,
+        help='where to request works from instead of AO3, e.g. a local stand-in (benchmarks/ao3_standin.py)')
+    parser.add_argument(
+        '--delay', type=float, default=DEFAULT_DELAY,
+        help='seconds between requests to AO3, across all scrapers sharing --rate-file (default 5)')
+    parser.add_argument(
+        '--rate-file', dest='rate_file', default=DEFAULT_RATE_FPATH,
+        help='file that scrapers running at the same time share their request rate through')
+    parser.add_argument(
+        '--timeout', type=float, default=DEFAULT_TIMEOUT,
+        help='seconds to wait for a page before retrying it (default 60)')
+    parser.add_argument(
+        '--pipeline', type=int, default=0,
+        help='number of parser processes to run alongside the fetcher (default 0, fetch and parse one fic at a time)')
+    parser.add_argument(
+        '--async', dest='use_async', action='store_true',
+        help='request pages with asyncio, overlapping downloads, and parse them in --pipeline N processes (default one per core). needs aiohttp')
+    parser.add_argument(
+        '--parser', default='bs4', choices=['bs4', 'lxml'],
+        help='page parser to use, lxml is faster (default bs4)')
+    parser.add_argument(
+        '--output-format', dest='output_format', default='csv', choices=FORMATS,
+        help='write stories and chapters as csvs, or as Parquet tables (needs pyarrow) (default csv)')
+    parser.add_argument(
+        '--text-format', dest='text_format', default='csv', choices=['csv', 'jsonl.zst'],
+        help='write the text of each work to its own csv, or all of it to a packed store (needs zstandard) (default csv)')
+    parser.add_argument(
+        '--retry-rounds', dest='retry_rounds', type=int, default=retry_rounds,
+        help='times to go back over works that failed with network or server errors, at the end of the run (default 2)')
+    parser.add_argument(
+        '--metrics-file', dest='metrics_file', default='',
+        help='file to write crawl metrics to, as json or, if it ends in .prom, in the Prometheus text format')
+    parser.add_argument(
+        '--metrics-every', dest='metrics_every', type=float, default=60,
+        help='seconds between writing metrics (default 60)')
+    parser.add_argument(
+        '--flush-every', dest='flush_every', type=int, default=flush_every,
+        help='number of works to write out at a time (default 100)')
+    parser.add_argument(
+        '--flush-secs', dest='flush_secs', type=float, default=flush_secs,
+        help='most seconds to keep finished works before writing them out (default 30)')
+    parser.add_argument(
+        '--fsync', action='store_true',
+        help='make sure each batch of works is on disk before recording them as completed')
+    parser.add_argument(
+        '--profile', nargs='?', const='profile', default='',
+        help='time each stage and write cProfile stats to this directory (default profile/), parsing in the main process')
+    parser.add_argument(
+        '--profile-every', dest='profile_every', type=int, default=1000,
+        help='number of works between profile dumps (default 1000)')
+    parser.add_argument(
+        '--profile-memory', dest='profile_memory', action='store_true',
+        help='also record the lines that allocate the most memory in each profile dump (slow)')
+    parser.add_argument(
+        '--reparse', default='',
+        help='re-parse every work page in this cache directory (e.g. raw/) instead of scraping')
+    parser.add_argument(
+        '--update', action='store_true',
+        help='skip works in the id csv whose listing stats match the ones already in stories.csv')
+    parser.add_argument(
+        '--catalog', default='',
+        help='SQLite catalog to record each work in (see ao3_catalog.py). Without ids, scrape the works in it that need fetching')
     args = parser.parse_args()
+    if not args.ids and not args.reparse and not args.catalog:
+        parser.error('give fic ids or a csv of them (or --reparse a cache directory, or a --catalog)')
     fic_ids = args.ids
     idlist_is_csv = (len(fic_ids) == 1 and '.csv' in fic_ids[0]) 
+    if args.update and not idlist_is_csv:
+        parser.error('--update needs a csv of ids written by ao3_work_ids.py')
     fandom = str(args.fandom)
     headers = str(args.header)
     if headers == "":
@@ -399,7 +780,37 @@ def get_args():
     else:
         ofc = False
     output_dirpath = args.outputdir
-    return fic_ids, fandom, headers, restart, idlist_is_csv, ofc, output_dirpath
+    global catalog
+    if args.catalog:
+        catalog = Catalog(args.catalog)
+    global raw_cache
+    raw_cache = RawCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1e9), offline=args.offline)
+    if args.offline and not raw_cache.enabled():
+        parser.error('--offline needs a --cache-dir')
+    global rate_limiter, retry_policy
+    rate_limiter = RateLimiter(args.delay, state_fpath=args.rate_file)
+    retry_policy = RetryPolicy(rate_limiter)
+    global request_timeout
+    request_timeout = args.timeout
+    base_url = args.base_url.rstrip('/')
+    global host_scheduler
+    host_scheduler = HostScheduler(args.delay, args.rate_file)
+    use_async = args.use_async
+    n_workers = args.pipeline
+    reparse_dirpath = args.reparse
+    page_parser = args.parser
+    update = args.update
+    retry_rounds = args.retry_rounds
+    metrics.configure(args.metrics_file, args.metrics_every)
+    if args.profile:
+        profiler.start(args.profile, args.profile_every, args.profile_memory)
+    flush_every = args.flush_every
+    flush_secs = args.flush_secs
+    fsync_flushes = args.fsync
+    resume = args.resume
+    output_format = args.output_format
+    text_format = args.text_format
+    return fic_ids, fandom, headers, restart, idlist_is_csv, ofc, output_dirpath, n_workers, reparse_dirpath, page_parser, update, use_async, output_format, text_format, resume
 
 '''
 
@@ -412,61 +823,222 @@ def process_id(fic_id, restart, found):
     else:
         return False
 
+# 
+# Re-parse mode: rebuild the csvs and content files from the page cache alone
+# 
+def cached_works(cache_dir):
+    '''
+    returns a list of (fic_id, path) for the work pages in a cache directory,
+    one per work, preferring full work pages over first chapter ones
+    '''
+    found = {}
+    for path in tqdm(RawCache(cache_dir).entries(), desc='Finding cached works', ncols=70):
+        url = entry_url(path)
+        if url is None: # old entries are named after their url
+            url = os.path.basename(path)
+        match = re.search(r'works[/_](\d+)', url)
+        if not match:
+            continue
+        fic_id = match.group(1)
+        if fic_id not in found or 'view_full_work' in url:
+            found[fic_id] = path
+    return sorted(found.items(), key=lambda item: int(item[0]))
+
+def reparse_entry(item, parser='bs4'):
+    ''' parser worker for re-parse mode '''
+    fic_id, path = item
+    _, src = read_entry(path)
+    return parse_page(fic_id, src, parser)
+
+def reparse_cache(fandom, cache_dir, n_workers, storywriter, chapterwriter, errorwriter, output_dirpath='', write_whole_fics=False, parser='bs4'):
+    works = cached_works(cache_dir)
+    print("Re-parsing {} cached works".format(len(works)))
+    parse = partial(reparse_entry, parser=parser)
+    with multiprocessing.Pool(n_workers or None) as pool:
+        # while profiling, pages are parsed here, where the profiler can see them
+        mapped = map(parse, works) if profiler.enabled else pool.imap_unordered(parse, works, chunksize=8)
+        for parsed in tqdm(mapped, total=len(works), ncols=70):
+            write_parsed_fic(fandom, parsed, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, output_dirpath, write_whole_fics)
+
+# 
+# Update mode: only fetch works that changed since they were last scraped
+# 
+def stories_index(stories_fname):
+    '''
+    returns {fic_id: (status date, chapter_count, words)} from an existing stories.csv,
+    or the stories.parquet table next to it if there is one.
+    a work that was scraped more than once is indexed by its last row
+    '''
+    index = {}
+    columns = ['fic_id', 'published', 'status date', 'chapter_count', 'words']
+    if os.path.isdir(parquet_path(stories_fname)):
+        for fic_id, published, status_date, chapter_count, words in read_columns(parquet_path(stories_fname), columns):
+            if status_date is None:
+                status_date = published
+            index[str(fic_id)] = (str(status_date or ''), str(chapter_count), str(words or ''))
+        return index
+    if not os.path.isfile(stories_fname):
+        return index
+    csv.field_size_limit(1000000000)
+    with open(stories_fname, 'r') as f_in:
+        reader = csv.reader(f_in)
+        header = next(reader, None)
+        if header is None:
+            return index
+        cols = [header.index(c) for c in columns]
+        for row in reader:
+            if len(row) < len(header):
+                continue
+            fic_id, published, status_date, chapter_count, words = [row[i] for i in cols]
+            if status_date == "null":
+                status_date = published
+            index[fic_id] = (status_date.strip(), chapter_count, words)
+    return index
+
+def digits(s):
+    return re.sub(r'\D', '', s)
+
+def unchanged(row, index):
+    '''
+    whether the listing stats saved with an id by ao3_work_ids.py
+    (row is id, url, updated date, chapters, words) match what was scraped
+    '''
+    if len(row) < 5 or row[0] not in index:
+        return False
+    date, chapters, words = row[2:5]
+    status_date, chapter_count, scraped_words = index[row[0]]
+    return (date != "" and date == status_date
+            and chapters.split('/')[0].strip() == chapter_count
+            and digits(words) == digits(scraped_words))
+
+# 
+# Resume mode: skip the works an earlier run already completed
+# 
+def completed_ids(output_dirpath, fandom):
+    '''
+    returns the set of fic ids completed in this output directory: those in completed.csv,
+    or for output written before there was one, those in stories.csv and errors.csv
+    (apart from pages that were missing from the cache)
+    '''
+    completed = set()
+    journal_fpath = completedcsv(output_dirpath, fandom)
+    if os.path.isfile(journal_fpath) and os.path.getsize(journal_fpath) > 0:
+        for row in CompletionJournal(journal_fpath).rows():
+            if row[0]:
+                completed.add(row[0])
+        return completed
+    stories_fname = storiescsv(output_dirpath, fandom)
+    csv.field_size_limit(1000000000)
+    if os.path.isdir(parquet_path(stories_fname)):
+        completed.update(str(fic_id) for fic_id, in read_columns(parquet_path(stories_fname), ['fic_id']))
+    elif os.path.isfile(stories_fname):
+        with open(stories_fname, 'r') as f_in:
+            reader = csv.reader(f_in)
+            next(reader, None)
+            completed.update(row[0] for row in reader if row)
+    if os.path.isfile(errorscsv(output_dirpath, fandom)):
+        with open(errorscsv(output_dirpath, fandom), 'r') as f_in:
+            completed.update(row[0] for row in csv.reader(f_in)
+                             if len(row) > 1 and row[1] not in ('Not in cache', NOT_IN_CACHE) + TRANSIENT)
+    return completed
+
+def csv_rows(csv_fname):
+    ''' yields the rows of a csv, reading it once, with a progress bar of how much has been read '''
+    with open(csv_fname, 'rb') as f_in, tqdm(total=os.path.getsize(csv_fname), unit='B', unit_scale=True, ncols=70) as progress:
+        def lines():
+            for line in f_in:
+                progress.update(len(line))
+                yield line.decode('utf-8')
+        for row in csv.reader(lines()):
+            if row:
+                yield row
+
+def ids_to_scrape(fic_ids, idlist_is_csv, restart, index=None, completed=None):
+    '''
+    yields the fic ids to scrape, skipping those before restart,
+    with an index from stories_index, those that haven't changed,
+    and those in completed, a set from completed_ids
+    '''
+    if not idlist_is_csv:
+        for fic_id in fic_ids:
+            if completed is None or fic_id not in completed:
+                yield fic_id
+        return
+
+    # Scrape fics
+    n_before_restart = 0
+    n_unchanged = 0
+    n_completed = 0
+    found_restart = (restart == '')
+    for row in csv_rows(fic_ids[0]):
+        found_restart = process_id(row[0], restart, found_restart)
+        if not found_restart:
+            n_before_restart += 1
+        elif completed is not None and row[0] in completed:
+            n_completed += 1
+        elif index is not None and unchanged(row, index):
+            n_unchanged += 1
+        else:
+            yield row[0]
+    if n_before_restart:
+        tqdm.write('Skipped {} works before {}'.format(n_before_restart, restart))
+    if completed is not None:
+        tqdm.write('Skipped {} works that were already scraped'.format(n_completed))
+    if index is not None:
+        tqdm.write('Skipped {} works that are unchanged since they were last scraped'.format(n_unchanged))
+
 def main():
-    fic_ids, fandom, headers, restart, idlist_is_csv, only_first_chap, output_dirpath = get_args()
+    fic_ids, fandom, headers, restart, idlist_is_csv, only_first_chap, output_dirpath, n_workers, reparse_dirpath, page_parser, update, use_async, output_format, text_format, resume = get_args()
     os.chdir(os.getcwd())
-    storycolumns = ['fic_id', 'title', 'author', 'author_key', 'rating', 'category', 'fandom', 'relationship', 'character', 'additional tags', 'language', 'published', 'status', 'status date', 'words', 'comments', 'kudos', 'bookmarks', 'hits', 'chapter_count', 'series','seriespart','seriesid', 'summary', 'preface_notes','afterword_notes']
-    chaptercolumns = ['fic_id', 'title', 'summary', 'preface_notes', 'afterword_notes', 'chapter_num', 'chapter_title', 'paragraph_count']
-    textcolumns = ['fic_id', 'chapter_id','para_id','text']
     if not os.path.exists(workdir(output_dirpath, fandom)):
         os.mkdir(workdir(output_dirpath, fandom))
-    if not os.path.exists(contentdir(output_dirpath, fandom)):
+    global text_store
+    if text_format == 'jsonl.zst':
+        text_store = TextStore(textstoredir(output_dirpath, fandom)).open()
+    elif not os.path.exists(contentdir(output_dirpath, fandom)):
         os.mkdir(contentdir(output_dirpath, fandom))
-    with open(storiescsv(output_dirpath, fandom), 'a') as f_out:
-      storywriter = csv.writer(f_out)
-      with open(chapterscsv(output_dirpath, fandom), 'a') as ch_out:
-        chapterwriter = csv.writer(ch_out)
-        with open(errorscsv(output_dirpath, fandom), 'a') as e_out:
-            errorwriter = csv.writer(e_out)
-            #does the csv already exist? if not, let's write a header row.
-            if os.stat(storiescsv(output_dirpath, fandom)).st_size == 0:
-                print('Writing a header row for the csv.')
-                storywriter.writerow(storycolumns)
-            if os.stat(chapterscsv(output_dirpath, fandom)).st_size == 0:
-                print('Writing a header row for the csv.')
-                chapterwriter.writerow(chaptercolumns)
-            if idlist_is_csv:
-                csv_fname = fic_ids[0]
-                total_lines = 0
-
-                # Count fics remaining
-                with open(csv_fname, 'r') as f_in:
-                    reader = csv.reader(f_in)
-                    for row in reader:
-                        if not row:
-                            continue
-                        total_lines += 1
-
-                # Scrape fics
-                with open(csv_fname, 'r+') as f_in:
-                    reader = csv.reader(f_in)
-                    if restart is '':
-                        for row in tqdm(reader, total=total_lines, ncols=70):
-                            if not row:
-                                continue
-                            write_fic_to_csv(fandom, row[0], only_first_chap, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, headers, output_dirpath, write_whole_fics=True)
-                    else: 
-                        found_restart = False
-                        for row in tqdm(reader, total=total_lines, ncols=70):
-                            if not row:
-                                continue
-                            found_restart = process_id(row[0], restart, found_restart)
-                            if found_restart:
-                                write_fic_to_csv(fandom, row[0], only_first_chap, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, headers, output_dirpath=output_dirpath, write_whole_fics=True)
-                            else:
-                                print('Skipping already processed fic')
+    try:
+        scrape(fic_ids, fandom, headers, restart, idlist_is_csv, only_first_chap, output_dirpath, n_workers, reparse_dirpath, page_parser, update, use_async, output_format, resume)
+    finally:
+        if text_store is not None:
+            text_store.close()
+        if catalog is not None:
+            catalog.close()
+        metrics.write()
+        profiler.stop()
 
+def scrape(fic_ids, fandom, headers, restart, idlist_is_csv, only_first_chap, output_dirpath, n_workers, reparse_dirpath, page_parser, update, use_async, output_format, resume):
+    global output, last_round
+    storywriter = open_table(storiescsv(output_dirpath, fandom), storycolumns, output_format, storytypes)
+    chapterwriter = open_table(chapterscsv(output_dirpath, fandom), chaptercolumns, output_format, chaptertypes)
+    errorwriter = CsvTable(errorscsv(output_dirpath, fandom))
+    journal = CompletionJournal(completedcsv(output_dirpath, fandom))
+    with WorkWriter(storywriter, chapterwriter, errorwriter, journal, flush_every, flush_secs, fsync_flushes, text_store, catalog) as output:
+        if reparse_dirpath:
+            reparse_cache(fandom, reparse_dirpath, n_workers, storywriter, chapterwriter, errorwriter, output_dirpath, write_whole_fics=True, parser=page_parser)
+            return
+        index = stories_index(storiescsv(output_dirpath, fandom)) if update else None
+        completed = completed_ids(output_dirpath, fandom) if resume else None
+        if not fic_ids and catalog is not None:
+            fic_ids = (row[0] for row in catalog.to_fetch(fandom))
+        to_scrape = ids_to_scrape(fic_ids, idlist_is_csv, restart, index, completed)
+        for retry_round in range(retry_rounds + 1):
+            last_round = retry_round == retry_rounds
+            if retry_round > 0:
+                if not retry_queue:
+                    break
+                tqdm.write('Trying {} works again that failed with network or server errors'.format(len(retry_queue)))
+                to_scrape = retry_queue[:]
+                del retry_queue[:]
+            if use_async:
+                scrape_async(fandom, to_scrape, n_workers, only_first_chap, storywriter, chapterwriter, errorwriter, headers, output_dirpath, write_whole_fics=True, parser=page_parser)
+            elif n_workers > 0:
+                scrape_pipelined(fandom, to_scrape, n_workers, only_first_chap, storywriter, chapterwriter, errorwriter, headers, output_dirpath, write_whole_fics=True, parser=page_parser)
             else:
-                for fic_id in fic_ids:
-                    write_fic_to_csv(fandom, fic_id, only_first_chap, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, headers, output_dirpath=output_dirpath, write_whole_fics=True)
-main()
+                for fic_id in to_scrape:
+                    write_fic_to_csv(fandom, fic_id, only_first_chap, storywriter, chapterwriter, errorwriter, storycolumns, chaptercolumns, headers, output_dirpath=output_dirpath, write_whole_fics=True, parser=page_parser)
+        if retry_queue:
+            tqdm.write('{} works still failed, run again with --resume to try them again'.format(len(retry_queue)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+'''
+Requests to AO3, shared by ao3_work_ids.py and ao3_get_fanfics.py.
+
+Every request waits its turn with a RateLimiter. The limiter keeps its state in a
+small file that every scraper process on the machine locks before taking a turn,
+so several scrapers running at once (e.g. scrape_ao3_work_ids.py, which runs
+ao3_work_ids.py for ten fandoms in parallel) share one request budget rather
+than each waiting its own 5 seconds.
+
+fetch sends a request with the RetryPolicy: when AO3 is throttling (HTTP 429 or
+503, or a page that reads 'Retry later'), it waits as long as Retry-After asks, or
+backs off exponentially, and tries again. After several failures in a row the
+circuit breaker pauses every scraper sharing the rate limit, not just this one.
+
+Requests go through a requests.Session from make_session, which keeps connections
+to AO3 open between requests (so each one doesn't start with a new TCP and TLS
+handshake), asks for compressed pages and gives up on a stalled connection
+after a timeout.
+
+Request latencies, retries and time spent waiting are recorded in ao3_metrics.metrics.
+'''
+
+import email.utils
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+import re
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from ao3_metrics import metrics
+
+# urllib3 decodes brotli responses when one of these is installed
+try:
+    import brotli
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+try:
+    import fcntl
+except ImportError: # Windows: processes can't share the limiter, threads still do
+    fcntl = None
+
+# AO3's terms of service ask for at most one request every 5 seconds
+DEFAULT_DELAY = 5
+DEFAULT_RATE_FPATH = os.path.join(tempfile.gettempdir(), "ao3scraper_rate")
+
+# seconds to wait for a connection, and then for the page
+CONNECT_TIMEOUT = 10
+DEFAULT_TIMEOUT = 60
+
+# responses that mean AO3 wants us to slow down (or is briefly unavailable)
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class RateLimiter():
+    '''
+    A token bucket shared through a file. The file holds a single timestamp,
+    the time at which the bucket will next be full (the "theoretical arrival time"
+    of the next request), which is all a token bucket needs to store.
+    Every request moves it on by delay seconds; a request may be sent once it is
+    no more than (burst - 1) * delay seconds in the future.
+    '''
+
+    def __init__(self, delay=DEFAULT_DELAY, burst=1, state_fpath=DEFAULT_RATE_FPATH):
+        '''
+        delay: seconds between requests, across every process using state_fpath
+        burst: number of requests that can be sent back to back after a quiet spell
+        state_fpath: the file the limiter's state is kept in. An empty string keeps
+            it in this process only.
+        '''
+        self.delay = delay
+        self.burst = burst
+        self.state_fpath = state_fpath if fcntl else ''
+        self.lock = threading.Lock()
+        self.next_time = 0 # used without a state file
+
+    def update(self, advance):
+        ''' replaces the shared timestamp with advance(timestamp), returning advance's other result '''
+        with self.lock:
+            if not self.state_fpath:
+                self.next_time, result = advance(self.next_time)
+                return result
+            fd = os.open(self.state_fpath, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                state = os.pread(fd, 8, 0)
+                next_time = struct.unpack("d", state)[0] if len(state) == 8 else 0
+                next_time, result = advance(next_time)
+                os.pwrite(fd, struct.pack("d", next_time), 0)
+            finally:
+                os.close(fd) # also releases the lock
+            return result
+
+    def reserve(self):
+        ''' takes the next turn, returning how many seconds to wait for it '''
+        return self.update(self.advance)
+
+    def try_reserve(self):
+        ''' takes the next turn if it has come, returning 0, or else the seconds until it comes '''
+        def advance(next_time):
+            new_time, wait = self.advance(next_time)
+            return (new_time, 0) if wait <= 0 else (next_time, wait)
+        return self.update(advance)
+
+    def pause(self, seconds):
+        ''' holds back every request for the next few seconds, in all processes '''
+        def advance(next_time):
+            return max(next_time, time.time() + seconds + (self.burst - 1) * self.delay), None
+        self.update(advance)
+
+    def advance(self, next_time):
+        now = time.time()
+        send_at = max(now, next_time - (self.burst - 1) * self.delay)
+        return max(now, next_time) + self.delay, send_at - now
+
+    def wait(self):
+        ''' blocks until this process may send a request '''
+        wait = self.reserve()
+        if wait > 0:
+            metrics.count("sleep_seconds_total", wait)
+            time.sleep(wait)
+
+
+def make_session(pool_size=4):
+    '''
+    a session that keeps up to pool_size connections to each host alive.
+    It doesn't retry by itself, retries are up to fetch
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return session
+
+def https_url(url):
+    ''' AO3 redirects http to https, so skip the redirect '''
+    return re.sub(r"^http://(www\.)?archiveofourown\.org", "https://archiveofourown.org", url)
+
+
+class RetryPolicy():
+    '''
+    How long to wait before retrying a request. Without a Retry-After header,
+    the wait doubles with each attempt (with some jitter, so that scrapers don't
+    retry in lockstep) up to max_delay. After breaker_after failures in a row the
+    circuit breaker opens and the whole crawl is paused for at least breaker_pause
+    seconds; the next successful request closes it again.
+    '''
+
+    def __init__(self, limiter, max_tries=10, base_delay=15, max_delay=600, breaker_after=5, breaker_pause=600, max_throttled=20):
+        '''
+        limiter: the RateLimiter that waits are taken through, so they hold back every process sharing it
+        max_tries: attempts before a request that fails with a network error is given up
+        max_throttled: attempts before a request that keeps being throttled (e.g. a very large
+            work that always gets a 502) is given up, and the last response returned
+        '''
+        self.limiter = limiter
+        self.max_tries = max_tries
+        self.max_throttled = max_throttled
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_after = breaker_after
+        self.breaker_pause = breaker_pause
+        self.failures = 0 # in a row, across requests
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def failed(self, attempt, retry_after=None):
+        self.failures += 1
+        metrics.count("retries_total")
+        wait = retry_after if retry_after is not None else self.backoff(attempt)
+        if self.failures >= self.breaker_after:
+            wait = max(wait, self.breaker_pause)
+            tqdm.write("{} failed requests in a row, pausing all scraping for {:.0f} seconds".format(self.failures, wait))
+        else:
+            tqdm.write("Retrying in {:.0f} seconds".format(wait))
+        self.limiter.pause(wait)
+
+    def succeeded(self):
+        self.failures = 0
+
+
+def throttled(req):
+    return is_throttled(req.status_code, req.text)
+
+def is_throttled(status, text):
+    return status in RETRY_STATUSES or text == 'Retry later\n'
+
+def retry_after(req):
+    return retry_after_seconds(req.headers.get("Retry-After"))
+
+def retry_after_seconds(value):
+    ''' the wait asked for by a Retry-After header (in seconds or as a date), or None '''
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def record_request(start, status, n_bytes=0):
+    elapsed = time.time() - start
+    metrics.count("requests_total", status=status)
+    metrics.count("fetch_seconds_total", elapsed)
+    metrics.count("response_bytes_total", n_bytes)
+    metrics.observe("request_seconds", elapsed)
+
+def fetch(url, headers, limiter, policy, session=None, timeout=DEFAULT_TIMEOUT):
+    '''
+    requests url once limiter allows, retrying as policy says while AO3 is throttling
+    or the connection fails (including timing out after timeout seconds).
+    Returns the response, which may be an error page such as a 404, or still
+    a throttled one once policy.max_throttled attempts have been throttled.
+    Raises the last error once a failing connection is given up
+    '''
+    get = session.get if session is not None else requests.get
+    attempt = 0
+    n_throttled = 0
+    while True:
+        limiter.wait()
+        start = time.time()
+        try:
+            req = get(url, headers=headers, timeout=(CONNECT_TIMEOUT, timeout))
+        except requests.exceptions.RequestException as e:
+            record_request(start, "error")
+            tqdm.write("ERROR, on {} {} {}".format(url, type(e), e))
+            if attempt + 1 >= policy.max_tries:
+                raise
+            policy.failed(attempt)
+        else:
+            record_request(start, req.status_code, len(req.content))
+            if not throttled(req):
+                policy.succeeded()
+                return req
+            n_throttled += 1
+            if n_throttled >= policy.max_throttled:
+                tqdm.write("Giving up on {} after {} tries ({})".format(url, n_throttled, req.status_code))
+                return req
+            tqdm.write("Page reads 'retry later' ({}) on {}".format(req.status_code, url))
+            policy.failed(attempt, retry_after(req))
+        attempt += 1
@@ -0,0 +1,286 @@
+'''
+A faster way of parsing AO3 work pages, for when parsing rather than the request
+delay is what limits throughput (e.g. ao3_get_fanfics.py --reparse).
+
+This builds an lxml tree directly instead of a BeautifulSoup tree, and looks things up
+with precompiled XPath expressions. The work meta group is walked once, rather than
+once per stat and tag category. parse_fic returns exactly the same dictionary as
+ao3_get_fanfics.parse_fic, so the two can be swapped with --parser.
+'''
+
+import re
+import sys
+import lxml.html
+from lxml import etree
+from tqdm import tqdm
+from ao3_errors import error_row, PARSE_ERROR
+from ao3_profile import profiler, timed
+
+
+def has_class(name):
+    # XPath test for one of the classes of an element, like bs4's class_="name"
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+# bs4's class_="a b" matches the whole class attribute rather than single classes
+FLASH_ERROR = etree.XPath("//*[@class][normalize-space(@class)='flash error']")
+WORK_META = etree.XPath("//*[@class][normalize-space(@class)='work meta group']")
+WORK_META_DL = etree.XPath("//dl[normalize-space(@class)='work meta group']")
+TITLE = etree.XPath("//h2[normalize-space(@class)='title heading']")
+CHAPTERS = etree.XPath("//div[@id='chapters']")
+CHAPTER_NODES = etree.XPath(".//div[starts-with(@id, 'chapter-')]")
+PREFACES = etree.XPath("//div[{}]".format(has_class("preface")))
+TAG_LINKS = etree.XPath(".//*[{}]".format(has_class("tag")))
+# bs4's .text leaves out ruby annotations, scripts and the like
+TEXT_NODES = etree.XPath(".//text()[not(ancestor::rt or ancestor::rp or ancestor::script or ancestor::style or ancestor::template)]")
+
+# huge_tree lifts libxml2's limits on text size and nesting depth, which very long
+# or deeply nested works can exceed
+HTML_PARSER = lxml.html.HTMLParser(huge_tree=True)
+
+STAT_CATEGORIES = ['language', 'published', 'status', 'words', 'chapters', 'comments', 'kudos', 'bookmarks', 'hits']
+TAG_CATEGORIES = ['rating', 'category', 'fandom', 'relationship', 'character', 'freeform']
+
+
+# Lookups of the first match below an element walk the tree and stop there,
+# which is much cheaper than an XPath query that collects every match
+
+def first(el, tag="*", cls=None, id=None):
+    ''' the first element below el with this tag (and class and id), like bs4's find '''
+    for found in el.iterdescendants(tag):
+        if cls is not None and cls not in classes(found):
+            continue
+        if id is not None and found.get("id") != id:
+            continue
+        return found
+    return None
+
+def classes(el):
+    return el.get("class", "").split()
+
+def text(el):
+    ''' the equivalent of bs4's Tag.text '''
+    if len(el) == 0: # most inline tags, e.g. <em>word</em>
+        return el.text or ""
+    return "".join(TEXT_NODES(el))
+
+def bs4_string(el):
+    ''' the equivalent of bs4's Tag.string: the only string inside el, or None '''
+    if len(el) == 0:
+        return el.text
+    if len(el) == 1 and not el.text and not el[0].tail and isinstance(el[0].tag, str):
+        return bs4_string(el[0])
+    return None
+
+def children(el):
+    ''' the children of el in document order, as bs4 sees them: text and elements '''
+    if el.text:
+        yield el.text
+    for child in el:
+        if child.tag is etree.Comment:
+            # bs4 keeps comments as strings
+            if child.text:
+                yield child.text
+        elif isinstance(child.tag, str):
+            yield child
+        if child.tail:
+            yield child.tail
+
+@timed("into_chunks")
+def into_chunks(el):
+    ''' same as ao3_text.into_chunks, walking nested paragraphs with a stack '''
+    stack = [(children(el), [])]
+    while stack:
+        kids, previouschild = stack[-1]
+        for child in kids:
+            if isinstance(child, str):
+                previouschild.append(child.strip())
+            elif child.tag == "p" or child.tag == "div":
+                if len(previouschild):
+                    yield " ".join(previouschild)
+                    del previouschild[:]
+                stack.append((children(child), []))
+                break
+            elif child.tag == "br":
+                if len(previouschild):
+                    yield " ".join(previouschild)
+                    del previouschild[:]
+            else:
+                previouschild.append(text(child).strip())
+        else:
+            stack.pop()
+            yield " ".join(previouschild)
+
+def into_text(el):
+    return "\n".join(ch for ch in (ch.strip() for ch in into_chunks(el)) if len(ch) > 0)
+
+def chapter_paras(chapter):
+    for para in into_chunks(chapter):
+        para = para.strip()
+        if len(para) > 0 and para != "Chapter Text":
+            yield para
+
+def index_meta(meta):
+    '''
+    walks the work meta group once, returning the first dd for each class,
+    the first dd for each full class attribute and the first dt for each class
+    '''
+    dd_by_class = {}
+    dd_by_classes = {}
+    dt_by_class = {}
+    for el in meta.iter("dd", "dt"):
+        cls = classes(el)
+        if el.tag == "dd":
+            dd_by_classes.setdefault(" ".join(cls), el)
+            for c in cls:
+                dd_by_class.setdefault(c, el)
+        else:
+            for c in cls:
+                dt_by_class.setdefault(c, el)
+    return dd_by_class, dd_by_classes, dt_by_class
+
+def get_series(meta):
+    try:
+        seriesregion = first(first(meta, "span", "series"), "span", "position")
+        part_and_name = re.search(r"Part (\d+) of the (.*) series", text(seriesregion))
+        seriespart = part_and_name.group(1)
+        series = part_and_name.group(2)
+        seriesid = first(seriesregion, "a").get("href").split("/")[2]
+    except:
+        series = ""
+        seriespart = ""
+        seriesid = ""
+    return (series, seriespart, seriesid)
+
+@timed("get_stats")
+def get_stats(dd_by_class, dt_by_class):
+    stats = {}
+    for category in STAT_CATEGORIES:
+        dd = dd_by_class.get(category)
+        if dd is None:
+            stat = "null"
+            tqdm.write("Category error:")
+            tqdm.write('{} {} {}'.format(AttributeError, "'NoneType' object has no attribute 'text'", category))
+        else:
+            stat = text(dd)
+        stats[category] = stat
+
+    stats["status date"] = stats.get("status",stats["published"])
+    stats["language"] = stats["language"].strip()
+
+    #add a custom completed/updated field
+    thestatus = dt_by_class.get("status")
+    if thestatus is None: status = 'Completed'
+    else: status = text(thestatus).strip(':')
+    stats["status"] = status
+    return stats
+
+@timed("get_tags")
+def get_tags(dd_by_classes):
+    tags = {}
+    for category in TAG_CATEGORIES:
+        dd = dd_by_classes.get(category + ' tags')
+        tags[category] = [] if dd is None else [text(t) for t in TAG_LINKS(dd)]
+    return tags
+
+def access_denied(doc):
+    return bool(FLASH_ERROR(doc)) or not WORK_META(doc)
+
+def parse_fic(fic_id, src, stream=False):
+    ''' same as ao3_get_fanfics.parse_fic, using lxml '''
+    parsed = {"fic_id": fic_id, "denied": False, "errors": [], "story": None, "chapters": []}
+    try:
+        with profiler.stage("lxml tree"):
+            doc = lxml.html.document_fromstring(src, parser=HTML_PARSER)
+    except (etree.ParserError, ValueError):
+        doc = None
+    if doc is None or access_denied(doc):
+        parsed["denied"] = True
+        parsed["src"] = src
+        return parsed
+
+    meta = WORK_META_DL(doc)[0]
+    dd_by_class, dd_by_classes, dt_by_class = index_meta(meta)
+    (series, seriespart, seriesid) = get_series(meta)
+    tags = get_tags(dd_by_classes)
+    stats = get_stats(dd_by_class, dt_by_class)
+    title = bs4_string(TITLE(doc)[0]).strip()
+    byline = first(doc, cls="byline")
+    author = text(byline).strip()
+    try:
+        href = first(byline, "a").get("href")
+        author_key = href.split("/")[2]
+        author_pseudo = href.split("/")[4]
+    except Exception as e:
+        print('Unexpected error getting authorship: ', sys.exc_info()[0])
+        parsed["errors"].append(error_row(fic_id, PARSE_ERROR, 'byline: {}'.format(type(e).__name__)))
+        author_key = author
+        author_pseudo = author
+
+    #get the fic itself
+    content = CHAPTERS(doc)[0]
+    chapnodes = CHAPTER_NODES(content)
+    if len(chapnodes) == 0: chapnodes = CHAPTERS(doc)
+    chapter_titles = [text(first(t, "h3")).strip() for t in chapnodes]
+    chapters = [first(ch, "div", "userstuff") for ch in chapnodes]
+
+    st_summary = ""
+    st_preface_notes = ""
+    st_afterword_notes = ""
+    for preface in PREFACES(doc):
+        if "afterword" in classes(preface):
+            try:
+                st_afterword_notes = into_text(first(preface, "blockquote"))
+            except: pass
+        elif "chapter" not in classes(preface):
+            try:
+                st_preface_notes = into_text(first(first(preface, "div", "notes"), "blockquote"))
+            except: pass
+            try:
+                st_summary = into_text(first(first(preface, "div", "summary"), "blockquote"))
+            except: pass
+
+    strow = { "fic_id": fic_id,
+              "title": title,
+              "summary": st_summary,
+              "preface_notes": st_preface_notes,
+              "afterword_notes": st_afterword_notes,
+              "series": series,
+              "seriespart": seriespart,
+              "seriesid": seriesid,
+              "author": author_pseudo,
+              "author_key": author_key,
+              "additional tags": tags["freeform"],
+              "chapter_count": len(chapters) }
+    strow = dict(strow, **tags)
+    strow = dict(strow, **stats)
+    parsed["story"] = strow
+
+    for ch, chall in enumerate(chapters):
+        paras = chapter_paras(chall)
+        if not stream:
+            paras = list(paras)
+
+        ch_preface_notes = ""
+        ch_summary = ""
+        ch_afterword_notes = ""
+        chapnode = chapnodes[ch]
+        try:
+            ch_summary = into_text(first(first(first(chapnode, "div", "preface"), "div", id="summary"), "blockquote"))
+        except: pass
+        try:
+            ch_preface_notes = into_text(first(first(first(chapnode, "div", "preface"), "div", id="notes"), "blockquote"))
+        except: pass
+        try:
+            ch_afterword_notes = into_text(first(first(chapnode, "div", "end"), "blockquote"))
+        except: pass
+        chrow = {
+             "fic_id": fic_id,
+             "title": title,
+             "summary": ch_summary,
+             "preface_notes": ch_preface_notes,
+             "afterword_notes": ch_afterword_notes,
+             "chapter_num": str(ch+1),
+             "chapter_title": chapter_titles[ch],
+             "paragraph_count": None if stream else len(paras)}
+        parsed["chapters"].append((chrow, paras))
+    return parsed
@@ -0,0 +1,156 @@
+'''
+Counters and histograms for watching a long crawl, shared by ao3_work_ids.py and
+ao3_get_fanfics.py (--metrics-file / --metrics_file).
+
+Everything is recorded on the one Metrics object in this module, `metrics`:
+    requests_total{status}      responses from AO3, by HTTP status (and "error" for failed connections)
+    request_seconds             histogram of how long each request took
+    response_bytes_total        size of the pages received
+    retries_total               requests that were tried again (throttled, or the connection failed)
+    sleep_seconds_total         time spent waiting for the rate limit (and backing off)
+    fetch_seconds_total         time spent waiting for responses
+    parse_seconds_total         time spent parsing pages (in the parser processes, in pipeline mode)
+    write_seconds_total         time spent writing works out
+    works_total{outcome}        works done, by how they ended ("scraped" or a kind of failure),
+                                each counted once, however many rounds it took
+    work_retries_total{outcome} works that failed and were put back to try again in a later round
+    ids_total, pages_total      work ids and listing pages collected by ao3_work_ids.py
+and every snapshot adds works_per_hour and ids_per_hour since the start.
+
+With a metrics file, a snapshot is written to it every so often, replacing the last one:
+json, or the Prometheus text format if the file name ends in .prom (e.g. for
+node_exporter's textfile collector). Comparing sleep, fetch, parse and write time shows
+whether a slow crawl is being held back by throttling, AO3, parsing or the disk.
+'''
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of the request_seconds buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram():
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is everything above the top bucket
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        ''' cumulative counts, as Prometheus has them '''
+        cumulative = {}
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            cumulative[str(bound)] = total
+        return {"buckets": cumulative, "count": self.count, "sum": self.sum}
+
+
+def metric_key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.fpath = ''
+        self.every = 60
+        self.last_write = 0
+
+    def count(self, name, n=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        ''' adds the time spent in a with block to the counter name_seconds_total '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.count(name + "_seconds_total", time.time() - start)
+
+    def total(self, name):
+        ''' the sum of a counter over all its labels '''
+        with self.lock:
+            return sum(v for k, v in self.counters.items() if k == name or k.startswith(name + "{"))
+
+    def snapshot(self):
+        hours = max(time.time() - self.start_time, 1e-9) / 3600
+        works, ids = self.total("works_total"), self.total("ids_total")
+        with self.lock:
+            return {
+                "time": time.time(),
+                "uptime_seconds": hours * 3600,
+                "works_per_hour": works / hours,
+                "ids_per_hour": ids / hours,
+                "counters": dict(self.counters),
+                "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+            }
+
+    def prometheus(self, snapshot):
+        lines = []
+        for name in ["uptime_seconds", "works_per_hour", "ids_per_hour"]:
+            lines.append("ao3_{} {}".format(name, snapshot[name]))
+        for key, value in sorted(snapshot["counters"].items()):
+            lines.append("ao3_{} {}".format(key, value))
+        for name, h in sorted(snapshot["histograms"].items()):
+            for bound, count in h["buckets"].items():
+                lines.append('ao3_{}_bucket{{le="{}"}} {}'.format(name, bound, count))
+            lines.append("ao3_{}_count {}".format(name, h["count"]))
+            lines.append("ao3_{}_sum {}".format(name, h["sum"]))
+        return "\n".join(lines) + "\n"
+
+    def configure(self, fpath, every=60):
+        ''' write snapshots to fpath ('' for none), at most every so many seconds '''
+        self.fpath = fpath
+        self.every = every
+
+    def write(self):
+        ''' writes a snapshot to the metrics file, replacing the last one '''
+        if not self.fpath:
+            return
+        snapshot = self.snapshot()
+        if self.fpath.endswith(".prom"):
+            text = self.prometheus(snapshot)
+        else:
+            text = json.dumps(snapshot, indent=1)
+        tmp_fpath = self.fpath + ".tmp"
+        with open(tmp_fpath, "w") as f:
+            f.write(text)
+        os.replace(tmp_fpath, self.fpath)
+        self.last_write = time.time()
+
+    def maybe_write(self):
+        ''' writes a snapshot if the last one is old enough '''
+        if self.fpath and time.time() - self.last_write >= self.every:
+            self.write()
+
+
+metrics = Metrics()
@@ -0,0 +1,407 @@
+'''
+Tables that ao3_get_fanfics.py writes its stories and chapters to.
+
+Both kinds of table take rows with writerow, like a csv.writer, with the values in
+column order as the parser produced them (lists of tags, numbers as AO3 shows them).
+
+CsvTable appends to a csv, with lists written as json, as the scraper always has.
+Rows are kept in memory until the table is flushed, and then written out in one go.
+
+ParquetTable writes a directory of Parquet files (stories.parquet/part-....parquet),
+which pandas or pyarrow read as one table (pd.read_parquet("stories.parquet")).
+Tags are list<string> columns, stats are integers and dates are dates, so nothing
+needs re-parsing on loading. Rows are buffered and written out as a new part file
+once row_group_size of them are waiting or the oldest has waited flush_secs seconds,
+and at the end; each part is written under a temporary name and renamed, so a crash
+never leaves a broken file. pyarrow is optional: pip install pyarrow to use this.
+
+WorkWriter flushes the tables together, every flush_every works or flush_secs seconds
+(with Parquet tables, only once one of them has a row group's worth of rows waiting),
+and then records the works whose rows were written in a completion journal (completed.csv),
+along with the size each csv had after them, or for a Parquet table its last part file.
+A crash can lose at most the works since the last flush, which aren't in the journal,
+and any rows of theirs that did reach the tables are cut off again (or their part files
+removed) when the tables are next opened.
+'''
+
+import csv
+import datetime
+import io
+import json
+import os
+import re
+import time
+
+from ao3_profile import timed
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+FORMATS = ['csv', 'parquet']
+
+# the columns of the tables, shared with ao3_work_ids.py --metadata
+storycolumns = ['fic_id', 'title', 'author', 'author_key', 'rating', 'category', 'fandom', 'relationship', 'character', 'additional tags', 'language', 'published', 'status', 'status date', 'words', 'comments', 'kudos', 'bookmarks', 'hits', 'chapter_count', 'series','seriespart','seriesid', 'summary', 'preface_notes','afterword_notes']
+chaptercolumns = ['fic_id', 'title', 'summary', 'preface_notes', 'afterword_notes', 'chapter_num', 'chapter_title', 'paragraph_count']
+textcolumns = ['fic_id', 'chapter_id','para_id','text']
+# column types for --output-format parquet, the other columns are strings
+storytypes = {'fic_id': 'int', 'rating': 'list', 'category': 'list', 'fandom': 'list', 'relationship': 'list', 'character': 'list', 'additional tags': 'list', 'published': 'date', 'status date': 'date', 'words': 'int', 'comments': 'int', 'kudos': 'int', 'bookmarks': 'int', 'hits': 'int', 'chapter_count': 'int', 'seriespart': 'int', 'seriesid': 'int'}
+chaptertypes = {'fic_id': 'int', 'chapter_num': 'int', 'paragraph_count': 'int'}
+
+
+def maybe_json(s):
+    if type(s) is list: return json.dumps(s)
+    if type(s) is dict: return json.dumps(s)
+    else: return s
+
+
+class CsvTable():
+
+    def __init__(self, fpath, columns=None):
+        self.fpath = fpath
+        self.f = open(fpath, 'ab')
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.marks = []
+        #does the csv already exist? if not, let's write a header row.
+        if self.f.tell() == 0 and columns:
+            print('Writing a header row for the csv.')
+            self.writer.writerow(columns)
+            self.flush()
+
+    def writerow(self, row):
+        self.writer.writerow([maybe_json(value) for value in row])
+
+    def mark(self):
+        ''' marks the end of a work's rows, flush returns the size of the csv there '''
+        self.marks.append(self.buffer.tell())
+
+    def discard(self):
+        ''' drops the rows written since the last mark '''
+        self.buffer.truncate(self.marks[-1] if self.marks else 0)
+        self.buffer.seek(0, io.SEEK_END)
+
+    def unmarked(self):
+        ''' whether there are rows after the last mark '''
+        return self.buffer.tell() > (self.marks[-1] if self.marks else 0)
+
+    def due(self):
+        ''' whether the table wants flushing: a csv can be flushed at any time '''
+        return True
+
+    def flush(self, fsync=False):
+        ''' writes out the rows written so far, returning the size of the csv at each mark '''
+        text = self.buffer.getvalue()
+        sizes = []
+        start = 0
+        for end in self.marks:
+            self.f.write(text[start:end].encode("utf-8"))
+            sizes.append(self.f.tell())
+            start = end
+        self.f.write(text[start:].encode("utf-8"))
+        self.f.flush()
+        if fsync:
+            os.fsync(self.f.fileno())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.marks = []
+        return sizes
+
+    def truncate(self, size):
+        ''' cuts off anything after size bytes, e.g. rows of works that weren't completed '''
+        size = int(size)
+        if size < self.f.tell():
+            self.f.truncate(size)
+            self.f.seek(size)
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# column types for ParquetTable, anything not listed is a string
+def to_int(value):
+    if isinstance(value, int):
+        return value
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    digits = re.sub(r'[^\d]', '', str(value or ''))
+    return int(digits) if digits else None
+
+def to_list(value):
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    if isinstance(value, str) and value.startswith('['):
+        return [str(v) for v in json.loads(value)]
+    return []
+
+def to_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.date.fromisoformat(str(value).strip())
+    except ValueError: # "null", or a date AO3 didn't show
+        return None
+
+def to_string(value):
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+CONVERTERS = {'int': to_int, 'list': to_list, 'date': to_date, 'string': to_string}
+
+
+def arrow_type(kind):
+    return {'int': pa.int64(), 'list': pa.list_(pa.string()), 'date': pa.date32(), 'string': pa.string()}[kind]
+
+class ParquetTable():
+
+    def __init__(self, dirpath, columns, types, row_group_size=10000, flush_secs=300):
+        '''
+        dirpath: directory the part files are written to
+        types: {column: 'int', 'list' or 'date'}, other columns are strings
+        row_group_size, flush_secs: the table is due to be flushed to a new part file
+            when this many rows of completed works are waiting, or the oldest has waited this long
+        '''
+        if pa is None:
+            raise ImportError("Parquet output needs pyarrow: pip install pyarrow")
+        os.makedirs(dirpath, exist_ok=True)
+        self.dirpath = dirpath
+        self.columns = columns
+        self.kinds = [types.get(c, 'string') for c in columns]
+        self.schema = pa.schema([(c, arrow_type(kind)) for c, kind in zip(columns, self.kinds)])
+        self.row_group_size = row_group_size
+        self.flush_secs = flush_secs
+        self.rows = []
+        self.marks = []
+        self.first_row_time = None
+        self.last_part = ''
+
+    def writerow(self, row):
+        # only written out when WorkWriter flushes, so a part file never holds part of a work
+        if not self.rows:
+            self.first_row_time = time.time()
+        self.rows.append(row)
+
+    def n_marked(self):
+        return self.marks[-1] if self.marks else 0
+
+    def mark(self):
+        self.marks.append(len(self.rows))
+
+    def discard(self):
+        del self.rows[self.n_marked():]
+
+    def unmarked(self):
+        return len(self.rows) > self.n_marked()
+
+    def due(self):
+        ''' whether enough rows of completed works are waiting to make a row group '''
+        return self.n_marked() > 0 and (self.n_marked() >= self.row_group_size
+                                        or time.time() - self.first_row_time >= self.flush_secs)
+
+    def flush(self, fsync=False):
+        '''
+        writes the rows of completed works to a new part file, keeping any after the last mark.
+        returns the name of the last part file at each mark, for truncate
+        '''
+        n_marked = self.n_marked()
+        if n_marked > 0:
+            rows = self.rows[:n_marked]
+            arrays = []
+            for i, (kind, field) in enumerate(zip(self.kinds, self.schema)):
+                convert = CONVERTERS[kind]
+                arrays.append(pa.array([convert(row[i]) for row in rows], type=field.type))
+            table = pa.Table.from_arrays(arrays, schema=self.schema)
+            # named by time, so that the parts sort in the order they were written
+            fname = "part-{:016d}-{}.parquet".format(time.time_ns() // 1000, os.getpid())
+            tmp_fpath = os.path.join(self.dirpath, fname + ".tmp")
+            pq.write_table(table, tmp_fpath, compression="zstd")
+            if fsync:
+                with open(tmp_fpath, 'rb') as f:
+                    os.fsync(f.fileno())
+            os.replace(tmp_fpath, os.path.join(self.dirpath, fname))
+            self.last_part = fname
+            del self.rows[:n_marked]
+            self.first_row_time = time.time()
+        parts = [self.last_part] * len(self.marks)
+        self.marks = []
+        return parts
+
+    def truncate(self, last_part):
+        ''' removes the part files written after last_part, which hold rows of works that weren't completed '''
+        self.last_part = last_part
+        for fname in os.listdir(self.dirpath):
+            if (fname.endswith(".parquet") and fname > last_part) or fname.endswith(".parquet.tmp"):
+                os.remove(os.path.join(self.dirpath, fname))
+
+    def close(self):
+        self.flush()
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_table(fpath, columns, output_format='csv', types=None):
+    '''
+    opens a table to append rows to. fpath ends in .csv;
+    Parquet tables go in a directory of the same name ending in .parquet instead
+    '''
+    if output_format == 'parquet':
+        return ParquetTable(parquet_path(fpath), columns, types or {})
+    return CsvTable(fpath, columns)
+
+def parquet_path(fpath):
+    return re.sub(r'\.csv$', '', fpath) + '.parquet'
+
+def read_columns(dirpath, columns):
+    ''' yields the values of some columns of a Parquet table, row by row, in the order they were written '''
+    for fname in sorted(os.listdir(dirpath)):
+        if fname.endswith(".parquet"):
+            table = pq.read_table(os.path.join(dirpath, fname), columns=columns)
+            yield from zip(*(table.column(c).to_pylist() for c in columns))
+
+
+class CompletionJournal():
+    '''
+    completed.csv: a row for each work whose story, chapters and text have been written,
+    with the size of each csv (stories, chapters and errors) just after its rows,
+    or for a Parquet table the name of the last part file written by then
+    '''
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.f = open(fpath, 'a')
+        self.writer = csv.writer(self.f)
+
+    def rows(self):
+        with open(self.fpath, 'r') as f_in:
+            for row in csv.reader(f_in):
+                if row:
+                    yield row
+
+    def last_sizes(self):
+        ''' the size of each csv (or last part file of each Parquet table) after the last completed work, or None '''
+        last = None
+        for row in self.rows():
+            last = row
+        if last is None:
+            return None
+        return [size or None for size in last[1:]]
+
+    def record(self, fic_ids, sizes, fsync=False):
+        for i, fic_id in enumerate(fic_ids):
+            self.writer.writerow([fic_id] + [table_sizes[i] if table_sizes else '' for table_sizes in sizes])
+        self.f.flush()
+        if fsync:
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+class WorkWriter():
+    '''
+    with WorkWriter(stories, chapters, errors, journal) as output:
+        output.stories.writerow(...)
+        ...
+        output.done(fic_id) # once all of a work's rows and text are written
+    '''
+
+    def __init__(self, stories, chapters, errors, journal, flush_every=100, flush_secs=30, fsync=False, text_store=None, catalog=None):
+        '''
+        stories, chapters, errors: CsvTables or ParquetTables
+        journal: the CompletionJournal that completed works are recorded in
+        flush_every, flush_secs: the tables are flushed when this many works are done,
+            or when the first of them was done this long ago
+        fsync: whether to make sure every flush reaches the disk before the works are recorded
+        text_store: the TextStore that works' text is written to, if any
+        catalog: the ao3_catalog.Catalog to commit after each flush, if any
+        '''
+        self.stories = stories
+        self.chapters = chapters
+        self.errors = errors
+        self.tables = [stories, chapters, errors]
+        self.journal = journal
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self.fsync = fsync
+        self.text_store = text_store
+        self.catalog = catalog
+        self.pending = []
+        self.first_done_time = None
+        # drop any rows written after the last completed work
+        sizes = journal.last_sizes()
+        if sizes is not None:
+            for table, size in zip(self.tables, sizes):
+                if size is not None:
+                    table.truncate(size)
+
+    def done(self, fic_id):
+        for table in self.tables:
+            table.mark()
+        if not self.pending:
+            self.first_done_time = time.time()
+        self.pending.append(fic_id)
+        if len(self.pending) >= self.flush_every or time.time() - self.first_done_time >= self.flush_secs:
+            # Parquet tables are only flushed a row group at a time, rather than into a part file per batch
+            parquet_tables = [table for table in self.tables if isinstance(table, ParquetTable)]
+            if not parquet_tables or any(table.due() for table in parquet_tables):
+                self.flush()
+
+    def keep(self):
+        '''
+        keeps the rows written since the last completed work, such as the error row of a work
+        that will be tried again, so that discard doesn't drop them. They are recorded in a row without an id
+        '''
+        self.done('')
+
+    def discard(self):
+        ''' drops the rows written since the last completed work, which couldn't be finished '''
+        for table in self.tables:
+            table.discard()
+
+    @timed("flush")
+    def flush(self):
+        if self.pending:
+            sizes = [table.flush(self.fsync) for table in self.tables]
+            if self.fsync and self.text_store is not None:
+                self.text_store.sync()
+            self.journal.record(self.pending, sizes, self.fsync)
+            self.pending = []
+        # works that will be tried again aren't done, but are in the catalog
+        if self.catalog is not None:
+            self.catalog.commit()
+
+    def close(self, complete=True):
+        '''
+        complete: whether everything written is finished with (rather than the run
+        stopping partway through a work), so that the rows after the last completed
+        work, such as errors, are kept too. They are recorded in a row without an id
+        '''
+        if complete and any(table.unmarked() for table in self.tables):
+            self.keep()
+        self.flush()
+        for table in self.tables:
+            table.close()
+        self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
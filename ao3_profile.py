@@ -0,0 +1,203 @@
+'''
+Profiling for ao3_get_fanfics.py --profile and ao3_work_ids.py --profile, for finding
+out where the time goes when it isn't the request delay, e.g. when re-parsing the
+cache or collecting metadata from listing pages.
+
+Everything is recorded on the one Profiler object in this module, `profiler`. While it
+is running, it times these stages:
+    soup, lxml tree     building the BeautifulSoup (or lxml) tree of a page
+    get_stats, get_tags reading a work's stats and tags
+    get_blurb_stats, get_blurb_metadata    the same for a blurb on a listing page
+    into_chunks         splitting text into paragraphs
+    flush               writing batches of rows out to the tables
+and, from ao3_metrics, the time spent sleeping for the rate limit, waiting for
+responses (http), parsing and writing. Stages can be nested: into_chunks is part of
+parse, or of write when paragraphs are streamed to the tables.
+
+Every so many works it writes to its directory
+    profile-NNNNNNNN.txt    the stage times, the functions that took longest
+                            and, with memory profiling, the lines that allocated most
+    profile-NNNNNNNN.prof   the cProfile stats so far, for pstats or snakeviz
+where NNNNNNNN is the number of works done. cProfile only sees the main thread, so
+with --profile pages are parsed in the main process rather than in a pool.
+'''
+
+import cProfile
+import inspect
+import io
+import linecache
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+from ao3_metrics import metrics
+
+# stages that ao3_metrics already times: (name, counter of seconds, counter of calls)
+METRIC_STAGES = [
+    ("sleep", "sleep_seconds_total", None),
+    ("http", "fetch_seconds_total", "requests_total"),
+    ("parse", "parse_seconds_total", None),
+    ("write", "write_seconds_total", None),
+]
+
+
+class Profiler():
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stages = {} # name: [calls, seconds]
+        self.dirpath = ''
+        self.every = 1000
+        self.memory = False
+        self.unit = 'works'
+        self.n_works = 0
+        self.last_dump = 0
+        self.cprofile = None
+        self.start_time = time.time()
+
+    def start(self, dirpath, every=1000, memory=False, unit='works'):
+        '''
+        starts profiling, dumping to dirpath every so many works (or whatever unit done counts).
+        memory also traces allocations with tracemalloc, which slows everything down a lot
+        '''
+        os.makedirs(dirpath, exist_ok=True)
+        self.dirpath = dirpath
+        self.every = every
+        self.memory = memory
+        self.unit = unit
+        self.enabled = True
+        self.start_time = time.time()
+        if memory:
+            tracemalloc.start(10)
+        self.cprofile = cProfile.Profile()
+        self.cprofile.enable()
+
+    def stop(self):
+        ''' writes a last dump and stops profiling '''
+        if not self.enabled:
+            return
+        self.dump()
+        self.cprofile.disable()
+        if self.memory:
+            tracemalloc.stop()
+        self.enabled = False
+
+    def add(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0])
+            stage[0] += 1
+            stage[1] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        ''' adds the time spent in a with block to a stage '''
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed_iter(self, name, it):
+        ''' yields from it, adding the time spent getting each item to a stage '''
+        it = iter(it)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def done(self, n=1):
+        ''' counts works done, dumping every self.every of them '''
+        if not self.enabled:
+            return
+        self.n_works += n
+        if self.n_works - self.last_dump >= self.every:
+            self.dump()
+
+    #
+    # Dumps
+    #
+    def stage_lines(self):
+        lines = ['{:<20} {:>10} {:>12} {:>10}'.format('stage', 'calls', 'seconds', 'ms/call')]
+        def line(name, calls, seconds):
+            per_call = '{:.3f}'.format(1000 * seconds / calls) if calls else ''
+            lines.append('{:<20} {:>10} {:>12.3f} {:>10}'.format(name, calls or '', seconds, per_call))
+        for name, seconds_counter, calls_counter in METRIC_STAGES:
+            line(name, calls_counter and int(metrics.total(calls_counter)), metrics.total(seconds_counter))
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1][1])
+        for name, (calls, seconds) in stages:
+            line(name, calls, seconds)
+        return lines
+
+    def function_lines(self, n=30):
+        s = io.StringIO()
+        pstats.Stats(self.cprofile, stream=s).sort_stats('cumulative').print_stats(n)
+        return s.getvalue().strip('\n').split('\n')
+
+    def memory_lines(self, n=20):
+        # leaving out what profiling itself allocates
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, cProfile, pstats, linecache)
+        ] + [tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ['traced memory: {:.1f} MB, peak {:.1f} MB'.format(current / 1e6, peak / 1e6)]
+        for stat in snapshot.statistics('lineno')[:n]:
+            frame = stat.traceback[0]
+            lines.append('{:>10.1f} KB {:>8} blocks  {}:{}'.format(stat.size / 1e3, stat.count, frame.filename, frame.lineno))
+        return lines
+
+    def dump(self):
+        ''' writes the profile so far to profile-<works done>.txt and .prof '''
+        self.last_dump = self.n_works
+        fpath = os.path.join(self.dirpath, 'profile-{:08d}'.format(self.n_works))
+        # pstats and dump_stats both stop the profiler
+        self.cprofile.disable()
+        try:
+            lines = ['{} {}, {:.1f} seconds'.format(self.n_works, self.unit, time.time() - self.start_time), '']
+            lines += self.stage_lines() + ['']
+            memory_lines = self.memory_lines() + [''] if self.memory else []
+            lines += self.function_lines() + [''] + memory_lines
+            with open(fpath + '.txt', 'w') as f:
+                f.write('\n'.join(lines))
+            self.cprofile.dump_stats(fpath + '.prof')
+        finally:
+            self.cprofile.enable()
+
+
+profiler = Profiler()
+
+
+def timed(name):
+    '''
+    decorator that adds the time spent in a function to a stage, while profiling.
+    for a generator function it's the time spent getting each item
+    '''
+    def decorate(f):
+        if inspect.isgeneratorfunction(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not profiler.enabled:
+                    return f(*args, **kwargs)
+                return profiler.timed_iter(name, f(*args, **kwargs))
+        else:
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not profiler.enabled:
+                    return f(*args, **kwargs)
+                with profiler.stage(name):
+                    return f(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,55 @@
+'''
+Getting the text out of parts of AO3 pages parsed with BeautifulSoup, shared by
+ao3_get_fanfics.py (work pages) and ao3_work_ids.py (blurbs on listing pages).
+ao3_lxml_parse.py has the same for lxml trees.
+'''
+
+import bs4
+
+from ao3_profile import timed
+
+#from unidecode import unidecode
+
+# We don't want to convert unicode to ascii particularly
+def unidecode(st): return st
+
+def text_of(t):
+    return unidecode(t.text if type(t) is bs4.element.Tag else t).strip()
+
+@timed("into_chunks")
+def into_chunks(tag):
+    '''
+    yields the text of tag chunk by chunk: <p>, <div> and <br> end a chunk,
+    any other tags are run into the surrounding text.
+    Nested paragraphs are walked with a stack of (children, pending text)
+    rather than by recursion, so deeply nested html can't hit the recursion limit.
+    '''
+    stack = [(iter(tag.children), [])]
+    while stack:
+        children, previouschild = stack[-1]
+        for child in children:
+            if child.name == "p" or child.name == "div":
+                if len(previouschild):
+                    yield " ".join(previouschild)
+                    del previouschild[:]
+                stack.append((iter(child.children), []))
+                break
+            elif child.name == "br":
+                if len(previouschild):
+                    yield " ".join(previouschild)
+                    del previouschild[:]
+            else:
+                previouschild.append(text_of(child))
+        else:
+            stack.pop()
+            yield " ".join(previouschild)
+
+def into_text(tag):
+    return "\n".join(ch for ch in (ch.strip() for ch in into_chunks(tag)) if len(ch) > 0)
+
+def chapter_paras(chapter):
+    ''' yields the paragraphs of a chapter's text '''
+    for para in into_chunks(chapter):
+        para = para.strip()
+        if len(para) > 0 and para != "Chapter Text":
+            yield para
@@ -0,0 +1,208 @@
+'''
+A packed store for the text of works, used by ao3_get_fanfics.py --text-format jsonl.zst
+instead of a csv file per work (or per chapter), which for a large fandom means
+hundreds of thousands of tiny files.
+
+The store is a directory of append-only shards (text-00000.jsonl.zst, ...), each up to
+shard_bytes long, and an index:
+    text-NNNNN.jsonl.zst    one zstd frame per work, holding a line of json per paragraph:
+                            {"fic_id": "123", "chapter_id": 1, "para_id": 1, "text": "..."}
+    index.csv               fic_id, shard, offset, length of each work's frame
+
+Since every work is its own frame, one work can be read from the middle of a shard
+(TextStore.work), and the whole corpus can be read shard by shard, in order (TextStore.works).
+A work that was scraped again (e.g. with --update) is appended again, and the
+index's last row for it is the current one.
+
+A work is added to the index only once its frame has been written out, so a crash
+leaves at most an unindexed frame at the end of a shard, which is cut off when the
+store is next opened. Only one process should write to a store at a time.
+
+zstandard is optional: pip install zstandard to use this.
+'''
+
+import csv
+import io
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_COLUMNS = ['fic_id', 'shard', 'offset', 'length']
+
+
+def shard_fname(shard):
+    return "text-{:05d}.jsonl.zst".format(shard)
+
+
+class TextStore():
+
+    def __init__(self, dirpath, shard_bytes=2**30, level=3):
+        '''
+        dirpath: directory the shards and index are in
+        shard_bytes: a new shard is started once the current one is this long
+        level: zstd compression level
+        '''
+        if zstandard is None:
+            raise ImportError("the packed text store needs zstandard: pip install zstandard")
+        self.dirpath = dirpath
+        self.shard_bytes = shard_bytes
+        self.level = level
+        self.index_fpath = os.path.join(dirpath, "index.csv")
+        self.shard_f = None
+        self.index_f = None
+        self.index_writer = None
+        self.shard = 0
+        self._index = None
+
+    def read_index(self):
+        ''' returns {fic_id: (shard, offset, length)}, the last entry for each work '''
+        if self._index is None:
+            self._index = {}
+            for fic_id, shard, offset, length in self.entries():
+                self._index[fic_id] = (shard, offset, length)
+        return self._index
+
+    def entries(self):
+        ''' yields (fic_id, shard, offset, length) for every frame, in the order they were written '''
+        if not os.path.isfile(self.index_fpath):
+            return
+        with open(self.index_fpath, 'r') as f_in:
+            reader = csv.reader(f_in)
+            next(reader, None)
+            for row in reader:
+                if len(row) == len(INDEX_COLUMNS):
+                    yield row[0], int(row[1]), int(row[2]), int(row[3])
+
+    #
+    # Writing
+    #
+    def open(self):
+        os.makedirs(self.dirpath, exist_ok=True)
+        # an index row cut off by a crash would run into the next one
+        if os.path.isfile(self.index_fpath):
+            with open(self.index_fpath, 'rb+') as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - 4096))
+                tail = f.read()
+                if tail and not tail.endswith(b"\n"):
+                    f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+        # carry on from the end of the last indexed frame, dropping anything written after it
+        end = 0
+        for _, shard, offset, length in self.entries():
+            if shard > self.shard or (shard == self.shard and offset + length > end):
+                self.shard, end = shard, offset + length
+        shard_fpath = os.path.join(self.dirpath, shard_fname(self.shard))
+        if os.path.exists(shard_fpath) and os.path.getsize(shard_fpath) > end:
+            os.truncate(shard_fpath, end)
+        self.shard_f = open(shard_fpath, 'ab')
+        self.index_f = open(self.index_fpath, 'a')
+        self.index_writer = csv.writer(self.index_f)
+        if os.stat(self.index_fpath).st_size == 0:
+            self.index_writer.writerow(INDEX_COLUMNS)
+        self.compressor = zstandard.ZstdCompressor(level=self.level)
+        return self
+
+    def sync(self):
+        ''' makes sure everything added so far is on disk '''
+        os.fsync(self.shard_f.fileno())
+        os.fsync(self.index_f.fileno())
+
+    def close(self):
+        if self.shard_f is not None:
+            self.shard_f.close()
+            self.index_f.close()
+            self.shard_f = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def next_shard(self):
+        self.shard_f.close()
+        self.shard += 1
+        self.shard_f = open(os.path.join(self.dirpath, shard_fname(self.shard)), 'ab')
+
+    def add_work(self, fic_id, paras):
+        '''
+        appends a work, given its paragraphs as (chapter_id, para_id, text).
+        paras can be a generator, only one paragraph is held at a time.
+        If it raises, nothing of the work is kept
+        '''
+        if self.shard_f.tell() >= self.shard_bytes:
+            self.next_shard()
+        offset = self.shard_f.tell()
+        fic_id = str(fic_id)
+        writer = self.compressor.stream_writer(self.shard_f, closefd=False)
+        try:
+            for chapter_id, para_id, text in paras:
+                line = json.dumps({"fic_id": fic_id, "chapter_id": chapter_id, "para_id": para_id, "text": text})
+                writer.write(line.encode("utf-8") + b"\n")
+        except BaseException:
+            # cut off the part of the frame written so far, so the next work starts where this one did
+            self.shard_f.flush()
+            self.shard_f.truncate(offset)
+            self.shard_f.seek(offset)
+            raise
+        writer.close() # ends the frame
+        self.shard_f.flush()
+        length = self.shard_f.tell() - offset
+        self.index_writer.writerow([fic_id, self.shard, offset, length])
+        self.index_f.flush()
+        if self._index is not None:
+            self._index[fic_id] = (self.shard, offset, length)
+
+    #
+    # Reading
+    #
+    def decompress(self, frame):
+        return zstandard.ZstdDecompressor().decompressobj().decompress(frame)
+
+    def rows(self, frame):
+        for line in io.BytesIO(self.decompress(frame)):
+            yield json.loads(line)
+
+    def work(self, fic_id):
+        ''' returns the paragraphs of a work as dicts with fic_id, chapter_id, para_id and text, or None '''
+        entry = self.read_index().get(str(fic_id))
+        if entry is None:
+            return None
+        shard, offset, length = entry
+        with open(os.path.join(self.dirpath, shard_fname(shard)), 'rb') as f_in:
+            f_in.seek(offset)
+            return list(self.rows(f_in.read(length)))
+
+    def works(self, latest_only=True):
+        '''
+        yields (fic_id, paragraphs) for every work, reading the shards from start to end.
+        With latest_only, works that were scraped more than once are only read at their last copy
+        '''
+        entries = list(self.entries())
+        if latest_only:
+            latest = {fic_id: (shard, offset) for fic_id, shard, offset, _ in entries}
+            entries = [e for e in entries if latest[e[0]] == (e[1], e[2])]
+        entries.sort(key=lambda e: (e[1], e[2]))
+        f_in, shard = None, None
+        try:
+            for fic_id, entry_shard, offset, length in entries:
+                if entry_shard != shard:
+                    if f_in is not None:
+                        f_in.close()
+                    shard = entry_shard
+                    f_in = open(os.path.join(self.dirpath, shard_fname(shard)), 'rb')
+                f_in.seek(offset)
+                yield fic_id, list(self.rows(f_in.read(length)))
+        finally:
+            if f_in is not None:
+                f_in.close()
+
+    def __contains__(self, fic_id):
+        return str(fic_id) in self.read_index()
+
+    def __len__(self):
+        return len(self.read_index())
@@ -3,20 +3,40 @@
 # Saves ids to a csv for later use e.g. to retrieve fic text
 
 # Options:
+# Start from a later page of the search (--start_with_page)
+# Continue a search that was interrupted, from the page after the last one
+#      saved (--resume), using the checkpoint written after every page
 # Only retrieve multichapter fics
+# Also save each work's metadata from the search results, in the same
+#      format as ao3_get_fanfics.py's stories.csv (--metadata)
 # Modify search to include a list of tags
 #      (e.g. you want all fics tagged either "romance" or "fluff")
+# Write counts of requests, latencies, retries and ids/hour to a file every
+#      --metrics_every seconds (--metrics_file, json or Prometheus .prom, see ao3_metrics.py)
+# Record each work found, with the page it was found on and its blurb stats, in an
+#      SQLite catalog shared with ao3_get_fanfics.py (--catalog, under --fandom, see ao3_catalog.py)
+# Time each stage (parsing pages, reading blurbs, writing) and dump cProfile stats
+#      every --profile_every ids (--profile DIR, see ao3_profile.py), and the lines
+#      allocating the most memory too with --profile_memory
 
 from bs4 import BeautifulSoup
 import re
-import time
 import requests
 import csv
 import sys
+import os
+import contextlib
+import sqlite3
+import json
 import datetime
 import argparse
 from tqdm import tqdm
-import pdb
+from ao3_metrics import metrics
+from ao3_profile import profiler, timed
+from ao3_catalog import Catalog
+from ao3_http import RateLimiter, RetryPolicy, fetch, throttled, make_session, https_url, DEFAULT_DELAY, DEFAULT_RATE_FPATH, DEFAULT_TIMEOUT
+from ao3_output import storycolumns, maybe_json
+from ao3_text import into_text, unidecode
 
 page_empty = False
 base_url = ""
@@ -25,12 +45,58 @@ num_requested_fic = 0
 num_recorded_fic = 0
 csv_name = ""
 multichap_only = ""
+metadata_only = False
 tags = []
+start_page = 1
+resume = False
 
 # keep track of all processed ids to avoid repeats:
 # this is separate from the temporary batch of ids
 # that are written to the csv and then forgotten
-seen_ids = []
+class SeenIds():
+    '''
+    the ids written so far, in a set, or with a database path in an sqlite
+    table on disk instead. The database is queried rather than loaded, so a
+    restarted run picks up where it left off at once, and runs for several
+    tags or fandoms can share one database (and run at the same time)
+    '''
+    def __init__(self, db_fpath=''):
+        self.ids = set()
+        self.db = None
+        if db_fpath:
+            self.db = sqlite3.connect(db_fpath, timeout=60)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen_ids (id INTEGER PRIMARY KEY)")
+            self.db.commit()
+
+    def __contains__(self, id):
+        if self.db is None:
+            return id in self.ids
+        return self.db.execute("SELECT 1 FROM seen_ids WHERE id = ?", (int(id),)).fetchone() is not None
+
+    def __len__(self):
+        if self.db is None:
+            return len(self.ids)
+        return self.db.execute("SELECT COUNT(*) FROM seen_ids").fetchone()[0]
+
+    def update(self, ids):
+        if self.db is None:
+            self.ids.update(ids)
+            return
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO seen_ids VALUES (?)", ((int(id),) for id in ids))
+
+seen_ids = SeenIds()
+
+# the catalog that works found are recorded in, and the fandom they're recorded under (see ao3_catalog.py)
+catalog = None
+catalog_fandom = ''
+
+# every request waits its turn, shared with any other scrapers running (see ao3_http.py)
+rate_limiter = RateLimiter()
+retry_policy = RetryPolicy(rate_limiter)
+session = make_session()
+request_timeout = DEFAULT_TIMEOUT
 
 # 
 # Ask the user for:
@@ -50,7 +116,16 @@ def get_args():
     global csv_name
     global num_requested_fic
     global multichap_only
+    global metadata_only
     global tags
+    global seen_ids
+    global start_page
+    global resume
+    global rate_limiter
+    global retry_policy
+    global request_timeout
+    global catalog
+    global catalog_fandom
 
     parser = argparse.ArgumentParser(description='Scrape AO3 work IDs given a search URL')
     parser.add_argument(
@@ -63,9 +138,23 @@ def get_args():
         '--header', default='',
         help='user http header')
     parser.add_argument(
-        '--start_with_page', default=1, 
+        '--base_url', default='',
+        help='request the search from this site instead of AO3, e.g. a local stand-in (benchmarks/ao3_standin.py)')
+    parser.add_argument(
+        '--delay', type=float, default=DEFAULT_DELAY,
+        help='seconds between requests to AO3, across all scrapers sharing --rate_file (default 5)')
+    parser.add_argument(
+        '--rate_file', default=DEFAULT_RATE_FPATH,
+        help='file that scrapers running at the same time share their request rate through')
+    parser.add_argument(
+        '--timeout', type=float, default=DEFAULT_TIMEOUT,
+        help='seconds to wait for a page before retrying it (default 60)')
+    parser.add_argument(
+        '--start_with_page', type=int, default=1, 
         help='page to start scraping') 
-        # doesn't appear to work since there is no use of this variable?
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='continue an interrupted search from its checkpoint, <out_csv>_checkpoint.json')
     parser.add_argument(
         '--num_to_retrieve', default='a', 
         help='how many fic ids you want')
@@ -75,10 +164,51 @@ def get_args():
     parser.add_argument(
         '--tag_csv', default='',
         help='provide an optional list of tags; the retrieved fics must have one or more such tags')
+    parser.add_argument(
+        '--metadata', action='store_true',
+        help='also write the metadata shown in the search results to <out_csv>_stories.csv, in the format of stories.csv')
+    parser.add_argument(
+        '--seen_db', default='',
+        help='sqlite file of ids already collected, which are skipped. kept between runs and can be shared between fandoms')
+    parser.add_argument(
+        '--metrics_file', default='',
+        help='file to write crawl metrics to, as json or, if it ends in .prom, in the Prometheus text format')
+    parser.add_argument(
+        '--metrics_every', type=float, default=60,
+        help='seconds between writing metrics (default 60)')
+    parser.add_argument(
+        '--catalog', default='',
+        help='SQLite catalog shared with ao3_get_fanfics.py to record the works found in (see ao3_catalog.py)')
+    parser.add_argument(
+        '--fandom', default='',
+        help='fandom to record the works under in the --catalog (default the --out_csv name)')
+    parser.add_argument(
+        '--profile', nargs='?', const='profile', default='',
+        help='time each stage and write cProfile stats to this directory (default profile/)')
+    parser.add_argument(
+        '--profile_every', type=int, default=1000,
+        help='number of ids between profile dumps (default 1000)')
+    parser.add_argument(
+        '--profile_memory', action='store_true',
+        help='also record the lines that allocate the most memory in each profile dump (slow)')
 
     args = parser.parse_args()
-    url = args.url
+    url = https_url(args.url)
+    if args.base_url:
+        url = args.base_url.rstrip('/') + re.sub(r'^https?://[^/]+', '', url)
+    base_url = url
     csv_name = str(args.out_csv)
+    start_page = args.start_with_page
+    rate_limiter = RateLimiter(args.delay, state_fpath=args.rate_file)
+    retry_policy = RetryPolicy(rate_limiter)
+    request_timeout = args.timeout
+    resume = args.resume
+    metrics.configure(args.metrics_file, args.metrics_every)
+    if args.catalog:
+        catalog = Catalog(args.catalog)
+        catalog_fandom = args.fandom or os.path.basename(csv_name)
+    if args.profile:
+        profiler.start(args.profile, args.profile_every, args.profile_memory, unit='ids')
     
     # defaults to all
     if (str(args.num_to_retrieve) is 'a'):
@@ -92,6 +222,15 @@ def get_args():
     else:
         multichap_only = False
 
+    metadata_only = args.metadata
+    if args.seen_db:
+        seen_ids = SeenIds(args.seen_db)
+        print("{} ids already collected in {}".format(len(seen_ids), args.seen_db))
+    elif resume and os.path.isfile(csv_name + ".csv"):
+        # without a database, the ids already written are the ones in the csv
+        with open(csv_name + ".csv", "r") as f:
+            seen_ids.update(row[0] for row in csv.reader(f) if row)
+
     tag_csv = str(args.tag_csv)
     if (tag_csv):
         with open(tag_csv, "r") as tags_f:
@@ -110,32 +249,25 @@ def get_args():
 def get_ids(header_info=''):
     global page_empty
     headers = {'user-agent' : header_info}
+    # retries while AO3 says 'Retry later', and stops at any other error page,
+    # so that a page without works is only taken for the end of the results
+    # when it is one (past the last page, AO3 lists no works rather than erroring)
     try:
-        req = requests.get(url, headers=headers)
-    except requests.exceptions.ConnectionError:
-        print ("CONNECTION ERROR", url)
-        time.sleep(15)
-        try:
-            req = requests.get(url, headers=headers)
-        except requests.exceptions.ConnectionError:
-            print (url, "FAILED TWICE -- SKIPPING")
-            return []
-
-    wait_time = 15
-    increment = 1
-    while req.text == 'Retry later\n':
-        tqdm.write("Page reads 'retry later'")
-        time.sleep(wait_time * increment)
-        req = requests.get(url, headers=headers)
-        increment += 1
-        if increment > 6:
-            break
-    soup = BeautifulSoup(req.text, "lxml")
-
-    # some responsiveness in the "UI"
-    #sys.stdout.write('.')
-    #sys.stdout.flush()
-    works = soup.find_all(class_="work blurb group")
+        req = fetch(url, headers, rate_limiter, retry_policy, session, request_timeout)
+        if req.status_code != 200 or throttled(req):
+            raise requests.exceptions.HTTPError("HTTP {}".format(req.status_code), response=req)
+    except requests.exceptions.RequestException:
+        tqdm.write("{} FAILED -- stopping, continue later with --resume".format(url))
+        raise
+    with metrics.timer("parse"):
+        with profiler.stage("soup"):
+            soup = BeautifulSoup(req.text, "lxml")
+
+        # some responsiveness in the "UI"
+        #sys.stdout.write('.')
+        #sys.stdout.flush()
+        # blurbs also carry per-work classes (work-<id> user-<id>), so match classes rather than the whole attribute
+        works = soup.select("li.work.blurb.group")
 
     # see if we've gone too far and run out of fic: 
     if (len(works) is 0):
@@ -148,20 +280,94 @@ def get_ids(header_info=''):
         if (multichap_only):
             # FOR MULTICHAP ONLY
             chaps = tag.find('dd', class_="chapters")
-            if (chaps.text != u"1/1"):
-                t = tag.get('id')
-                t = t[5:]
-                if not t in seen_ids:
-                    ids.append(t)
-                    seen_ids.append(t)
-        else:
-            t = tag.get('id')
-            t = t[5:]
-            if not t in seen_ids:
-                ids.append(t)
-                seen_ids.append(t)
+            if (chaps.text == u"1/1"):
+                continue
+        t = tag.get('id')
+        t = t[5:]
+        if not t in seen_ids:
+            ids.append((t, tag))
     return ids
 
+# 
+# the stats shown in a work's blurb on the listing page:
+# the date it was last updated, its chapters (e.g. 3/5) and word count.
+# these are saved with each id so that ao3_get_fanfics.py --update
+# can skip works that haven't changed since they were last scraped
+# 
+@timed("get_blurb_stats")
+def get_blurb_stats(tag):
+    date = tag.find('p', class_="datetime")
+    try:
+        date = datetime.datetime.strptime(date.text.strip(), "%d %b %Y").strftime("%Y-%m-%d")
+    except (AttributeError, ValueError):
+        date = ""
+    stats = [date]
+    for category in ['chapters', 'words']:
+        dd = tag.find('dd', class_=category)
+        stats.append(dd.text.strip() if dd else "")
+    return stats
+
+def blurb_tags(tag, css):
+    return [unidecode(a.text) for li in tag.find_all('li', class_=css) for a in li.find_all('a', class_="tag")]
+
+# 
+# the rest of a work's metadata from its blurb, as a row of stories.csv.
+# blurbs don't show the published date or the notes, and the chapter count
+# is the number of chapters posted so far
+# 
+@timed("get_blurb_metadata")
+def get_blurb_metadata(tag):
+    strow = {"fic_id": tag.get('id')[5:]}
+    heading = tag.find('h4', class_="heading")
+    strow["title"] = heading.find('a').text.strip()
+    author = heading.find('a', rel="author")
+    if author:
+        href = author['href'].split("/")
+        strow["author_key"] = href[2]
+        strow["author"] = href[4] if len(href) > 4 else href[2]
+    else: # anonymous and orphaned works
+        strow["author_key"] = strow["author"] = heading.text.split(" by ")[-1].strip()
+
+    required = {}
+    for span in tag.select("ul.required-tags span[title]"):
+        for css in ['rating', 'category']:
+            if css in span.get('class', []):
+                required[css] = span['title']
+    strow["rating"] = [required['rating']] if 'rating' in required else []
+    category = required.get('category', '')
+    strow["category"] = [c.strip() for c in category.split(",")] if category and category != "No category" else []
+    fandoms = tag.find('h5', class_="fandoms")
+    strow["fandom"] = [unidecode(a.text) for a in fandoms.find_all('a', class_="tag")] if fandoms else []
+    strow["relationship"] = blurb_tags(tag, "relationships")
+    strow["character"] = blurb_tags(tag, "characters")
+    strow["freeform"] = strow["additional tags"] = blurb_tags(tag, "freeforms")
+
+    for category in ['language', 'words', 'comments', 'kudos', 'bookmarks', 'hits']:
+        dd = tag.find('dd', class_=category)
+        strow[category] = unidecode(dd.text).strip() if dd else "null"
+    date, chapters, _ = get_blurb_stats(tag)
+    strow["published"] = "null"
+    # as get_stats does: a work page only shows a status once there is more than one chapter
+    posted, _, total = chapters.partition("/")
+    if posted == "1":
+        strow["status"], strow["status date"] = 'Completed', "null"
+    else:
+        strow["status"] = 'Completed' if posted == total else 'Updated'
+        strow["status date"] = date
+    strow["chapter_count"] = posted
+
+    strow["series"] = strow["seriespart"] = strow["seriesid"] = ""
+    series = tag.select_one("ul.series li")
+    if series:
+        link = series.find('a')
+        strow["series"] = link.text
+        strow["seriespart"] = series.find('strong').text
+        strow["seriesid"] = link['href'].split("/")[2]
+    summary = tag.find('blockquote', class_="summary")
+    strow["summary"] = into_text(summary) if summary else ""
+    strow["preface_notes"] = strow["afterword_notes"] = ""
+    return strow
+
 # 
 # update the url to move to the next page
 # note that if you go too far, ao3 won't error, 
@@ -195,12 +401,25 @@ def update_url_to_next_page():
         else:
             url = url + "?page=2"
 
+def get_page():
+    match = re.search(r"[?&]page=(\d+)", url)
+    return int(match.group(1)) if match else 1
+
+# move the url to a given page
+def set_page(page):
+    global url
+    if re.search(r"[?&]page=\d+", url):
+        url = re.sub(r"([?&]page=)\d+", r"\g<1>{}".format(page), url)
+    elif url.find("?") != -1:
+        url = url + "&page=" + str(page)
+    else:
+        url = url + "?page=" + str(page)
 
 # modify the base_url to include the new tag, and save to global url
 def add_tag_to_url(tag):
     global url
     key = "&work_search%5Bother_tag_names%5D="
-    if (base_url.find(key)):
+    if (base_url.find(key) != -1):
         start = base_url.find(key) + len(key)
         new_url = base_url[:start] + tag + "%2C" + base_url[start:]
         url = new_url
@@ -212,18 +431,52 @@ def add_tag_to_url(tag):
 # after every page, write the gathered ids
 # to the csv, so a crash doesn't lose everything.
 # include the url where it was found,
-# so an interrupted search can be restarted
+# so an interrupted search can be restarted,
+# and the blurb stats (updated date, chapters, words)
 # 
 def write_ids_to_csv(ids):
+    with metrics.timer("write"):
+        write_ids(ids)
+
+def write_ids(ids):
     global num_recorded_fic
-    with open(csv_name + ".csv", 'a') as csvfile:
+    written = []
+    rows = []
+    with open(csv_name + ".csv", 'a') as csvfile, open_stories_csv() as storiesfile:
         wr = csv.writer(csvfile, delimiter=',')
-        for id in ids:
+        for id, blurb in ids:
+            if id in written:
+                continue
             if (not_finished()):
-                wr.writerow([id, url])
+                row = [id, url] + get_blurb_stats(blurb)
+                wr.writerow(row)
+                rows.append(row)
+                if storiesfile:
+                    strow = get_blurb_metadata(blurb)
+                    csv.writer(storiesfile).writerow([maybe_json(strow.get(k, "null")) for k in storycolumns])
                 num_recorded_fic = num_recorded_fic + 1
+                written.append(id)
             else:
                 break
+    # only once they're safely in the csv
+    seen_ids.update(written)
+    if catalog is not None:
+        catalog.listed(catalog_fandom, rows)
+    metrics.count("ids_total", len(written))
+    profiler.done(len(written))
+
+# 
+# in metadata mode, blurbs are also written to <csv_name>_stories.csv
+# 
+def open_stories_csv():
+    if not metadata_only:
+        return contextlib.nullcontext()
+    fname = csv_name + "_stories.csv"
+    is_new = not os.path.isfile(fname) or os.stat(fname).st_size == 0
+    f = open(fname, 'a')
+    if is_new:
+        csv.writer(f).writerow(storycolumns)
+    return f
 
 # 
 # if you want everything, you're not done
@@ -251,6 +504,34 @@ def make_readme():
     with open(csv_name + "_readme.txt", "w") as text_file:
         text_file.write("url: " + url + "\n" + "num_requested_fic: " + str(num_requested_fic) + "\n" + "retreived on: " + str(datetime.datetime.now()))
 
+# 
+# after every page, save where the search got to: the url of the next page,
+# its page number, which tag it's on and how many ids were written for that tag.
+# it is written to a temporary file first, so a crash can't leave half a checkpoint
+# 
+def checkpoint_fname():
+    return csv_name + "_checkpoint.json"
+
+def write_checkpoint(tag_index, done=False):
+    checkpoint = {
+        "url": url,
+        "page": get_page(),
+        "tag_index": tag_index,
+        "num_recorded_fic": num_recorded_fic,
+        "done": done,
+    }
+    tmp_fname = checkpoint_fname() + ".tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_fname, checkpoint_fname())
+
+def load_checkpoint():
+    if not os.path.isfile(checkpoint_fname()):
+        print("No checkpoint found at {}, starting from the beginning".format(checkpoint_fname()))
+        return None
+    with open(checkpoint_fname(), "r") as f:
+        return json.load(f)
+
 # reset flags to run again
 # note: do not reset seen_ids
 def reset():
@@ -259,15 +540,15 @@ def reset():
     page_empty = False
     num_recorded_fic = 0
 
-def process_for_ids(header_info=''):
+def process_for_ids(header_info='', tag_index=0):
     ids_written = 0
     if num_requested_fic > -1:
-        pbar = tqdm(total=num_requested_fic, ncols=70)
+        pbar = tqdm(total=num_requested_fic, initial=num_recorded_fic, ncols=70)
     else:
-        pbar = tqdm()
+        pbar = tqdm(initial=num_recorded_fic)
     while(not_finished()):
-        # 5 second delay between requests as per AO3's terms of service
-        time.sleep(5)
+        # 5 second delay between requests as per AO3's terms of service,
+        # taken by the rate limiter in get_ids
         ids = get_ids(header_info)
         write_ids_to_csv(ids)
         pbar.update(len(ids))
@@ -275,23 +556,51 @@ def process_for_ids(header_info=''):
         #sys.stdout.write('{} IDs written\n'.format(ids_written))
         sys.stdout.flush()
         update_url_to_next_page()
+        write_checkpoint(tag_index)
+        metrics.count("pages_total")
+        metrics.maybe_write()
 
 def main():
+    global url
+    global num_recorded_fic
     header_info = get_args()
-    make_readme()
+    checkpoint = load_checkpoint() if resume else None
+    if checkpoint and checkpoint["done"]:
+        tqdm.write("The search in {} has already finished".format(checkpoint_fname()))
+        return
+    if not checkpoint:
+        make_readme()
 
     print ("processing...\n")
 
-    if (len(tags)):
-        for t in tags:
+    # one pass over the search for each tag, or just one
+    passes = tags if len(tags) else [None]
+    for i, t in enumerate(passes):
+        if checkpoint and i < checkpoint["tag_index"]:
+            continue
+        if t is not None:
             print ("Getting tag: ", t)
             reset()
             add_tag_to_url(t)
-            process_for_ids(header_info)
-    else:
-        process_for_ids(header_info)
+        if checkpoint and i == checkpoint["tag_index"] and checkpoint["url"]:
+            url = checkpoint["url"]
+            num_recorded_fic = checkpoint["num_recorded_fic"]
+            print("Resuming from page {} with {} ids written".format(checkpoint["page"], num_recorded_fic))
+        elif i == 0 and start_page > 1:
+            set_page(start_page)
+        process_for_ids(header_info, i)
+        # the next pass starts from the beginning of its tag
+        url = ""
+        reset()
+        write_checkpoint(i + 1)
+    write_checkpoint(len(passes), done=True)
+    metrics.write()
+    profiler.stop()
+    if catalog is not None:
+        catalog.close()
 
     tqdm.write("That's all, folks.")
     tqdm.write("Written to {}\n".format(csv_name))
 
-main()
+if __name__ == '__main__':
+    main()
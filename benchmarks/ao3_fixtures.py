@@ -0,0 +1,290 @@
+'''
+Synthetic AO3 pages that follow the archive's markup closely enough for the
+scrapers to parse them: work pages (one-shots up to long multi-chapter works
+viewed with view_full_work=true and show_comments=true) and the work listing
+pages that ao3_work_ids.py reads, whose blurbs agree with the work pages.
+
+Pages are generated from a seed, so the same arguments always give the same page.
+A work's revision can be bumped to make it look updated since the last crawl.
+Saved or recorded pages can be used instead of (or as well as) these, see bench_parse.py.
+'''
+
+import datetime
+import gzip
+import os
+import random
+from html import escape
+
+WORDS = ("the a and of to in was he she they said it that his her with had for on at "
+         "as but not be from what all were when we there been one would could out into "
+         "time only about then back looked over after before never door hand eyes night "
+         "light voice again room something away still through long head face thought").split()
+
+RATINGS = ["General Audiences", "Teen And Up Audiences", "Mature", "Explicit", "Not Rated"]
+CATEGORIES = ["F/F", "F/M", "Gen", "M/M", "Multi", "Other"]
+
+
+def sentence(rng, n_words=None):
+    n_words = n_words or rng.randint(4, 20)
+    words = [rng.choice(WORDS) for _ in range(n_words)]
+    return " ".join(words).capitalize() + rng.choice([".", ".", ".", "?", "!"])
+
+def paragraph(rng):
+    ''' a paragraph of text, with the kinds of inline markup AO3 allows '''
+    text = " ".join(sentence(rng) for _ in range(rng.randint(1, 6)))
+    kind = rng.random()
+    if kind < 0.1:
+        # line breaks inside a paragraph
+        parts = text.split(". ")
+        return "<p>" + ".<br />\n".join(escape(p) for p in parts) + "</p>"
+    if kind < 0.25:
+        words = text.split(" ")
+        i = rng.randrange(len(words))
+        words[i] = "<em>" + escape(words[i]) + "</em>"
+        return "<p>" + " ".join(words) + "</p>"
+    if kind < 0.3:
+        # nested divs, as produced by some rich text editors
+        return "<div><div><p>" + escape(text) + "</p></div></div>"
+    if kind < 0.32:
+        return "<p align=\"center\">* * *</p>"
+    return "<p>" + escape(text) + "</p>"
+
+def userstuff(rng, n_paras):
+    return "\n".join(paragraph(rng) for _ in range(n_paras))
+
+def tag_list(category, tags):
+    items = "".join('<li><a class="tag" href="/tags/{0}/works">{0}</a></li>'.format(escape(t)) for t in tags)
+    return '<dt class="{0} tags">{0}:</dt>\n<dd class="{0} tags"><ul class="commas">{1}</ul></dd>\n'.format(category, items)
+
+def random_date(rng):
+    return "20{:02d}-{:02d}-{:02d}".format(rng.randint(10, 23), rng.randint(1, 12), rng.randint(1, 28))
+
+def work_info(fic_id, n_chapters=1, revision=0):
+    '''
+    the metadata of a work, shared by its work page and its listing blurb.
+    each revision adds a chapter (if there is more than one) and words, and moves the updated date on
+    '''
+    rng = random.Random(fic_id)
+    info = {
+        "fic_id": fic_id,
+        "title": sentence(rng, 3).rstrip(".?!"),
+        "author": "author{}".format(rng.randint(1, 9999)),
+        "rating": rng.choice(RATINGS),
+        "warnings": ["No Archive Warnings Apply"],
+        "category": rng.sample(CATEGORIES, rng.randint(1, 2)),
+        "fandom": ["Synthetic Fandom {}".format(rng.randint(1, 5))],
+        "relationship": ["Character {}/Character {}".format(rng.randint(1, 9), rng.randint(1, 9)) for _ in range(rng.randint(0, 3))],
+        "character": ["Character {}".format(rng.randint(1, 20)) for _ in range(rng.randint(1, 6))],
+        "freeform": [" ".join(rng.sample(WORDS, 2)).title() for _ in range(rng.randint(0, 15))],
+        "series": (rng.randint(1, 9), rng.randint(1000, 99999), "Synthetic Series") if rng.random() < 0.3 else None,
+        "published": random_date(rng),
+        "updated": random_date(rng),
+        "complete": rng.random() < 0.7,
+        "words": rng.randint(500, 5000) * n_chapters,
+        "comments": rng.randint(0, 500),
+        "kudos": rng.randint(0, 5000),
+        "bookmarks": rng.randint(0, 900),
+        "hits": rng.randint(0, 90000),
+        "summary": userstuff(rng, rng.randint(1, 3)),
+        "n_chapters": n_chapters,
+    }
+    info["pseud"] = info["author"].replace("author", "pen")
+    if info["updated"] < info["published"]:
+        info["published"], info["updated"] = info["updated"], info["published"]
+    if n_chapters == 1:
+        info["updated"] = info["published"]
+    if revision:
+        if n_chapters > 1:
+            info["n_chapters"] += revision
+        info["words"] += 1000 * revision
+        year = int(info["updated"][:4]) + revision
+        info["updated"] = "{}{}".format(year, info["updated"][4:])
+        if n_chapters == 1:
+            info["published"] = info["updated"]
+    return info
+
+def work_meta(info):
+    html = '<dl class="work meta group">\n'
+    html += tag_list("rating", [info["rating"]])
+    html += tag_list("warning", info["warnings"])
+    for category in ["category", "fandom", "relationship", "character", "freeform"]:
+        html += tag_list(category, info[category])
+    html += '<dt class="language" lang="en">Language:</dt>\n<dd class="language" lang="en">\n    English\n  </dd>\n'
+    if info["series"]:
+        html += ('<dt class="series">Series:</dt>\n<dd class="series"><span class="series">'
+                 '<span class="position">Part {} of the <a href="/series/{}">{}</a> series</span></span></dd>\n'
+                 ).format(*info["series"])
+    n_chapters = info["n_chapters"]
+    html += '<dt class="stats">Stats:</dt>\n<dd class="stats"><dl class="stats">'
+    html += '<dt class="published">Published:</dt><dd class="published">{}</dd>'.format(info["published"])
+    if n_chapters > 1:
+        html += '<dt class="status">{}:</dt><dd class="status">{}</dd>'.format("Completed" if info["complete"] else "Updated", info["updated"])
+    total = n_chapters if info["complete"] else "?"
+    html += '<dt class="words">Words:</dt><dd class="words">{:,}</dd>'.format(info["words"])
+    html += '<dt class="chapters">Chapters:</dt><dd class="chapters">{}/{}</dd>'.format(n_chapters, total)
+    html += '<dt class="comments">Comments:</dt><dd class="comments">{}</dd>'.format(info["comments"])
+    html += '<dt class="kudos">Kudos:</dt><dd class="kudos">{}</dd>'.format(info["kudos"])
+    html += '<dt class="bookmarks">Bookmarks:</dt><dd class="bookmarks"><a href="/works/{}/bookmarks">{}</a></dd>'.format(info["fic_id"], info["bookmarks"])
+    html += '<dt class="hits">Hits:</dt><dd class="hits">{}</dd>'.format(info["hits"])
+    html += '</dl></dd>\n</dl>\n'
+    return html
+
+def notes_module(rng, kind, id_attr=None):
+    id_html = ' id="{}"'.format(id_attr) if id_attr else ''
+    return ('<div{} class="{} module"><h3 class="heading">{}:</h3>'
+            '<blockquote class="userstuff">{}</blockquote></div>\n').format(
+                id_html, kind, kind.split()[-1].title(), userstuff(rng, rng.randint(1, 3)))
+
+def comments(rng, fic_id, n_comments):
+    html = '<div id="feedback" class="feedback"><div id="comments_placeholder"><ol class="thread">\n'
+    for i in range(n_comments):
+        html += ('<li class="comment group" id="comment_{0}"><h4 class="heading byline">'
+                 '<a href="/users/reader{1}/pseuds/reader{1}">reader{1}</a> on Chapter 1</h4>'
+                 '<blockquote class="userstuff">{2}</blockquote></li>\n').format(
+                     fic_id * 1000 + i, rng.randint(1, 999), userstuff(rng, rng.randint(1, 2)))
+    html += '</ol></div></div>\n'
+    return html
+
+def work_page(fic_id, n_chapters=1, paras_per_chapter=30, n_comments=0, seed=None, revision=0):
+    '''
+    returns the html of a work page.
+    with n_chapters > 1 it looks like a view_full_work=true page, with chapter prefaces and end notes.
+    '''
+    info = work_info(fic_id, n_chapters, revision)
+    n_chapters = info["n_chapters"]
+    rng = random.Random("text {}".format(fic_id if seed is None else seed))
+    chapter_html = [userstuff(rng, paras_per_chapter) for ch in range(n_chapters)]
+
+    html = '<!DOCTYPE html>\n<html lang="en"><head><meta charset="utf-8"/><title>Work {0}</title></head><body>\n'.format(fic_id)
+    html += '<div id="outer" class="wrapper"><div id="inner" class="wrapper"><div id="main" class="works-show region" role="main">\n'
+    html += '<div class="wrapper">\n' + work_meta(info) + '</div>\n'
+    html += '<div id="workskin">\n<div class="preface group">\n'
+    html += '<h2 class="title heading">\n    {}\n  </h2>\n'.format(escape(info["title"]))
+    html += '<h3 class="byline heading">\n    <a rel="author" href="/users/{}/pseuds/{}">{}</a>\n  </h3>\n'.format(info["author"], info["pseud"], info["pseud"])
+    html += '<div class="summary module"><h3 class="heading">Summary:</h3><blockquote class="userstuff">{}</blockquote></div>\n'.format(info["summary"])
+    if rng.random() < 0.5:
+        html += notes_module(rng, "notes")
+    html += '</div>\n'
+
+    html += '<div id="chapters" role="article">\n'
+    if n_chapters == 1:
+        html += '<h3 class="landmark heading" id="work">Work Text:</h3>\n<div class="userstuff">\n' + chapter_html[0] + '\n</div>\n'
+    else:
+        for ch, text in enumerate(chapter_html, start=1):
+            html += '<div class="chapter" id="chapter-{}">\n'.format(ch)
+            html += '<div class="chapter preface group" role="complementary">\n'
+            html += '<h3 class="title"><a href="/works/{0}/chapters/{1}">Chapter {2}</a>: {3}</h3>\n'.format(
+                fic_id, fic_id * 1000 + ch, ch, escape(sentence(rng, 3).rstrip(".?!")))
+            if rng.random() < 0.3:
+                html += notes_module(rng, "summary", "summary")
+            if rng.random() < 0.4:
+                html += notes_module(rng, "notes", "notes")
+            html += '</div>\n'
+            html += '<div class="userstuff module" role="article">\n<h3 class="landmark heading" id="work">Chapter Text</h3>\n'
+            html += text + '\n</div>\n'
+            if rng.random() < 0.3:
+                html += '<div class="chapter preface group" role="complementary">\n'
+                html += notes_module(rng, "end notes", "chapter_{}_endnotes".format(ch))
+                html += '</div>\n'
+            html += '</div>\n'
+    html += '</div>\n'
+    if rng.random() < 0.5:
+        html += '<div id="work_endnotes" class="afterword preface group">\n' + notes_module(rng, "end notes") + '</div>\n'
+    html += '</div>\n'
+    if n_comments:
+        html += comments(rng, fic_id, n_comments)
+    html += '</div></div></div>\n</body></html>\n'
+    return html
+
+def blurb(info):
+    ''' the blurb for a work on a listing page '''
+    fic_id = info["fic_id"]
+    day = datetime.date.fromisoformat(info["updated"])
+    n_chapters = info["n_chapters"]
+    html = '<li id="work_{0}" class="work blurb group work-{0} user-1" role="article">\n'.format(fic_id)
+    html += '<div class="header module">\n<h4 class="heading"><a href="/works/{}">{}</a> by <a rel="author" href="/users/{}/pseuds/{}">{}</a></h4>\n'.format(
+        fic_id, escape(info["title"]), info["author"], info["pseud"], info["pseud"])
+    html += '<h5 class="fandoms heading"><span class="landmark">Fandoms:</span> {}</h5>\n'.format(
+        ", ".join('<a class="tag" href="/tags/{0}/works">{0}</a>'.format(escape(f)) for f in info["fandom"]))
+    html += '<ul class="required-tags">\n'
+    html += '<li><a class="help symbol question modal" title="Symbols key"><span class="rating-general rating" title="{0}"><span class="text">{0}</span></span></a></li>\n'.format(info["rating"])
+    html += '<li><a class="help symbol question modal" title="Symbols key"><span class="warning-no warnings" title="{0}"><span class="text">{0}</span></span></a></li>\n'.format(", ".join(info["warnings"]))
+    html += '<li><a class="help symbol question modal" title="Symbols key"><span class="category-slash category" title="{0}"><span class="text">{0}</span></span></a></li>\n'.format(", ".join(info["category"]))
+    html += '<li><a class="help symbol question modal" title="Symbols key"><span class="complete-{0} iswip" title="{1}"><span class="text">{1}</span></span></a></li>\n'.format(
+        "yes" if info["complete"] else "no", "Complete Work" if info["complete"] else "Work in Progress")
+    html += '</ul>\n<p class="datetime">{} {} {}</p>\n</div>\n'.format(day.day, day.strftime("%b"), day.year)
+    html += '<h6 class="landmark heading">Tags</h6>\n<ul class="tags commas">\n'
+    for css, category in [("warnings", "warnings"), ("relationships", "relationship"), ("characters", "character"), ("freeforms", "freeform")]:
+        for tag in info[category]:
+            link = '<a class="tag" href="/tags/{0}/works">{0}</a>'.format(escape(tag))
+            if css == "warnings":
+                link = "<strong>" + link + "</strong>"
+            html += "<li class='{}'>{}</li> ".format(css, link)
+    html += '\n</ul>\n<h6 class="landmark heading">Summary</h6>\n<blockquote class="userstuff summary">{}</blockquote>\n'.format(info["summary"])
+    if info["series"]:
+        html += '<h6 class="landmark heading">Series</h6>\n<ul class="series">\n<li>Part <strong>{}</strong> of <a href="/series/{}">{}</a></li>\n</ul>\n'.format(*info["series"])
+    total = n_chapters if info["complete"] else "?"
+    chapters = str(n_chapters) if n_chapters == 1 else '<a href="/works/{}/chapters/{}">{}</a>'.format(fic_id, fic_id * 1000 + n_chapters, n_chapters)
+    html += '<dl class="stats">\n'
+    html += '<dt class="language">Language:</dt>\n<dd class="language" lang="en">English</dd>\n'
+    html += '<dt class="words">Words:</dt>\n<dd class="words">{:,}</dd>\n'.format(info["words"])
+    html += '<dt class="chapters">Chapters:</dt>\n<dd class="chapters">{}/{}</dd>\n'.format(chapters, total)
+    html += '<dt class="comments">Comments:</dt>\n<dd class="comments"><a href="/works/{}?show_comments=true">{}</a></dd>\n'.format(fic_id, info["comments"])
+    html += '<dt class="kudos">Kudos:</dt>\n<dd class="kudos"><a href="/works/{}#kudos">{}</a></dd>\n'.format(fic_id, info["kudos"])
+    html += '<dt class="bookmarks">Bookmarks:</dt>\n<dd class="bookmarks"><a href="/works/{}/bookmarks">{}</a></dd>\n'.format(fic_id, info["bookmarks"])
+    html += '<dt class="hits">Hits:</dt>\n<dd class="hits">{}</dd>\n'.format(info["hits"])
+    html += '</dl>\n</li>\n'
+    return html
+
+def listing_page(infos, page=1, n_pages=1):
+    ''' a page of work blurbs, like /works?page=N or /tags/<tag>/works?page=N '''
+    html = '<!DOCTYPE html>\n<html lang="en"><head><meta charset="utf-8"/><title>Works | Archive of Our Own</title></head><body>\n'
+    html += '<div id="main" class="works-index dashboard filtered region" role="main">\n'
+    html += '<h2 class="heading">{} Works</h2>\n'.format(len(infos))
+    html += '<ol class="work index group">\n' + "".join(blurb(info) for info in infos) + '</ol>\n'
+    html += '<ol class="pagination actions" role="navigation">'
+    if page < n_pages:
+        html += '<li class="next" title="next"><a rel="next" href="?page={}">Next</a></li>'.format(page + 1)
+    html += '</ol>\n</div>\n</body></html>\n'
+    return html
+
+def locked_page():
+    return ('<!DOCTYPE html>\n<html><body><div id="main" class="sessions-new region" role="main">'
+            '<div class="flash error">Sorry, you don\'t have permission to access the page you were trying to reach. Please log in.</div>'
+            '<div id="login"><form class="new_user" action="/users/login" method="post"></form></div>'
+            '</div></body></html>\n')
+
+def tag_page(tag, synonyms=()):
+    ''' the landing page of a canonical tag, listing the tags wrangled as its synonyms '''
+    html = '<!DOCTYPE html>\n<html lang="en"><head><meta charset="utf-8"/><title>{} | Archive of Our Own</title></head><body>\n'.format(escape(tag))
+    html += '<div id="main" class="tags-show region" role="main">\n'
+    html += '<div class="primary header module"><h2 class="heading">{}</h2></div>\n'.format(escape(tag))
+    html += '<div class="synonym listbox group"><h3 class="heading">Tags with the same meaning:</h3><ul class="tags commas index group">'
+    html += "".join('<li><a class="tag" href="/tags/{0}">{0}</a></li>'.format(escape(t)) for t in synonyms)
+    html += '</ul></div>\n</div>\n</body></html>\n'
+    return html
+
+# name: (fic_id, n_chapters, paras_per_chapter, n_comments)
+CORPUS = {
+    "oneshot_short": (1000001, 1, 15, 0),
+    "oneshot_long": (1000002, 1, 400, 0),
+    "multichapter_10": (1000003, 10, 40, 20),
+    "multichapter_50": (1000004, 50, 40, 100),
+    "full_work_200": (1000005, 200, 60, 300),
+}
+
+def make_corpus(dirpath, names=None):
+    '''
+    writes the fixture pages to dirpath as <name>.html.gz (if they aren't already there)
+    and returns their paths
+    '''
+    os.makedirs(dirpath, exist_ok=True)
+    paths = []
+    for name in (names or sorted(CORPUS)):
+        path = os.path.join(dirpath, name + ".html.gz")
+        if not os.path.exists(path):
+            fic_id, n_chapters, paras, n_comments = CORPUS[name]
+            with gzip.open(path, "wt", encoding="utf-8") as f:
+                f.write(work_page(fic_id, n_chapters, paras, n_comments))
+        paths.append(path)
+    return paths
@@ -0,0 +1,225 @@
+'''
+A local stand-in for AO3, for testing the scrapers' throughput, retries and memory
+without touching the real archive (or the network).
+
+It serves the synthetic pages from ao3_fixtures.py (or pages recorded in a page cache):
+    /works/<id>                 work pages, some of them locked
+    /works?page=N               listing pages of 20 blurbs, as read by ao3_work_ids.py
+    /tags/<tag>/works?page=N    the same, for a tag
+    /tags/<tag>                 tag pages with synonyms, as read by extras/get_tag_counts.py
+    /stats                      counts of what has been served so far, as json
+and can be slow, fail, or throttle clients with 429 'Retry later' responses.
+
+Usage - python benchmarks/ao3_standin.py [--port 8000] [--works 100000] [--latency 0.2]
+            [--error_rate 0.01] [--retry_later_rate 0.01] [--max_rate 5] [--cache_dir raw/]
+
+then point the scrapers at it with --base_url (and no delay, since it's not AO3):
+    python ao3_work_ids.py "http://localhost:8000/works" --base_url http://localhost:8000 --delay 0 --rate_file ''
+    python ao3_get_fanfics.py work_ids.csv --base_url http://localhost:8000 --delay 0 --rate-file '' --cache-dir ''
+'''
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote_plus
+
+BENCH_DIRPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIRPATH, '..'))
+
+import ao3_fixtures
+from ao3_cache import RawCache
+
+WORKS_PER_PAGE = 20
+
+
+class StandIn():
+    ''' what the server serves, and how badly it behaves '''
+
+    def __init__(self, n_works=100000, latency=0, error_rate=0, retry_later_rate=0, max_rate=0,
+                 locked_rate=0.01, revision=0, revised_rate=0, cache_dir=''):
+        '''
+        n_works: works in the archive, with ids 1 to n_works
+        latency: average seconds before each response
+        error_rate: fraction of requests answered with a 500 or a dropped connection
+        retry_later_rate: fraction of requests answered with 429 'Retry later'
+        max_rate: requests per second, above which clients get 429 'Retry later' (0 for no limit)
+        locked_rate: fraction of works that are only for logged in users
+        revision, revised_rate: this fraction of works has been updated revision times
+            (more chapters and words, a later date), to test ao3_get_fanfics.py --update
+        cache_dir: serve pages recorded in this page cache where there are any
+        '''
+        self.n_works = n_works
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_later_rate = retry_later_rate
+        self.max_rate = max_rate
+        self.locked_rate = locked_rate
+        self.revision = revision
+        self.revised_rate = revised_rate
+        self.cache = RawCache(cache_dir) if cache_dir else None
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def fraction(self, fic_id, salt):
+        # a fixed pseudo-random number in [0, 1) for each work
+        return (zlib.crc32("{} {}".format(salt, fic_id).encode()) % 10000) / 10000
+
+    def work_shape(self, fic_id):
+        ''' returns (n_chapters, paragraphs per chapter, revision) '''
+        rng = random.Random("shape {}".format(fic_id))
+        n_chapters = rng.choice([1, 1, 1, 1, 2, 3, 5, 10, 30])
+        revision = self.revision if self.fraction(fic_id, "revised") < self.revised_rate else 0
+        return n_chapters, rng.randint(10, 60), revision
+
+    def work(self, fic_id):
+        if fic_id < 1 or fic_id > self.n_works:
+            return 404, "<html><body><h2>Error 404</h2><p>The page you were looking for doesn't exist.</p></body></html>"
+        if self.fraction(fic_id, "locked") < self.locked_rate:
+            return 200, ao3_fixtures.locked_page()
+        n_chapters, paras, revision = self.work_shape(fic_id)
+        return 200, ao3_fixtures.work_page(fic_id, n_chapters, paras, revision=revision)
+
+    def listing(self, key, page):
+        n_pages = (self.n_works + WORKS_PER_PAGE - 1) // WORKS_PER_PAGE
+        # each search or tag lists all the works, starting at a different one
+        offset = zlib.crc32(key.encode()) % self.n_works
+        infos = []
+        if 1 <= page <= n_pages:
+            for i in range((page - 1) * WORKS_PER_PAGE, min(page * WORKS_PER_PAGE, self.n_works)):
+                fic_id = 1 + (offset + i) % self.n_works
+                n_chapters, _, revision = self.work_shape(fic_id)
+                infos.append(ao3_fixtures.work_info(fic_id, n_chapters, revision))
+        return 200, ao3_fixtures.listing_page(infos, page, n_pages)
+
+    def tag(self, tag):
+        synonyms = ["{} ({})".format(tag, kind) for kind in ["Alternate Spelling", "Abbreviation"]]
+        return 200, ao3_fixtures.tag_page(tag, synonyms)
+
+    def page(self, path):
+        ''' returns (status, html) for a request path '''
+        if self.cache:
+            text = self.cache.get("https://archiveofourown.org" + path)
+            if text is not None:
+                return 200, text
+        parts = urlsplit(path)
+        query = parse_qs(parts.query)
+        page = int(query.get("page", ["1"])[0])
+        match = re.fullmatch(r"/works/(\d+)(/chapters/\d+)?", parts.path)
+        if match:
+            return self.work(int(match.group(1)))
+        if parts.path == "/works":
+            return self.listing(" ".join(sorted(v for k, vs in query.items() if k != "page" for v in vs)), page)
+        match = re.fullmatch(r"/tags/([^/]+)/works", parts.path)
+        if match:
+            return self.listing(unquote_plus(match.group(1)) + " " + " ".join(query.get("work_search[other_tag_names]", [])), page)
+        match = re.fullmatch(r"/tags/([^/]+)", parts.path)
+        if match:
+            return self.tag(unquote_plus(match.group(1)))
+        return 404, "<html><body><h2>Error 404</h2></body></html>"
+
+    def over_rate(self):
+        ''' whether this request comes too soon after the last ones, like AO3's rate limit '''
+        if not self.max_rate:
+            return False
+        with self.lock:
+            now = time.time()
+            if self.next_time - now > 1: # allow a second's worth of burst
+                return True
+            self.next_time = max(now, self.next_time) + 1 / self.max_rate
+            return False
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+
+def make_handler(standin):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive
+
+        def send_text(self, status, text, headers=None):
+            body = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+            standin.count("bytes", len(body))
+
+        def do_GET(self):
+            standin.count("requests")
+            if self.path == "/stats":
+                return self.send_text(200, json.dumps(standin.stats))
+            if standin.latency:
+                time.sleep(random.uniform(0.5, 1.5) * standin.latency)
+            if standin.over_rate() or random.random() < standin.retry_later_rate:
+                standin.count("retry_later")
+                return self.send_text(429, "Retry later\n", {"Retry-After": "1"})
+            if random.random() < standin.error_rate:
+                standin.count("errors")
+                if random.random() < 0.5:
+                    self.close_connection = True # dropped without a response
+                    return
+                return self.send_text(500, "<html><body><h2>Error 500</h2></body></html>")
+            status, text = standin.page(self.path)
+            standin.count(status)
+            self.send_text(status, text)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def serve(standin, host="localhost", port=8000):
+    server = ThreadingHTTPServer((host, port), make_handler(standin))
+    server.daemon_threads = True
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic AO3 pages locally')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--works', type=int, default=100000,
+        help='number of works in the archive (ids 1 to this)')
+    parser.add_argument('--latency', type=float, default=0,
+        help='average seconds to wait before each response')
+    parser.add_argument('--error_rate', type=float, default=0,
+        help='fraction of requests that fail with a 500 or a dropped connection')
+    parser.add_argument('--retry_later_rate', type=float, default=0,
+        help="fraction of requests answered with 429 'Retry later'")
+    parser.add_argument('--max_rate', type=float, default=0,
+        help="requests per second, above which requests get 429 'Retry later' (default no limit)")
+    parser.add_argument('--locked_rate', type=float, default=0.01,
+        help='fraction of works only visible to logged in users')
+    parser.add_argument('--revision', type=int, default=0,
+        help='number of times the works in --revised_rate have been updated')
+    parser.add_argument('--revised_rate', type=float, default=0,
+        help='fraction of works that have been updated --revision times')
+    parser.add_argument('--cache_dir', default='',
+        help='serve pages recorded in this page cache (e.g. raw/) where there are any')
+    args = parser.parse_args()
+
+    standin = StandIn(args.works, args.latency, args.error_rate, args.retry_later_rate, args.max_rate,
+                      args.locked_rate, args.revision, args.revised_rate, args.cache_dir)
+    server = serve(standin, args.host, args.port)
+    print("Serving {} works on http://{}:{}/".format(args.works, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(standin.stats))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+'''
+Benchmarks for the parsing hot path of ao3_get_fanfics.py.
+
+For each work page in the corpus this reports the time taken by each stage
+(building the tree, get_stats, get_tags, get_series, into_chunks, into_text,
+the whole parse and the whole of write_fic_to_csv without the network),
+works/second and the peak memory of a parse, for one or more parser backends.
+
+Usage - python benchmarks/bench_parse.py [PAGES ...] [--backends bs4 lxml] [--repeat 3] [--json out.json]
+
+PAGES are gzipped or plain html work pages, or directories of them (such as the raw/
+page cache). By default the synthetic corpus in ao3_fixtures.py is generated under
+benchmarks/fixtures/ and used, from one-shots up to a 200 chapter full work page with comments.
+'''
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIRPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIRPATH, '..'))
+
+from bs4 import BeautifulSoup
+import lxml.html
+import ao3_get_fanfics
+import ao3_lxml_parse
+from ao3_cache import RawCache, read_entry
+import ao3_fixtures
+
+
+def load_pages(paths):
+    ''' returns a list of (name, fic_id, src) '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, fnames in os.walk(path):
+                files.extend(os.path.join(dirpath, f) for f in sorted(fnames) if f.endswith((".gz", ".html")))
+        else:
+            files.append(path)
+    pages = []
+    for i, path in enumerate(files):
+        if path.endswith(".gz"):
+            _, src = read_entry(path)
+        else:
+            with open(path) as f:
+                src = f.read()
+        name = os.path.basename(path).split(".")[0]
+        pages.append((name[:30], str(1000000 + i), src))
+    return pages
+
+def bs4_stages(fic_id, src):
+    soup = BeautifulSoup(src, 'lxml')
+    meta = soup.find("dl", class_="work meta group")
+    chapters = [ch for ch in soup.find_all("div", class_="userstuff")]
+    blockquotes = soup.find_all("blockquote")
+    return {
+        "tree": lambda: BeautifulSoup(src, 'lxml'),
+        "get_stats": lambda: ao3_get_fanfics.get_stats(meta),
+        "get_tags": lambda: ao3_get_fanfics.get_tags(meta),
+        "get_series": lambda: ao3_get_fanfics.get_series(meta),
+        "into_chunks": lambda: [list(ao3_get_fanfics.into_chunks(ch)) for ch in chapters],
+        "into_text": lambda: [ao3_get_fanfics.into_text(bq) for bq in blockquotes],
+        "parse_fic": lambda: ao3_get_fanfics.parse_fic(fic_id, src),
+    }
+
+# the lxml parser indexes the meta group once for both stats and tags,
+# so the indexing is counted in both here
+
+def lxml_get_stats(meta):
+    dd_by_class, _, dt_by_class = ao3_lxml_parse.index_meta(meta)
+    return ao3_lxml_parse.get_stats(dd_by_class, dt_by_class)
+
+def lxml_get_tags(meta):
+    _, dd_by_classes, _ = ao3_lxml_parse.index_meta(meta)
+    return ao3_lxml_parse.get_tags(dd_by_classes)
+
+def lxml_stages(fic_id, src):
+    doc = lxml.html.document_fromstring(src)
+    meta = ao3_lxml_parse.WORK_META_DL(doc)[0]
+    chapters = [div for div in doc.iter("div") if "userstuff" in ao3_lxml_parse.classes(div)]
+    blockquotes = list(doc.iter("blockquote"))
+    return {
+        "tree": lambda: lxml.html.document_fromstring(src),
+        "get_stats": lambda: lxml_get_stats(meta),
+        "get_tags": lambda: lxml_get_tags(meta),
+        "get_series": lambda: ao3_lxml_parse.get_series(meta),
+        "into_chunks": lambda: [list(ao3_lxml_parse.into_chunks(ch)) for ch in chapters],
+        "into_text": lambda: [ao3_lxml_parse.into_text(bq) for bq in blockquotes],
+        "parse_fic": lambda: ao3_lxml_parse.parse_fic(fic_id, src),
+    }
+
+BACKENDS = {"bs4": bs4_stages, "lxml": lxml_stages}
+
+def write_fic_stage(fic_id, src, backend, tmp_dirpath):
+    ''' the whole of write_fic_to_csv, reading the page from a throwaway offline cache '''
+    cache = RawCache(os.path.join(tmp_dirpath, "raw"), offline=True)
+    cache.put(ao3_get_fanfics.work_url(fic_id, False), src)
+    output_dirpath = os.path.join(tmp_dirpath, "out")
+    os.makedirs(ao3_get_fanfics.contentdir(output_dirpath, "bench"), exist_ok=True)
+
+    def run():
+        ao3_get_fanfics.raw_cache = cache
+        with open(os.path.join(tmp_dirpath, "stories.csv"), "w") as f_out, \
+             open(os.path.join(tmp_dirpath, "chapters.csv"), "w") as ch_out, \
+             open(os.path.join(tmp_dirpath, "errors.csv"), "w") as e_out:
+            ao3_get_fanfics.write_fic_to_csv("bench", fic_id, False, csv.writer(f_out), csv.writer(ch_out), csv.writer(e_out),
+                ao3_get_fanfics.storycolumns, ao3_get_fanfics.chaptercolumns, output_dirpath=output_dirpath,
+                write_whole_fics=True, parser=backend)
+    return run
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_benchmarks(pages, backends, repeat):
+    '''
+    returns {backend: {page name: {stage: seconds, ..., "peak_bytes": n}}}
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dirpath:
+        for backend in backends:
+            results[backend] = {}
+            for name, fic_id, src in pages:
+                # the parsers print warnings about missing stats, which aren't of interest here
+                with contextlib.redirect_stdout(io.StringIO()):
+                    stages = BACKENDS[backend](fic_id, src)
+                    stages["write_fic_to_csv"] = write_fic_stage(fic_id, src, backend, tmp_dirpath)
+                    timings = {stage: best_time(fn, repeat) for stage, fn in stages.items()}
+                    timings["peak_bytes"] = peak_memory(stages["parse_fic"])
+                timings["size_bytes"] = len(src.encode("utf-8"))
+                results[backend][name] = timings
+    return results
+
+def print_results(results):
+    backends = list(results)
+    for backend in backends:
+        print("\n== {} ==".format(backend))
+        pages = results[backend]
+        stages = [s for s in next(iter(pages.values())) if s not in ("peak_bytes", "size_bytes")]
+        print("{:<30}".format("page (ms)") + "".join("{:>17}".format(s) for s in stages) + "{:>10}".format("peak MB"))
+        for name, timings in pages.items():
+            print("{:<30}".format(name) + "".join("{:>17.2f}".format(timings[s] * 1000) for s in stages)
+                  + "{:>10.1f}".format(timings["peak_bytes"] / 1e6))
+        total = sum(t["write_fic_to_csv"] for t in pages.values())
+        print("works/second (write_fic_to_csv, no network): {:.1f}".format(len(pages) / total))
+        print("MB of html/second: {:.1f}".format(sum(t["size_bytes"] for t in pages.values()) / 1e6 / total))
+
+    if len(backends) > 1:
+        base = backends[0]
+        print("\n== speedup over {} (parse_fic, write_fic_to_csv) ==".format(base))
+        for backend in backends[1:]:
+            for name in results[base]:
+                b, o = results[base][name], results[backend][name]
+                print("{:<10}{:<30}{:>8.1f}x{:>8.1f}x".format(backend, name, b["parse_fic"] / o["parse_fic"],
+                      b["write_fic_to_csv"] / o["write_fic_to_csv"]))
+
+def print_comparison(results, previous):
+    ''' time of each stage relative to an earlier run saved with --json (above 1 is slower now) '''
+    print("\n== relative to the earlier run (now / then) ==")
+    for backend, pages in results.items():
+        for name, timings in pages.items():
+            before = previous.get(backend, {}).get(name)
+            if not before:
+                continue
+            ratios = ["{} {:.2f}".format(stage, timings[stage] / before[stage])
+                      for stage in timings if stage not in ("peak_bytes", "size_bytes") and before.get(stage)]
+            print("{:<10}{:<30}{}".format(backend, name, ", ".join(ratios)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing of AO3 work pages')
+    parser.add_argument('pages', nargs='*',
+        help='work pages (.html or .gz) or directories of them, defaults to the synthetic fixture corpus')
+    parser.add_argument('--backends', nargs='+', default=['bs4', 'lxml'], choices=sorted(BACKENDS),
+        help='parser backends to compare, the first is the baseline')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of times each stage is run, the best time is reported')
+    parser.add_argument('--json', default='',
+        help='also save the results to this json file, to compare against later')
+    parser.add_argument('--compare', default='',
+        help='json file saved by an earlier run to compare these results against')
+    args = parser.parse_args()
+
+    paths = args.pages or ao3_fixtures.make_corpus(os.path.join(BENCH_DIRPATH, "fixtures"))
+    pages = load_pages(paths)
+    print("Benchmarking {} pages, {:.1f} MB of html".format(len(pages), sum(len(src) for _, _, src in pages) / 1e6))
+    results = run_benchmarks(pages, args.backends, args.repeat)
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,10 @@ import sys
 import datetime
 import argparse
 
+# the shared request helpers live in the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ao3_http import RateLimiter, RetryPolicy, fetch, make_session, https_url
+
 
 url = ""
 input_csv_name = ""
@@ -38,7 +42,7 @@ def get_user_params():
 		help='the name of the output csv')
 
 	args = parser.parse_args()
-	url = args.url
+	url = https_url(args.url)
 	input_csv_name = args.csv
 	output_csv_name = args.out_csv
 
@@ -51,7 +55,8 @@ def contains_tag(row, tags):
 	return False
 
 def get_tag_equivalencies():
-	req = requests.get(url)
+	rate_limiter = RateLimiter()
+	req = fetch(url, {}, rate_limiter, RetryPolicy(rate_limiter), make_session(pool_size=1))
 	soup = BeautifulSoup(req.text, "lxml")
 	synonyms = soup.find(class_="synonym listbox group")
 	lis = synonyms.find_all("li")
@@ -69,17 +74,17 @@ def main():
 	tags = get_tag_equivalencies()
 	count = 0
 
-	with open(input_csv_name, 'rb') as incsv:
+	with open(input_csv_name, 'r') as incsv:
 		with open(output_csv_name, 'a') as outcsv:
 			rd = csv.reader(incsv, delimiter=',', quotechar='"')
 			wr = csv.writer(outcsv, delimiter=',', quotechar='"')
 			#skip first line
-			rd.next()
+			next(rd)
 			for row in rd:
 				if contains_tag(row, tags):
 					count = count + 1
 					wr.writerow(row)
 
-	print count
+	print(count)
 
 main()
\ No newline at end of file
@@ -18,6 +18,10 @@ import pdb
 
 # I/O
 fandom_list_fpath = '/usr2/mamille2/fanfiction-project/ao3_books_lit_selected.tsv'
+data_dirpath = '/usr2/mamille2/AO3Scraper/data'
+# ids collected for any fandom, so that crossovers are only collected once
+# and a restarted scrape skips what it already has
+seen_db_fpath = os.path.join(data_dirpath, 'seen_ids.sqlite')
 
 def call_scraper(command):
     subprocess.call(command, shell=True)
@@ -45,12 +49,11 @@ def main():
         
     commands = []
     for f, url in zip(fandoms, urls):
-        data_dirpath = '/usr2/mamille2/AO3Scraper/data'
         f_lowered = f.lower().replace('- ', '').replace(" ", "_").replace(':', '').replace('/', '_').replace('.', '')
         fandom_dirpath = os.path.join(data_dirpath, f_lowered)
         if not os.path.exists(fandom_dirpath):
             os.mkdir(fandom_dirpath)
-        commands.append(f'python /usr2/mamille2/AO3Scraper/ao3_work_ids.py "{url}" --out_csv {fandom_dirpath}/ids')
+        commands.append(f'python /usr2/mamille2/AO3Scraper/ao3_work_ids.py "{url}" --out_csv {fandom_dirpath}/ids --seen_db {seen_db_fpath}')
 
     # Execute commands
     print("Scraping fandom work IDs...")
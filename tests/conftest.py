@@ -0,0 +1,57 @@
+'''
+The scrapers are run as scripts against benchmarks/ao3_standin.py, served from a thread,
+with chosen pages failing a given number of times.
+'''
+
+import os
+import subprocess
+import sys
+import threading
+from urllib.parse import urlsplit
+
+import pytest
+
+REPO_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRPATH)
+sys.path.insert(0, os.path.join(REPO_DIRPATH, 'benchmarks'))
+
+from ao3_standin import StandIn, serve
+
+
+class FailingStandIn(StandIn):
+    '''
+    answers each path in failures (with its query, or without for any query)
+    with a 500 the first so many times it is requested
+    '''
+
+    def __init__(self, n_works=100, **kwargs):
+        super().__init__(n_works, locked_rate=0, **kwargs)
+        self.failures = {}
+
+    def page(self, path):
+        key = path if path in self.failures else urlsplit(path).path
+        with self.lock:
+            n_failures = self.failures.get(key, 0)
+            if n_failures:
+                self.failures[key] = n_failures - 1
+        if n_failures:
+            return 500, "<html><body><h2>Error 500</h2></body></html>"
+        return super().page(path)
+
+
+@pytest.fixture
+def standin():
+    ''' (FailingStandIn, base url) '''
+    standin = FailingStandIn()
+    server = serve(standin, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield standin, "http://localhost:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def run_script(script, *args, timeout=120):
+    ''' runs one of the scrapers, returning the CompletedProcess '''
+    return subprocess.run([sys.executable, os.path.join(REPO_DIRPATH, script)] + [str(arg) for arg in args],
+                          capture_output=True, text=True, timeout=timeout)
@@ -0,0 +1,71 @@
+import csv
+import json
+import os
+
+import pytest
+
+from conftest import run_script
+
+
+def scrape(tmp_path, base_url, fic_ids, *args):
+    ids_fpath = tmp_path / "ids.csv"
+    ids_fpath.write_text("".join("{}\n".format(fic_id) for fic_id in fic_ids))
+    result = run_script("ao3_get_fanfics.py", ids_fpath, "--fandom", "f", "--outputdir", tmp_path,
+                        "--base_url", base_url, "--rate-file", "", "--cache-dir", "", *args)
+    assert result.returncode == 0, result.stderr
+    text_dirpath = tmp_path / "ao3_f_text"
+    with open(text_dirpath / "completed.csv") as f_in:
+        completed = [row[0] for row in csv.reader(f_in) if row and row[0]]
+    return text_dirpath, completed
+
+
+def test_async_retry_rounds(tmp_path, standin):
+    # the works that failed are tried again in a second round, in a new event loop
+    pytest.importorskip("aiohttp")
+    standin, base_url = standin
+    for fic_id in [2, 3, 5]:
+        standin.failures["/works/{}".format(fic_id)] = 1
+    text_dirpath, completed = scrape(tmp_path, base_url, range(1, 7),
+                                     "--async", "--pipeline", 2, "--delay", 0.1, "--retry-rounds", 1)
+    assert sorted(completed, key=int) == [str(fic_id) for fic_id in range(1, 7)]
+    with open(text_dirpath / "errors.csv") as f_in:
+        assert len([row for row in csv.reader(f_in) if row and row[0].isdigit()]) == 3
+
+
+
+def test_works_counted_once(tmp_path, standin):
+    # a work that fails twice before it is scraped is still one work
+    standin, base_url = standin
+    standin.failures["/works/2"] = 2
+    metrics_fpath = tmp_path / "metrics.json"
+    _, completed = scrape(tmp_path, base_url, range(1, 4), "--delay", 0, "--retry-rounds", 2, "--metrics-file", metrics_fpath)
+    assert len(completed) == 3
+    with open(metrics_fpath) as f_in:
+        snapshot = json.load(f_in)
+    counters = snapshot["counters"]
+    assert sum(v for k, v in counters.items() if k.startswith("works_total")) == 3
+    assert sum(v for k, v in counters.items() if k.startswith("work_retries_total")) == 2
+
+
+def failing_chapters(n_chapters):
+    ''' chapters as parse_fic streams them, with the text of the last one failing to parse '''
+    def paras(ch):
+        yield "A paragraph."
+        if ch == n_chapters - 1:
+            raise ValueError("bad html")
+        yield "Another."
+    for ch in range(n_chapters):
+        yield {"paragraph_count": None}, paras(ch)
+
+
+@pytest.mark.parametrize("write_whole_fics", [False, True])
+def test_parse_error_removes_content_files(tmp_path, write_whole_fics):
+    import ao3_get_fanfics
+    from ao3_output import CsvTable
+    os.makedirs(ao3_get_fanfics.contentdir(str(tmp_path), "f"))
+    parsed = {"fic_id": "1", "errors": [], "story": {"fic_id": "1"}, "chapters": failing_chapters(3)}
+    tables = [CsvTable(str(tmp_path / name)) for name in ["stories.csv", "chapters.csv", "errors.csv"]]
+    with pytest.raises(ValueError):
+        ao3_get_fanfics.write_fic_rows("f", parsed, *tables, ao3_get_fanfics.storycolumns, ao3_get_fanfics.chaptercolumns,
+                                       str(tmp_path), write_whole_fics)
+    assert os.listdir(ao3_get_fanfics.contentdir(str(tmp_path), "f")) == []
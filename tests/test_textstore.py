@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from ao3_textstore import TextStore, shard_fname
+
+zstandard = pytest.importorskip("zstandard")
+
+
+def test_failed_work_leaves_nothing_in_the_shard(tmp_path):
+    def failing_paras():
+        for para_id in range(1, 2000):
+            yield 1, para_id, "paragraph {} ".format(para_id) * 20
+        raise ValueError("bad html")
+
+    with TextStore(str(tmp_path)) as store:
+        store.add_work(1, [(1, 1, "first")])
+        size = os.path.getsize(tmp_path / shard_fname(0))
+        with pytest.raises(ValueError):
+            store.add_work(2, failing_paras())
+        assert os.path.getsize(tmp_path / shard_fname(0)) == size
+        store.add_work(3, [(1, 1, "third")])
+
+    store = TextStore(str(tmp_path))
+    assert [(fic_id, [row["text"] for row in rows]) for fic_id, rows in store.works()] == [("1", ["first"]), ("3", ["third"])]
+    # the shard is nothing but the two frames
+    entries = list(store.entries())
+    assert entries[1][2] == entries[0][3]
+    assert os.path.getsize(tmp_path / shard_fname(0)) == entries[1][2] + entries[1][3]
@@ -0,0 +1,29 @@
+import csv
+import json
+
+from conftest import run_script
+
+
+def collect(tmp_path, base_url, *args):
+    return run_script("ao3_work_ids.py", base_url + "/works", "--base_url", base_url, "--delay", 0,
+                      "--rate_file", "", "--out_csv", tmp_path / "ids", *args)
+
+def collected_ids(tmp_path):
+    with open(tmp_path / "ids.csv") as f_in:
+        return [row[0] for row in csv.reader(f_in) if row and row[0].isdigit()]
+
+
+def test_error_page_stops_the_search(tmp_path, standin):
+    # a 500 partway through isn't taken for the end of the results
+    standin, base_url = standin
+    standin.failures["/works?page=3"] = 1
+    result = collect(tmp_path, base_url)
+    assert result.returncode != 0
+    assert "--resume" in result.stdout + result.stderr
+    assert len(collected_ids(tmp_path)) == 40
+    with open(tmp_path / "ids_checkpoint.json") as f_in:
+        assert not json.load(f_in)["done"]
+
+    result = collect(tmp_path, base_url, "--resume")
+    assert result.returncode == 0, result.stderr
+    assert sorted(collected_ids(tmp_path), key=int) == [str(fic_id) for fic_id in range(1, 101)]